@@ -1,6 +1,12 @@
 $(function () {
     $('img').on('click', function() {
         if ($(this).hasClass('small')) {
+            // Thumbnails are swapped for the full image the first time they're enlarged
+            if (this.dataset.fullSrc) {
+                this.src = this.dataset.fullSrc;
+                this.removeAttribute('data-full-src');
+            }
+
             $(this).removeClass('small').addClass('large');
             $(this).animate({'max-height': '80vh', 'max-width': '80vw'}, 200);
         } else {
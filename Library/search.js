@@ -0,0 +1,241 @@
+// The search page for chats formatted with a search index. The index of each chat is in ../Search/<chat>/:
+// terms.js has every word in the chat and the months it's in, and <yyyy-mm>.js has the messages of one month.
+// They're JavaScript files that call the functions below, because browsers don't let pages read JSON files from the
+// filesystem, and only the ones that are needed for a search are loaded.
+
+var WhatsAppSearch = (function () {
+    var chats = [];  // Every indexed chat, from ../Search/chats.js
+    var terms = {};  // The terms of each chat that have been loaded, by the chat's key
+    var shards = {};  // The shards that have been loaded, by the chat's key and then the shard's name
+    var pending = {};  // The promises waiting for each script to load, by its path
+
+    var maxResults = 500;
+
+    function tokenize(text) {
+        // This must match SearchIndex.token_pattern in library.py
+        return text.toLowerCase().match(/[\p{L}\p{N}_]+/gu) || [];
+    }
+
+    function chatPath(chat) {
+        return '../Search/' + encodeURIComponent(chat) + '/';
+    }
+
+    function loadScript(path) {
+        return new Promise(function (resolve, reject) {
+            if (!pending[path]) {
+                pending[path] = [];
+
+                var script = document.createElement('script');
+                script.src = path;
+                script.charset = 'utf-8';
+                script.onerror = function () {
+                    // Reject everything waiting for the script, and remove it so that the next search tries again
+                    var waiting = pending[path] || [];
+                    delete pending[path];
+                    script.parentNode.removeChild(script);
+
+                    waiting.forEach(function (promise) {
+                        promise.reject(new Error('Failed to load ' + path));
+                    });
+                };
+                document.head.appendChild(script);
+            }
+
+            pending[path].push({resolve: resolve, reject: reject});
+        });
+    }
+
+    function loaded(path) {
+        var waiting = pending[path] || [];
+        delete pending[path];
+
+        waiting.forEach(function (promise) {
+            promise.resolve();
+        });
+    }
+
+    function loadTerms(chat) {
+        if (terms[chat]) {
+            return Promise.resolve(terms[chat]);
+        }
+
+        return loadScript(chatPath(chat) + 'terms.js').then(function () {
+            return terms[chat];
+        });
+    }
+
+    function loadShard(chat, shard) {
+        if (shards[chat] && shards[chat][shard]) {
+            return Promise.resolve(shards[chat][shard]);
+        }
+
+        return loadScript(chatPath(chat) + shard + '.js').then(function () {
+            return shards[chat][shard];
+        });
+    }
+
+    // Return the words in an index that start with a word from the search, so that 'hel' finds 'hello'
+    function matchingTerms(index, token) {
+        return Object.keys(index).filter(function (term) {
+            return term.lastIndexOf(token, 0) === 0;
+        });
+    }
+
+    // Return the shards of a chat that have every word of the search, in order
+    function shardsWithEveryToken(chatTerms, tokens) {
+        var candidates = null;
+
+        tokens.forEach(function (token) {
+            var found = {};
+            matchingTerms(chatTerms, token).forEach(function (term) {
+                chatTerms[term].forEach(function (shard) {
+                    found[shard] = true;
+                });
+            });
+
+            candidates = candidates === null ? found : Object.keys(candidates).reduce(function (both, shard) {
+                if (found[shard]) {
+                    both[shard] = true;
+                }
+                return both;
+            }, {});
+        });
+
+        return Object.keys(candidates || {}).sort();
+    }
+
+    // Return the numbers of the messages in a shard that have every word of the search
+    function messagesWithEveryToken(shard, tokens) {
+        var candidates = null;
+
+        tokens.forEach(function (token) {
+            var found = {};
+            matchingTerms(shard.terms, token).forEach(function (term) {
+                shard.terms[term].forEach(function (number) {
+                    found[number] = true;
+                });
+            });
+
+            candidates = candidates === null ? found : Object.keys(candidates).reduce(function (both, number) {
+                if (found[number]) {
+                    both[number] = true;
+                }
+                return both;
+            }, {});
+        });
+
+        return Object.keys(candidates || {}).map(Number).sort(function (a, b) {
+            return a - b;
+        });
+    }
+
+    function searchChat(chat, tokens) {
+        return loadTerms(chat.key).then(function (chatTerms) {
+            var shardNames = shardsWithEveryToken(chatTerms, tokens);
+
+            return Promise.all(shardNames.map(function (shardName) {
+                return loadShard(chat.key, shardName).then(function (shard) {
+                    return messagesWithEveryToken(shard, tokens).map(function (number) {
+                        return {chat: chat, message: shard.messages[number]};
+                    });
+                });
+            }));
+        }).then(function (resultsByShard) {
+            return [].concat.apply([], resultsByShard);
+        });
+    }
+
+    function showResults(results, seconds) {
+        var container = document.getElementById('search-results');
+        container.innerHTML = '';
+
+        results.slice(0, maxResults).forEach(function (result) {
+            // Each message is [anchor, page file, sender, date, time, text]
+            var message = result.message;
+
+            var link = document.createElement('a');
+            link.className = 'message recipient search-result';
+            link.href = '../' + encodeURIComponent(message[1]) + '#' + message[0];
+
+            var chatName = document.createElement('span');
+            chatName.className = 'recipient-name';
+            chatName.textContent = result.chat.title + (message[2] ? ' - ' + message[2] : '');
+
+            var date = document.createElement('span');
+            date.className = 'message-info date';
+            date.textContent = message[3] + ', ' + message[4];
+
+            var text = document.createElement('p');
+            text.textContent = message[5];
+
+            link.appendChild(chatName);
+            link.appendChild(date);
+            link.appendChild(text);
+            container.appendChild(link);
+        });
+
+        var status = results.length + ' messages found in ' + seconds.toFixed(3) + ' seconds';
+        if (results.length > maxResults) {
+            status += ', showing the first ' + maxResults;
+        }
+        document.getElementById('search-status').textContent = status;
+    }
+
+    function search(query, chatKey) {
+        var tokens = tokenize(query);
+        if (!tokens.length) {
+            return;
+        }
+
+        var start = performance.now();
+        var selectedChats = chats.filter(function (chat) {
+            return !chatKey || chat.key === chatKey;
+        });
+
+        document.getElementById('search-status').textContent = 'Searching...';
+
+        Promise.all(selectedChats.map(function (chat) {
+            return searchChat(chat, tokens);
+        })).then(function (resultsByChat) {
+            showResults([].concat.apply([], resultsByChat), (performance.now() - start) / 1000);
+        }).catch(function (error) {
+            document.getElementById('search-status').textContent = error.message;
+        });
+    }
+
+    document.addEventListener('DOMContentLoaded', function () {
+        var select = document.getElementById('search-chat');
+        chats.forEach(function (chat) {
+            var option = document.createElement('option');
+            option.value = chat.key;
+            option.textContent = chat.title + ' (' + chat.first + ' - ' + chat.last + ')';
+            select.appendChild(option);
+        });
+
+        if (!chats.length) {
+            document.getElementById('search-status').textContent = 'No chats have been formatted with a search index';
+        }
+
+        document.getElementById('search-form').addEventListener('submit', function (event) {
+            event.preventDefault();
+            search(document.getElementById('search-query').value, select.value);
+        });
+    });
+
+    return {
+        chatsLoaded: function (data) {
+            chats = data;
+        },
+
+        termsLoaded: function (chat, data) {
+            terms[chat] = data;
+            loaded(chatPath(chat) + 'terms.js');
+        },
+
+        shardLoaded: function (chat, shard, data) {
+            shards[chat] = shards[chat] || {};
+            shards[chat][shard] = data;
+            loaded(chatPath(chat) + shard + '.js');
+        }
+    };
+})();
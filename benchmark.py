@@ -0,0 +1,525 @@
+#!/usr/bin/env python
+
+# WhatsApp-Formatter is a program that takes exported WhatsApp chats and
+# formats them into more readable HTML files, with embedded attachments.
+#
+# Copyright (C) 2020 Doctor Dalek <https://github.com/DoctorDalek1963>.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""This module generates synthetic exported chats and times how fast the WhatsApp Formatter formats them.
+
+Every benchmark runs in a fresh process, so that the peak memory it reports isn't left over from an earlier one.
+Run it from the command line with --help to see the options, or use the functions directly.
+
+Classes:
+    SyntheticChat:
+        A dataclass describing a synthetic chat to generate.
+
+    BenchmarkResult:
+        A dataclass holding the result of one benchmark.
+
+Functions:
+    generate_chat_lines(spec: SyntheticChat) -> Iterator[str]:
+        Lazily generate the lines of the _chat.txt file of a synthetic chat.
+
+    write_synthetic_zip(path: str, spec: SyntheticChat) -> None:
+        Write a synthetic exported chat to a zip file, with its attachments.
+
+    bench_message_splitting(zip_path: str, mapped: bool = False) -> BenchmarkResult:
+        Time splitting the extracted _chat.txt of a chat into raw messages, from a text file or a memory-mapped file.
+
+    bench_message_parsing(zip_path: str, spec: SyntheticChat) -> BenchmarkResult:
+        Time creating a Message from every message in a chat, and creating its HTML.
+
+    bench_write_text(zip_path: str, spec: SyntheticChat) -> BenchmarkResult:
+        Time writing the HTML file of a chat, without its attachments.
+
+    bench_process_list_of_chats(zip_paths: List[str], spec: SyntheticChat, use_processes: bool = False, max_workers: Optional[int] = None) -> BenchmarkResult:
+        Time formatting several chats completely, from the zip files to the finished output directories.
+
+    run_benchmarks(spec: SyntheticChat, chats: int = 4, use_processes: bool = False, max_workers: Optional[int] = None, work_dir: Optional[str] = None) -> List[BenchmarkResult]:
+        Generate the synthetic chats and run every benchmark on them in a fresh process each.
+
+"""
+
+import argparse
+import concurrent.futures
+import io
+import json
+import mmap
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+import zipfile
+
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterator, List, Optional
+
+try:
+    import resource
+except ImportError:  # The resource module only exists on Unix, so peak memory isn't measured on Windows
+    resource = None
+
+import library
+
+# The directory with the templates and Library, which the formatter reads from the working directory
+repo_directory = os.path.dirname(os.path.abspath(__file__))
+
+# Words and bits of formatting to build the content of synthetic messages from
+words = ('hello', 'there', 'what', 'do', 'you', 'think', 'about', 'this', 'tomorrow', 'maybe', 'okay', 'great', 'lunch',
+         'meeting', 'sounds', 'good', 'sure', 'why', 'not', 'later', 'thanks', 'see', 'you', 'soon', 'really')
+markup = ('_{}_', '*{}*', '~{}~', '```{}```', '<{}>')
+links = ('https://example.com', 'https://www.example.org/some/long/path?query=1&other=two', 'http://example.net/a_b_c')
+
+# The extensions that each kind of attachment is given, and the fake contents of their files
+attachment_extensions = {'PHOTO': '.jpg', 'VIDEO': '.mp4', 'AUDIO': '.mp3', 'STICKER': '.webp', 'GIF': '.mp4'}
+attachment_size = 64 * 1024
+
+
+@dataclass
+class SyntheticChat:
+    """A dataclass describing a synthetic chat to generate.
+
+    Attributes:
+        messages:
+            The number of messages in the chat.
+
+        group_chat:
+            Whether the chat is a group chat, with group meta messages like people being added.
+
+        participants:
+            The number of people sending messages, including the sender.
+
+        twelve_hour:
+            Whether the timestamps use 12 hour time with am and pm, like '9:47:19 pm', or 24 hour time, like '21:47:19'.
+
+        markup_density:
+            The chance that each word is given WhatsApp formatting like _italics_ or has a character that needs escaping.
+
+        link_density:
+            The chance that each message has a link in it.
+
+        multiline_density:
+            The chance that each message has more than one line.
+
+        attachment_ratio:
+            The chance that each message is an attachment.
+
+        attachment_mix:
+            The relative weights of each kind of attachment, from the keys of attachment_extensions.
+
+        convert_audio:
+            Whether audio attachments are .opus voice messages that have to be converted to mp3, instead of .mp3 files.
+            Converting needs pydub and ffmpeg, and makes the benchmark measure them as well as the formatter.
+
+        seed:
+            The seed for the random numbers, so that the same spec always generates the same chat.
+
+    """
+
+    messages: int = 10000
+    group_chat: bool = True
+    participants: int = 4
+    twelve_hour: bool = True
+    markup_density: float = 0.05
+    link_density: float = 0.05
+    multiline_density: float = 0.05
+    attachment_ratio: float = 0.05
+    attachment_mix: Dict[str, float] = field(default_factory=lambda: {'PHOTO': 6, 'AUDIO': 2, 'VIDEO': 1, 'STICKER': 1})
+    convert_audio: bool = False
+    seed: int = 0
+
+    @property
+    def names(self) -> List[str]:
+        """The names of the participants. The first one is the sender."""
+        return ['Sender'] + [f'Person {i}' for i in range(1, self.participants)]
+
+
+@dataclass
+class BenchmarkResult:
+    """A dataclass holding the result of one benchmark.
+
+    Attributes:
+        name:
+            The name of the benchmark.
+
+        messages:
+            The number of messages that were formatted.
+
+        seconds:
+            The time taken, in seconds.
+
+        messages_per_second:
+            The number of messages formatted every second.
+
+        peak_rss_mib:
+            The peak memory used by the process that ran the benchmark, in MiB, including worker processes if any were
+            used. It's None if it can't be measured on this platform.
+
+    """
+
+    name: str
+    messages: int
+    seconds: float
+    messages_per_second: float = 0.0
+    peak_rss_mib: Optional[float] = None
+
+    def __post_init__(self):
+        if self.seconds > 0:
+            self.messages_per_second = self.messages / self.seconds
+
+
+def _random_content(rng: random.Random, spec: SyntheticChat) -> str:
+    """Return the content of a random text message."""
+    lines = []
+
+    for _ in range(1 + (rng.random() < spec.multiline_density) * rng.randint(1, 4)):
+        line = []
+
+        for _ in range(rng.randint(1, 15)):
+            word = rng.choice(words)
+            if rng.random() < spec.markup_density:
+                word = rng.choice(markup).format(word)
+
+            line.append(word)
+
+        if rng.random() < spec.link_density:
+            line.insert(rng.randint(0, len(line)), rng.choice(links))
+
+        lines.append(' '.join(line))
+
+    return '\n'.join(lines)
+
+
+def _format_timestamp(timestamp: datetime, twelve_hour: bool) -> str:
+    """Return the prefix of a message sent at timestamp, like '[02/11/2020, 9:47:19 pm]'."""
+    if twelve_hour:
+        time_string = f'{timestamp.hour % 12 or 12}:{timestamp:%M:%S} {"am" if timestamp.hour < 12 else "pm"}'
+    else:
+        time_string = f'{timestamp:%H:%M:%S}'
+
+    return f'[{timestamp:%d/%m/%Y}, {time_string}]'
+
+
+def _attachment_filename(number: int, file_type: str, timestamp: datetime, spec: SyntheticChat) -> str:
+    """Return the name of an attachment file, like the ones in exported chats."""
+    extension = '.opus' if file_type == 'AUDIO' and spec.convert_audio else attachment_extensions[file_type]
+    return f'{number:08d}-{file_type}-{timestamp:%Y-%m-%d-%H-%M-%S}{extension}'
+
+
+def generate_chat_lines(spec: SyntheticChat) -> Iterator[str]:
+    """Lazily generate the lines of the _chat.txt file of a synthetic chat, with the line breaks that iOS uses.
+
+    Arguments:
+        spec: SyntheticChat:
+            The description of the chat to generate.
+
+    Yields:
+        Every line of the file, including the notice that messages are encrypted, which isn't counted in spec.messages.
+        Attachment messages start with the left-to-right mark that iOS adds to them.
+
+    """
+    rng = random.Random(spec.seed)
+    names = spec.names
+    file_types = list(spec.attachment_mix)
+    weights = list(spec.attachment_mix.values())
+
+    timestamp = datetime(2020, 1, 1, 9, 0, 0)
+    attachment_number = 0
+
+    yield f'{_format_timestamp(timestamp, spec.twelve_hour)} {names[1]}: Messages and calls are end-to-end encrypted. ' \
+          f'No one outside of this chat, not even WhatsApp, can read or listen to them.\r\n'
+
+    for _ in range(spec.messages):
+        timestamp += timedelta(seconds=rng.choice((0, 1, 5, 30, 120, 3600, 40000)))
+        prefix = _format_timestamp(timestamp, spec.twelve_hour)
+        name = rng.choice(names)
+
+        if spec.group_chat and rng.random() < 0.01:
+            yield f'\u200e{prefix} Group: \u200e{name} added {rng.choice(names)}\r\n'
+
+        elif rng.random() < spec.attachment_ratio:
+            attachment_number += 1
+            file_type = rng.choices(file_types, weights)[0]
+            yield f'\u200e{prefix} {name}: \u200e<attached: ' \
+                  f'{_attachment_filename(attachment_number, file_type, timestamp, spec)}>\r\n'
+
+        else:
+            content = _random_content(rng, spec).replace('\n', '\r\n')
+            yield f'{prefix} {name}: {content}\r\n'
+
+
+def write_synthetic_zip(path: str, spec: SyntheticChat) -> None:
+    """Write a synthetic exported chat to a zip file, with a file for every attachment it mentions.
+
+    The attachments have random contents, except for .opus files, which are real silence so that they can be converted.
+
+    Arguments:
+        path: str:
+            The path of the zip file to write.
+
+        spec: SyntheticChat:
+            The description of the chat to generate.
+
+    """
+    rng = random.Random(spec.seed)
+    attachment_names = []
+
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        with zip_file.open('_chat.txt', 'w') as chat_file:
+            for line in generate_chat_lines(spec):
+                chat_file.write(line.encode('utf-8'))
+
+                if line.startswith('\u200e') and '<attached: ' in line:
+                    attachment_names.append(line[line.index('<attached: ') + 11:line.rindex('>')])
+
+        silence = None
+        for filename in attachment_names:
+            if filename.endswith('.opus'):
+                if silence is None:
+                    buffer = io.BytesIO()
+                    library.AudioSegment.silent(duration=1000).export(buffer, format='opus')
+                    silence = buffer.getvalue()
+
+                zip_file.writestr(filename, silence)
+            else:
+                # Media files are already compressed, so they're stored as they are
+                contents = rng.getrandbits(attachment_size * 8).to_bytes(attachment_size, 'little')
+                zip_file.writestr(filename, contents, compress_type=zipfile.ZIP_STORED)
+
+
+def _peak_rss_mib() -> Optional[float]:
+    """Return the peak memory used by this process and its finished children, in MiB, or None if it can't be measured."""
+    if resource is None:
+        return None
+
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+    # ru_maxrss is in bytes on macOS but in KiB everywhere else
+    return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def _read_raw_messages(zip_path: str) -> List[str]:
+    """Return every raw message in the _chat.txt of a zip file, as Chat would give them to Message.
+
+    Line endings are converted to newlines like they are when Chat reads the file, and the notice that messages are
+    encrypted is skipped.
+    """
+    with zipfile.ZipFile(zip_path) as zip_file:
+        chat_text = zip_file.read('_chat.txt').decode('utf-8')
+
+    return [raw_message for raw_message in library.split_chat_messages(io.StringIO(chat_text, newline=None))
+            if not re.match(library.Message.encrypted_messages_notice_pattern, raw_message)]
+
+
+def bench_message_splitting(zip_path: str, mapped: bool = False) -> BenchmarkResult:
+    """Time splitting the extracted _chat.txt of a chat into raw messages, from a text file or a memory-mapped file.
+
+    Keyword arguments:
+        mapped:
+            A boolean which is false if not specified. If true, the file is memory-mapped and split with
+            split_chat_buffer(), and if false, it's read as a text file and split with split_chat_messages().
+
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        with zipfile.ZipFile(zip_path) as zip_file:
+            chat_path = zip_file.extract('_chat.txt', temp_dir)
+
+        start_time = time.perf_counter()
+
+        if mapped:
+            with open(chat_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                messages = sum(1 for _ in library.split_chat_buffer(buffer))
+        else:
+            with open(chat_path, 'r', encoding='utf-8') as chat_file:
+                messages = sum(1 for _ in library.split_chat_messages(chat_file))
+
+        seconds = time.perf_counter() - start_time
+
+    name = 'split_chat_buffer (mmap)' if mapped else 'split_chat_messages'
+    return BenchmarkResult(name, messages, seconds, peak_rss_mib=_peak_rss_mib())
+
+
+def bench_message_parsing(zip_path: str, spec: SyntheticChat) -> BenchmarkResult:
+    """Time creating a Message from every message in a chat, and creating its HTML.
+
+    The messages are split and read into memory first, so only Message is timed.
+    """
+    raw_messages = _read_raw_messages(zip_path)
+
+    start_time = time.perf_counter()
+    for raw_message in raw_messages:
+        library.Message(raw_message, spec.group_chat, 'Benchmark').create_html(spec.names[0])
+    seconds = time.perf_counter() - start_time
+
+    return BenchmarkResult('Message parsing', len(raw_messages), seconds, peak_rss_mib=_peak_rss_mib())
+
+
+def bench_write_text(zip_path: str, spec: SyntheticChat) -> BenchmarkResult:
+    """Time writing the HTML file of a chat straight from its zip file, without its attachments."""
+    with tempfile.TemporaryDirectory() as output_dir:
+        chat = library.Chat(zip_path, spec.group_chat, spec.names[0], 'Benchmark', 'Benchmark', output_dir)
+
+        start_time = time.perf_counter()
+        chat._write_text()
+        seconds = time.perf_counter() - start_time
+
+        return BenchmarkResult('Chat._write_text', chat._result.messages, seconds, peak_rss_mib=_peak_rss_mib())
+
+
+def bench_process_list_of_chats(zip_paths: List[str], spec: SyntheticChat, use_processes: bool = False,
+                                max_workers: Optional[int] = None) -> BenchmarkResult:
+    """Time formatting several chats completely, from the zip files to the finished output directories.
+
+    Keyword arguments:
+        use_processes:
+            A boolean which is false if not specified. It's passed on to process_list_of_chats().
+
+        max_workers:
+            The number of chats to format at once. It's passed on to process_list_of_chats().
+
+    Raises:
+        RuntimeError:
+            If any of the chats were rejected, because then the time isn't comparable.
+
+    """
+    with tempfile.TemporaryDirectory() as output_dir:
+        list_of_chats = [(zip_path, spec.group_chat, spec.names[0], f'Benchmark {i}', f'Benchmark {i}', output_dir)
+                         for i, zip_path in enumerate(zip_paths)]
+        outcomes = {}
+
+        start_time = time.perf_counter()
+        rejected_chats = library.process_list_of_chats(list_of_chats, use_processes=use_processes,
+                                                       max_workers=max_workers, outcomes=outcomes)
+        seconds = time.perf_counter() - start_time
+
+        if rejected_chats:
+            raise RuntimeError(f'{len(rejected_chats)} chats were rejected')
+
+        messages = sum(result.messages for result in outcomes.values())
+        name = f'process_list_of_chats ({len(zip_paths)} chats, {"processes" if use_processes else "threads"})'
+
+        return BenchmarkResult(name, messages, seconds, peak_rss_mib=_peak_rss_mib())
+
+
+def _run_in_fresh_process(function: Callable[..., BenchmarkResult], *args, **kwargs) -> BenchmarkResult:
+    """Run a benchmark function in a new process, so that its peak memory is its own."""
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+        return executor.submit(function, *args, **kwargs).result()
+
+
+def run_benchmarks(spec: SyntheticChat, chats: int = 4, use_processes: bool = False, max_workers: Optional[int] = None,
+                   work_dir: Optional[str] = None) -> List[BenchmarkResult]:
+    """Generate the synthetic chats and run every benchmark on them in a fresh process each.
+
+    The formatter reads its templates and Library from the working directory, so this must be run from the root of
+    the repository.
+
+    Arguments:
+        spec: SyntheticChat:
+            The description of the chats to generate. Every chat uses it with a different seed.
+
+    Keyword arguments:
+        chats:
+            The number of chats to format with process_list_of_chats(). 4 if not specified.
+
+        use_processes:
+            A boolean which is false if not specified. It's passed on to process_list_of_chats().
+
+        max_workers:
+            The number of chats to format at once. It's passed on to process_list_of_chats().
+
+        work_dir:
+            The directory to write the synthetic zip files to, which is kept afterwards. If not specified, they're
+            written to a temporary directory which is removed afterwards.
+
+    Returns:
+        results:
+            A list of a BenchmarkResult for every benchmark.
+
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        work_dir = work_dir or temp_dir
+        os.makedirs(work_dir, exist_ok=True)
+
+        zip_paths = []
+        for i in range(max(chats, 1)):
+            zip_paths.append(os.path.join(work_dir, f'synthetic_{i}.zip'))
+            write_synthetic_zip(zip_paths[-1], SyntheticChat(**{**asdict(spec), 'seed': spec.seed + i}))
+
+        return [
+            _run_in_fresh_process(bench_message_splitting, zip_paths[0]),
+            _run_in_fresh_process(bench_message_splitting, zip_paths[0], mapped=True),
+            _run_in_fresh_process(bench_message_parsing, zip_paths[0], spec),
+            _run_in_fresh_process(bench_write_text, zip_paths[0], spec),
+            _run_in_fresh_process(bench_process_list_of_chats, zip_paths[:chats], spec,
+                                  use_processes=use_processes, max_workers=max_workers)
+        ]
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """Run the benchmarks with options from the command line and print the results as a table or as JSON."""
+    defaults = SyntheticChat()
+
+    parser = argparse.ArgumentParser(description='Time the WhatsApp Formatter on synthetic chats.')
+    parser.add_argument('--messages', type=int, default=defaults.messages, help='the number of messages in each chat')
+    parser.add_argument('--chats', type=int, default=4, help='the number of chats for process_list_of_chats')
+    parser.add_argument('--one-to-one', action='store_true', help='generate one-to-one chats instead of group chats')
+    parser.add_argument('--participants', type=int, default=defaults.participants, help='the number of people in each chat')
+    parser.add_argument('--24h', dest='twelve_hour', action='store_false', help='use 24 hour timestamps')
+    parser.add_argument('--markup-density', type=float, default=defaults.markup_density)
+    parser.add_argument('--link-density', type=float, default=defaults.link_density)
+    parser.add_argument('--multiline-density', type=float, default=defaults.multiline_density)
+    parser.add_argument('--attachment-ratio', type=float, default=defaults.attachment_ratio)
+    parser.add_argument('--attachment-mix', type=json.loads, default=defaults.attachment_mix,
+                        help='a JSON object of the weights of each kind of attachment, like \'{"PHOTO": 3, "VIDEO": 1}\'')
+    parser.add_argument('--convert-audio', action='store_true', help='use .opus voice messages, which need ffmpeg')
+    parser.add_argument('--seed', type=int, default=defaults.seed)
+    parser.add_argument('--executor', choices=('thread', 'process'), default='thread')
+    parser.add_argument('--workers', type=int, default=None, help='the number of chats to format at once')
+    parser.add_argument('--work-dir', help='keep the synthetic zip files in this directory')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args(argv)
+
+    spec = SyntheticChat(messages=args.messages, group_chat=not args.one_to_one, participants=args.participants,
+                         twelve_hour=args.twelve_hour, markup_density=args.markup_density, link_density=args.link_density,
+                         multiline_density=args.multiline_density, attachment_ratio=args.attachment_ratio,
+                         attachment_mix=args.attachment_mix, convert_audio=args.convert_audio, seed=args.seed)
+
+    # This is relative to where the benchmark was run from, so it's resolved before changing directory
+    work_dir = args.work_dir and os.path.abspath(args.work_dir)
+
+    # The formatter reads its templates and Library relative to the working directory
+    os.chdir(repo_directory)
+
+    results = run_benchmarks(spec, chats=args.chats, use_processes=args.executor == 'process', max_workers=args.workers,
+                             work_dir=work_dir)
+
+    if args.json:
+        print(json.dumps({'spec': asdict(spec), 'results': [asdict(result) for result in results]}, indent=4))
+        return
+
+    print(f'{"Benchmark":<50} {"Messages":>10} {"Seconds":>10} {"Messages/s":>12} {"Peak RSS":>12}')
+    for result in results:
+        peak = f'{result.peak_rss_mib:.1f} MiB' if result.peak_rss_mib is not None else 'unknown'
+        print(f'{result.name:<50} {result.messages:>10} {result.seconds:>10.3f} {result.messages_per_second:>12.0f} {peak:>12}')
+
+
+if __name__ == '__main__':
+    main()
@@ -18,19 +18,50 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-"""This module simply contains a function to run the CLI version of the WhatsApp Formatter.
+"""This module contains the functions to run the CLI version of the WhatsApp Formatter, interactively or in batches.
+
+Run with no arguments to be asked about each chat, or with a manifest or a directory of zips to format them all
+without any prompts, or with --watch to keep formatting the zips dropped into a directory. Run with --help to see all
+the options of batch mode.
 
 Functions:
     run_cli:
         Run the command line version of the WhatsApp Formatter.
 
+    run_batch(argv: Optional[List[str]] = None) -> int:
+        Format all the chats given on the command line without any prompts, and return the exit code.
+
+    run_watch(args: argparse.Namespace) -> int:
+        Run a WatchDaemon with the options from the command line until Ctrl+C, and return the exit code.
+
+    main(argv: Optional[List[str]] = None) -> int:
+        Run batch mode if there are any arguments, else run the interactive CLI.
+
 """
 
+import argparse
+import contextlib
+import csv
+import glob
+import json
+import multiprocessing
 import os
 import re
-import shutil
+import signal
+import sys
+import threading
+import time
+
+from typing import Dict, List, Optional, Tuple
+
+from daemon import WatchDaemon
+from library import BadFormatError, ProgressEvent, process_list_of_chats
+
+# The columns of a manifest, which are the positional arguments of process_chat()
+manifest_fields = ('input_file', 'group_chat', 'sender_name', 'chat_title', 'html_file_name', 'output_dir')
 
-from library import process_list_of_chats
+# Batch mode uses the templates and Library next to this file, so it can be run from any directory
+repo_directory = os.path.dirname(os.path.abspath(__file__))
 
 
 def run_cli() -> None:
@@ -82,9 +113,351 @@ def run_cli() -> None:
     print()
     print('Processing all...')
     process_list_of_chats(all_chats)
-    shutil.rmtree('temp')
     print('Processing complete!')
 
 
-if __name__ == "__main__":
+def _parse_bool(value) -> bool:
+    """Parse a group_chat value from a manifest, which is a bool in JSON but a string in CSV.
+
+    Raises:
+        BadFormatError:
+            If the value isn't true, false, yes, no, y, n, 1 or 0, in any case.
+
+    """
+    if isinstance(value, bool):
+        return value
+
+    text = str(value).strip().lower()
+
+    if text in ('true', 'yes', 'y', '1'):
+        return True
+
+    if text in ('false', 'no', 'n', '0'):
+        return False
+
+    raise BadFormatError(f'{value!r} is not true or false')
+
+
+def _read_manifest(manifest_file: str) -> List[Tuple[str, bool, str, str, str, str]]:
+    """Read a JSON or CSV manifest of chats and return a list of argument tuples for process_chat().
+
+    A JSON manifest is a list of objects, and a CSV manifest has a header row. Either way, each chat needs all of
+    manifest_fields. Relative input files and output directories are relative to the manifest.
+
+    Raises:
+        BadFormatError:
+            If the manifest isn't a list of chats, or a chat in it is missing a field or has an invalid one.
+
+    """
+    with open(manifest_file, encoding='utf-8', newline='') as f:
+        if manifest_file.lower().endswith('.csv'):
+            rows = list(csv.DictReader(f))
+        else:
+            rows = json.load(f)
+
+    if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+        raise BadFormatError(f'{manifest_file} is not a list of chats')
+
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_file))
+    chats = []
+
+    for i, row in enumerate(rows):
+        missing = [name for name in manifest_fields if row.get(name) in (None, '')]
+        if missing:
+            raise BadFormatError(f'Chat {i} in {manifest_file} is missing {", ".join(missing)}')
+
+        not_strings = [name for name in manifest_fields if name != 'group_chat' and not isinstance(row[name], str)]
+        if not_strings:
+            raise BadFormatError(f'Chat {i} in {manifest_file} has non-string values for {", ".join(not_strings)}')
+
+        try:
+            group_chat = _parse_bool(row['group_chat'])
+        except BadFormatError as e:
+            raise BadFormatError(f'Chat {i} in {manifest_file} has an invalid group_chat: {e}') from None
+
+        chats.append((os.path.join(manifest_dir, row['input_file']), group_chat, row['sender_name'],
+                      row['chat_title'], row['html_file_name'], os.path.join(manifest_dir, row['output_dir'])))
+
+    return chats
+
+
+def _glob_chats(pattern: str, group_chat: bool, sender_name: str, output_dir: str) -> List[Tuple[str, bool, str, str, str, str]]:
+    """Return a list of argument tuples for process_chat() for every zip matching a glob pattern or in a directory.
+
+    The title and the HTML file name of each chat are the name of its zip, without the extension.
+    """
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, '*.zip')
+
+    chats = []
+    for input_file in sorted(glob.glob(pattern)):
+        name = os.path.splitext(os.path.basename(input_file))[0]
+        chats.append((input_file, group_chat, sender_name, name, name, output_dir))
+
+    return chats
+
+
+def _build_parser() -> argparse.ArgumentParser:
+    """Return the ArgumentParser for batch mode."""
+    parser = argparse.ArgumentParser(description='Format exported WhatsApp chats into HTML files without any prompts.')
+
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--manifest', help='a JSON or CSV file listing the chats, with the columns ' + ', '.join(manifest_fields))
+    source.add_argument('--glob', help='a directory or a glob pattern of exported zip files to format')
+    source.add_argument('--watch', metavar='DIR',
+                        help='keep watching a directory and format every zip file dropped into it, until Ctrl+C')
+
+    chats = parser.add_argument_group('chats from --glob or --watch')
+    chats.add_argument('--sender-name',
+                       help='the name of the sender (your WhatsApp alias), required with --glob and --watch')
+    chats.add_argument('--group-chat', action='store_true', help='the chats are group chats')
+
+    output = parser.add_argument_group('output')
+    output.add_argument('--output-dir',
+                        help='put every chat in this directory, overriding the manifest (required with --glob and --watch)')
+    output.add_argument('--layout', choices=('flat', 'per-chat'), default='flat',
+                        help='put every chat straight in its output directory, or in a sub-directory named after its '
+                             'HTML file (default: %(default)s)')
+    output.add_argument('--page-size', type=int, default=0, help='split each chat into pages of this many messages')
+    output.add_argument('--page-by-month', action='store_true', help='start a new page every month')
+    output.add_argument('--incremental', action='store_true', help='only format messages which are new since the last run')
+    output.add_argument('--dedupe-attachments', action='store_true', help='store identical attachments only once')
+    output.add_argument('--thumbnails', action='store_true', help='make thumbnails of photos and posters of videos')
+    output.add_argument('--search-index', action='store_true',
+                        help='index the messages for Library/search.html in the output directory')
+    output.add_argument('--sqlite', metavar='FILE',
+                        help='write the messages of every chat to this SQLite database as well as to HTML')
+
+    workers = parser.add_argument_group('workers')
+    workers.add_argument('--workers', type=int, default=None, help='the number of chats to format at once')
+    workers.add_argument('--executor', choices=('thread', 'process'), default='thread',
+                         help='format chats in a pool of threads or of processes (default: %(default)s)')
+    workers.add_argument('--render-workers', type=int, default=0,
+                         help='the number of processes to render the messages of each chat with')
+    workers.add_argument('--audio-workers', type=int, default=None, help='the number of processes to convert audio with')
+    workers.add_argument('--audio-cache-dir', help='a directory to cache converted audio in')
+    workers.add_argument('--parse-cache-dir', help='a directory to cache parsed messages in, so chats are only parsed once')
+    workers.add_argument('--extract-to-temp', action='store_true',
+                         help='extract each zip to a temporary directory instead of reading it in place')
+
+    parser.add_argument('--report', help='write the JSON report to this file instead of stdout')
+    parser.add_argument('--profile', metavar='DIR', help='save a cProfile dump of each chat in this directory')
+    parser.add_argument('--progress', action='store_true', help='print the progress of each chat to stderr')
+
+    watch = parser.add_argument_group('--watch')
+    watch.add_argument('--status-dir', help='write a JSON status file for each zip file to this directory '
+                                            '(default: .formatter_jobs in the output directory)')
+    watch.add_argument('--poll-interval', type=float, default=2.0,
+                       help='the seconds between scans of the directory when inotify_simple isn\'t installed '
+                            '(default: %(default)s)')
+
+    return parser
+
+
+def _chat_kwargs(args: argparse.Namespace) -> dict:
+    """Return the keyword arguments for process_chat() from the options on the command line."""
+    return {'extract_to_temp': args.extract_to_temp, 'render_workers': args.render_workers, 'page_size': args.page_size,
+            'page_by_month': args.page_by_month, 'incremental': args.incremental,
+            'dedupe_attachments': args.dedupe_attachments, 'thumbnails': args.thumbnails,
+            'search_index': args.search_index, 'parse_cache_dir': args.parse_cache_dir, 'sqlite_file': args.sqlite,
+            'profile_dir': args.profile, 'template_dir': repo_directory,
+            'library_dir': os.path.join(repo_directory, 'Library')}
+
+
+class _ProgressPrinter:
+    """A progress callback that prints a line to stderr about the progress of each chat, at most once a second per chat."""
+
+    def __init__(self, interval: float = 1.0):
+        self._interval = interval
+        self._last_printed: Dict[str, float] = {}
+
+    def __call__(self, event: ProgressEvent) -> None:
+        """Print the event if it's the start or end of a chat, or if nothing has been printed about the chat recently."""
+        now = time.monotonic()
+
+        if event.stage in ('messages', 'attachments', 'audio') and \
+                now - self._last_printed.get(event.html_file_name, 0.0) < self._interval:
+            return
+
+        self._last_printed[event.html_file_name] = now
+        _print_progress(event)
+
+
+def _print_progress(event: ProgressEvent) -> None:
+    """Print a line to stderr about the progress of a chat."""
+    eta = event.eta()
+    eta_text = f', about {eta:.0f}s left' if eta is not None and event.stage not in ('finished', 'failed', 'cancelled') else ''
+    percent = f' ({100 * event.bytes_read / event.total_bytes:.0f}%)' if event.total_bytes else ''
+
+    print(f'{event.html_file_name}: {event.stage}, {event.messages} messages, {event.attachments} attachments'
+          f'{percent}{eta_text}', file=sys.stderr)
+
+
+def run_batch(argv: Optional[List[str]] = None) -> int:
+    """Format all the chats given on the command line without any prompts, and return the exit code.
+
+    A JSON report of every chat is written to stdout, or the file given with --report. Pressing Ctrl+C cancels the
+    chats that haven't finished, which are rejected in the report, and their temporary directories are cleaned up.
+
+    Arguments:
+        argv: Optional[List[str]]:
+            The command line arguments. sys.argv[1:] is used if not specified.
+
+    Returns:
+        exit_code:
+            0 if every chat was processed, 1 if any chats were rejected, or 2 if there were no chats to process.
+
+    """
+    parser = _build_parser()
+    args = parser.parse_args(argv)
+
+    if args.watch:
+        if not args.sender_name or not args.output_dir:
+            parser.error('--watch needs --sender-name and --output-dir')
+
+        if not os.path.isdir(args.watch):
+            parser.error(f'{args.watch} is not a directory')
+
+        return run_watch(args)
+
+    if args.manifest:
+        try:
+            all_chats = _read_manifest(args.manifest)
+        except (OSError, ValueError, BadFormatError) as e:
+            parser.error(f'could not read the manifest: {e}')
+    else:
+        if not args.sender_name or not args.output_dir:
+            parser.error('--glob needs --sender-name and --output-dir')
+
+        all_chats = _glob_chats(args.glob, args.group_chat, args.sender_name, args.output_dir)
+
+    if not all_chats:
+        print('ERROR: No chats to process', file=sys.stderr)
+        return 2
+
+    if args.output_dir:
+        all_chats = [chat[:5] + (args.output_dir,) for chat in all_chats]
+
+    if args.layout == 'per-chat':
+        all_chats = [chat[:5] + (os.path.join(chat[5], chat[4]),) for chat in all_chats]
+
+    for chat in all_chats:
+        os.makedirs(chat[5], exist_ok=True)
+
+    if args.profile:
+        os.makedirs(args.profile, exist_ok=True)
+
+    outcomes = {}
+
+    # Chats in other processes need an Event that can be shared between processes
+    manager = multiprocessing.Manager() if args.executor == 'process' else None
+    cancel_event = manager.Event() if manager is not None else threading.Event()
+
+    def cancel(signum, frame):
+        print('Cancelling... (the chats stop at the next message or attachment)', file=sys.stderr)
+        cancel_event.set()
+
+    previous_handler = signal.signal(signal.SIGINT, cancel)
+
+    # The report may be on stdout, so everything the chats print goes to stderr
+    with contextlib.redirect_stdout(sys.stderr):
+        rejected_chats = process_list_of_chats(all_chats, use_processes=args.executor == 'process', max_workers=args.workers,
+                                               audio_workers=args.audio_workers, audio_cache_dir=args.audio_cache_dir,
+                                               outcomes=outcomes, cancel_event=cancel_event,
+                                               progress=_ProgressPrinter() if args.progress else None, **_chat_kwargs(args))
+
+    signal.signal(signal.SIGINT, previous_handler)
+    if manager is not None:
+        manager.shutdown()
+
+    # The totals add up the counts and timings of every processed chat, to see where the time goes in the whole batch
+    totals = {'messages': 0, 'attachments': 0, 'converted_audio_files': 0, 'bytes_read': 0, 'bytes_written': 0, 'timings': {}}
+    report = {'processed': [], 'rejected': [], 'totals': totals}
+
+    for chat in all_chats:
+        entry = dict(zip(manifest_fields, chat))
+        outcome = outcomes.get(chat)
+
+        if chat in rejected_chats:
+            entry['error'] = repr(outcome)
+            report['rejected'].append(entry)
+        else:
+            entry.update(outcome.to_dict())
+            report['processed'].append(entry)
+
+            for key in totals:
+                if key != 'timings':
+                    totals[key] += entry[key]
+
+            for key, seconds in outcome.timings.items():
+                totals['timings'][key] = totals['timings'].get(key, 0.0) + seconds
+
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
+
+    return 1 if rejected_chats else 0
+
+
+def run_watch(args: argparse.Namespace) -> int:
+    """Run a WatchDaemon with the options from the command line until Ctrl+C, and return the exit code.
+
+    Ctrl+C or SIGTERM stops the daemon. The chats being formatted stop at their next message or attachment, and they're
+    formatted again the next time the daemon is run.
+
+    Arguments:
+        args: argparse.Namespace:
+            The parsed command line arguments, with args.watch, args.sender_name and args.output_dir.
+
+    Returns:
+        exit_code:
+            Always 0, once the daemon has stopped.
+
+    """
+    if args.profile:
+        os.makedirs(args.profile, exist_ok=True)
+
+    watch_daemon = WatchDaemon(args.watch, args.output_dir, args.sender_name, group_chat=args.group_chat,
+                               per_chat_dirs=args.layout == 'per-chat', status_dir=args.status_dir,
+                               use_processes=args.executor == 'process', max_workers=args.workers,
+                               audio_workers=args.audio_workers, audio_cache_dir=args.audio_cache_dir,
+                               poll_interval=args.poll_interval, progress=_ProgressPrinter() if args.progress else None,
+                               **_chat_kwargs(args))
+
+    stop_event = threading.Event()
+    main_pid = os.getpid()
+
+    # The worker processes inherit this handler, but only the main process stops the daemon
+    def stop(signum, frame):
+        if os.getpid() == main_pid and not stop_event.is_set():
+            print('Stopping... (the chats stop at the next message or attachment)', file=sys.stderr)
+            stop_event.set()
+
+    previous_handlers = {signum: signal.signal(signum, stop) for signum in (signal.SIGINT, signal.SIGTERM)}
+
+    # Everything the chats print goes to stderr, like in batch mode
+    with contextlib.redirect_stdout(sys.stderr):
+        watch_daemon.run(stop_event)
+
+    for signum, handler in previous_handlers.items():
+        signal.signal(signum, handler)
+
+    return 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Run batch mode if there are any arguments, else run the interactive CLI, and return the exit code."""
+    if argv is None:
+        argv = sys.argv[1:]
+
+    if argv:
+        return run_batch(argv)
+
     run_cli()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,576 @@
+# WhatsApp-Formatter is a program that takes exported WhatsApp chats and
+# formats them into more readable HTML files, with embedded attachments.
+#
+# Copyright (C) 2020 Doctor Dalek <https://github.com/DoctorDalek1963>.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""This module has the classes to watch a folder and format exported chats as soon as they're dropped into it.
+
+Zip files in the inbox are queued once they've been completely written, and formatted in a pool of workers which
+lasts as long as the daemon, so the processes, the templates, the Library folder and the audio transcoder are only
+set up once. Every job has a JSON status file, which is updated as the chat is queued, formatted, and finished.
+Run it with cli.py --watch.
+
+The inbox is watched with inotify if inotify_simple is installed, which only works on Linux, and polled otherwise.
+
+Classes:
+    JobStatus:
+        A dataclass holding the status of formatting one zip file from the inbox, which is saved as its status file.
+
+    FolderWatcher:
+        The class that finds zip files in a directory once they've been completely written.
+
+    WatchDaemon:
+        The class that watches an inbox and formats every new zip file in it with a persistent pool of workers.
+
+"""
+
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:  # inotify_simple is only needed to watch the inbox without polling it, and only works on Linux
+    INotify = flags = None
+
+from library import AudioTranscoder, FormatCancelled, ProgressEvent, forward_progress_events, ignore_interrupts
+from library import process_chat
+
+# The directory with the templates and Library, which the daemon uses wherever it's run from
+repo_directory = os.path.dirname(os.path.abspath(__file__))
+
+
+@dataclass
+class JobStatus:
+    """A dataclass holding the status of formatting one zip file from the inbox, which is saved as its status file.
+
+    Attributes:
+        input_file:
+            The zip file in the inbox.
+
+        html_file_name:
+            The name of the HTML file of the chat, which is the name of the zip file without the extension.
+
+        html_file:
+            The HTML file that the chat was written to, once it's finished, or an empty string. It's replaced when
+            the zip file changes and is formatted again.
+
+        output_dir:
+            The directory the chat is formatted into.
+
+        size:
+            The size of the zip file when it was queued.
+
+        mtime_ns:
+            The modification time of the zip file when it was queued, in nanoseconds. If the size or the modification
+            time change, the zip file is formatted again.
+
+        state:
+            'queued', 'running', 'finished', 'failed', or 'cancelled'. Cancelled jobs are queued again when the daemon
+            is restarted, but failed jobs aren't, unless the zip file changes.
+
+        queued_at, started_at, finished_at:
+            The local times that the job was queued, started, and finished, in ISO format, or empty strings.
+
+        messages, attachments:
+            How many messages and attachments have been formatted so far.
+
+        result:
+            The FormatResult of the chat as a dictionary once it's finished, or None.
+
+        error:
+            The error that stopped the chat if it failed or was cancelled, or an empty string.
+
+    """
+
+    input_file: str
+    html_file_name: str
+    output_dir: str
+    size: int
+    mtime_ns: int
+    html_file: str = ''
+    state: str = 'queued'
+    queued_at: str = ''
+    started_at: str = ''
+    finished_at: str = ''
+    messages: int = 0
+    attachments: int = 0
+    result: Optional[dict] = None
+    error: str = ''
+
+
+class FolderWatcher:
+    """The class that finds zip files in a directory once they've been completely written.
+
+    With inotify, a zip file is found when the program writing it closes it or when it's moved into the directory.
+    Without inotify, the directory is scanned every poll_interval seconds, and a zip file is found once its size and
+    modification time are the same in two scans in a row. Either way, it's only found if it's a valid zip file,
+    so a zip file which is still being copied is found when it's finished instead.
+
+    Methods:
+        scan() -> List[str]:
+            Return every complete zip file in the directory which hasn't been returned before, or has changed since.
+
+        wait(timeout: float) -> List[str]:
+            Wait up to timeout seconds for new zip files and return them.
+
+        close():
+            Stop watching the directory.
+
+    """
+
+    def __init__(self, directory: str, poll_interval: float = 2.0, use_inotify: Optional[bool] = None):
+        """Create a FolderWatcher for a directory.
+
+        Arguments:
+            directory: str:
+                The directory to watch. Only the zip files directly inside it are found.
+
+        Keyword arguments:
+            poll_interval:
+                The number of seconds between scans of the directory when it isn't watched with inotify. 2 if not specified.
+
+            use_inotify:
+                Whether to use inotify. If not specified, it's used if inotify_simple is installed.
+
+        Raises:
+            RuntimeError:
+                If use_inotify is true but inotify_simple isn't installed.
+
+        """
+        self._directory = directory
+        self._poll_interval = poll_interval
+
+        if use_inotify and INotify is None:
+            raise RuntimeError('inotify_simple must be installed to watch a directory with inotify')
+
+        self._inotify = None
+        if use_inotify or (use_inotify is None and INotify is not None):
+            self._inotify = INotify()
+            self._inotify.add_watch(self._directory, flags.CLOSE_WRITE | flags.MOVED_TO)
+
+        # The size and modification time of every zip file when it was last seen, and when it was last returned
+        self._seen: Dict[str, Tuple[int, int]] = {}
+        self._returned: Dict[str, Tuple[int, int]] = {}
+
+    @property
+    def uses_inotify(self) -> bool:
+        """Whether the directory is watched with inotify instead of being polled."""
+        return self._inotify is not None
+
+    def _check(self, path: str, wait_until_stable: bool) -> bool:
+        """Record the size and modification time of a zip file, and return True if it's complete and hasn't been returned.
+
+        If wait_until_stable is true, it's only complete if its size and modification time haven't changed since
+        the last time it was checked.
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:  # It was removed or renamed in the meantime
+            self._seen.pop(path, None)
+            return False
+
+        signature = (stat.st_size, stat.st_mtime_ns)
+        stable = self._seen.get(path) == signature
+        self._seen[path] = signature
+
+        if self._returned.get(path) == signature or (wait_until_stable and not stable) or not zipfile.is_zipfile(path):
+            return False
+
+        self._returned[path] = signature
+        return True
+
+    def scan(self) -> List[str]:
+        """Return every complete zip file in the directory which hasn't been returned before, or has changed since.
+
+        When the directory is being polled, a new zip file is only returned by the second scan that sees it.
+        """
+        with os.scandir(self._directory) as entries:
+            paths = sorted(entry.path for entry in entries if entry.is_file() and entry.name.lower().endswith('.zip'))
+
+        return [path for path in paths if self._check(path, wait_until_stable=not self.uses_inotify)]
+
+    def wait(self, timeout: float) -> List[str]:
+        """Wait up to timeout seconds for new zip files and return them. The list is empty if there weren't any."""
+        if not self.uses_inotify:
+            time.sleep(min(timeout, self._poll_interval))
+            return self.scan()
+
+        paths = []
+        for event in self._inotify.read(timeout=int(timeout * 1000)):
+            # If the kernel's queue of events overflowed, some were lost, so the whole directory is scanned instead
+            if event.mask & flags.Q_OVERFLOW:
+                return self.scan()
+
+            if event.name.lower().endswith('.zip'):
+                path = os.path.join(self._directory, event.name)
+
+                if path not in paths and self._check(path, wait_until_stable=False):
+                    paths.append(path)
+
+        return paths
+
+    def close(self) -> None:
+        """Stop watching the directory."""
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+
+
+class WatchDaemon:
+    """The class that watches an inbox and formats every new zip file in it with a persistent pool of workers.
+
+    Each zip file is formatted with process_chat() as a chat called after the name of the file. Its status is saved
+    as JSON in status_dir, with the same name as the HTML file, so that it can be checked from outside, and so that
+    a restarted daemon knows which zip files it has already formatted. Only one job with each name runs at a time, so
+    a zip file which changes while it's being formatted is held until that job is done, and then formatted again.
+
+    Methods:
+        queue(input_file: str) -> bool:
+            Queue a zip file to be formatted, unless it has already been formatted.
+
+        run(stop_event=None):
+            Watch the inbox and format every new zip file in it until stop_event is set.
+
+    """
+
+    status_interval = 1.0  # The minimum number of seconds between updates to the status file of a running job
+
+    def __init__(self, inbox: str, output_dir: str, sender_name: str, group_chat: bool = False, per_chat_dirs: bool = False,
+                 status_dir: Optional[str] = None, use_processes: bool = False, max_workers: Optional[int] = None,
+                 audio_workers: Optional[int] = None, audio_cache_dir: Optional[str] = None, poll_interval: float = 2.0,
+                 use_inotify: Optional[bool] = None, progress: Optional[Callable[[ProgressEvent], None]] = None,
+                 **kwargs):
+        """Create a WatchDaemon. Nothing is watched or formatted until run() is called.
+
+        Any other keyword arguments are passed on to process_chat() for every chat. template_dir and library_dir are
+        the ones next to this file if they're not given, so the daemon doesn't depend on its working directory.
+
+        Arguments:
+            inbox: str:
+                The directory to watch for exported zip files.
+
+            output_dir: str:
+                The directory to format the chats into.
+
+            sender_name: str:
+                The name of the sender (your WhatsApp alias) in every chat.
+
+        Keyword arguments:
+            group_chat:
+                A boolean which is false if not specified. If true, every chat is formatted as a group chat.
+
+            per_chat_dirs:
+                A boolean which is false if not specified. If true, each chat is formatted into its own directory in
+                output_dir, named after its HTML file.
+
+            status_dir:
+                The directory to write the status files to. '.formatter_jobs' in output_dir if not specified.
+
+            use_processes:
+                A boolean which is false if not specified. If true, chats are formatted in a pool of processes instead
+                of a pool of threads, like process_list_of_chats().
+
+            max_workers:
+                The maximum number of chats to format at once. The executor's default is used if not specified.
+
+            audio_workers:
+                The maximum number of processes in the AudioTranscoder pool shared by all the chats, if use_processes
+                is false. The number of CPUs is used if not specified.
+
+            audio_cache_dir:
+                The directory for the AudioTranscoder to cache converted audio in. If not specified, nothing is cached.
+
+            poll_interval:
+                The number of seconds between scans of the inbox when it isn't watched with inotify. 2 if not specified.
+
+            use_inotify:
+                Whether to watch the inbox with inotify. If not specified, it's used if inotify_simple is installed.
+
+            progress:
+                A callable which is also given every ProgressEvent of every chat, in this process. Nothing else is
+                told about the progress if not specified.
+
+        """
+        self._inbox = inbox
+        self._output_dir = output_dir
+        self._sender_name = sender_name
+        self._group_chat = group_chat
+        self._per_chat_dirs = per_chat_dirs
+        self._status_dir = status_dir or os.path.join(output_dir, '.formatter_jobs')
+        self._use_processes = use_processes
+        self._max_workers = max_workers
+        self._audio_workers = audio_workers
+        self._audio_cache_dir = audio_cache_dir
+        self._poll_interval = poll_interval
+        self._use_inotify = use_inotify
+        self._progress_callback = progress
+
+        kwargs.setdefault('template_dir', repo_directory)
+        kwargs.setdefault('library_dir', os.path.join(repo_directory, 'Library'))
+        self._chat_kwargs = kwargs
+
+        os.makedirs(self._status_dir, exist_ok=True)
+
+        # Every job this daemon has queued, by the name of its HTML file, and when its status file was last written
+        self._jobs: Dict[str, JobStatus] = {}
+        self._status_written: Dict[str, float] = {}
+        self._futures: List[concurrent.futures.Future] = []
+
+        # The zip files which changed while a job with the same name was unfinished, by the name of their HTML file
+        self._held: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+        # These last as long as run() does
+        self._executor: Optional[concurrent.futures.Executor] = None
+        self._transcoder: Optional[AudioTranscoder] = None
+        self._cancel_event = None
+        self._progress = None
+
+    def _status_path(self, html_file_name: str) -> str:
+        """Return the path of the status file of a job."""
+        return os.path.join(self._status_dir, html_file_name + '.json')
+
+    def _write_status(self, job: JobStatus) -> None:
+        """Write the status file of a job. It's written to a temporary file and renamed, so it's never half-written."""
+        file_descriptor, temp_path = tempfile.mkstemp(dir=self._status_dir, suffix='.tmp')
+
+        with os.fdopen(file_descriptor, 'w', encoding='utf-8') as f:
+            json.dump(asdict(job), f, indent=1)
+
+        os.chmod(temp_path, 0o644)  # mkstemp makes files that only their owner can read
+        os.replace(temp_path, self._status_path(job.html_file_name))
+
+        self._status_written[job.html_file_name] = time.monotonic()
+
+    def _read_status(self, html_file_name: str) -> Optional[JobStatus]:
+        """Return the status of a job from its status file, or None if there isn't one or it can't be read."""
+        try:
+            with open(self._status_path(html_file_name), 'r', encoding='utf-8') as f:
+                return JobStatus(**json.load(f))
+        except (OSError, ValueError, TypeError):
+            return None
+
+    def queue(self, input_file: str) -> bool:
+        """Queue a zip file to be formatted, unless it has already been formatted.
+
+        A zip file has already been formatted if it's been queued by this daemon, or if its status file says it
+        finished or failed, and it hasn't changed since. A status file that says it's queued or running is from a daemon
+        that was killed, so it's formatted again. If a job with the same name is still queued or running, the zip file
+        is held and queued by run() once that job is done. This must only be called while run() is running.
+
+        Returns:
+            True if the zip file was queued, False if it had already been formatted or it was held.
+
+        """
+        try:
+            stat = os.stat(input_file)
+        except OSError:
+            return False
+
+        html_file_name = os.path.splitext(os.path.basename(input_file))[0]
+
+        with self._lock:
+            previous = self._jobs.get(html_file_name)
+            done_states = ('queued', 'running', 'finished', 'failed')
+
+            if previous is None:
+                previous = self._read_status(html_file_name)
+                done_states = ('finished', 'failed')
+
+            if previous is not None and (previous.size, previous.mtime_ns) == (stat.st_size, stat.st_mtime_ns) and \
+                    previous.state in done_states:
+                return False
+
+            # Two jobs with the same name would write the same HTML file and status file at the same time
+            if html_file_name in self._jobs and previous.state in ('queued', 'running'):
+                if html_file_name not in self._held:
+                    print(f'HELD: {input_file} (it changed while it was being formatted)', file=sys.stderr)
+
+                self._held[html_file_name] = input_file
+                return False
+
+            output_dir = os.path.join(self._output_dir, html_file_name) if self._per_chat_dirs else self._output_dir
+            os.makedirs(output_dir, exist_ok=True)
+
+            # An incremental run appends to the previous HTML file itself, but otherwise it has to be removed, or the
+            # chat would be written to a new numbered HTML file next to it every time the zip file changed
+            if previous is not None and not self._chat_kwargs.get('incremental'):
+                self._remove_output(previous)
+
+            job = JobStatus(input_file, html_file_name, output_dir, stat.st_size, stat.st_mtime_ns,
+                            queued_at=datetime.now().isoformat(timespec='seconds'))
+            self._jobs[html_file_name] = job
+            self._write_status(job)
+
+        print(f'QUEUED: {input_file}', file=sys.stderr)
+
+        future = self._executor.submit(process_chat, input_file, self._group_chat, self._sender_name, html_file_name,
+                                       html_file_name, output_dir, transcoder=self._transcoder, progress=self._progress,
+                                       cancel_event=self._cancel_event, **self._chat_kwargs)
+        future.add_done_callback(lambda done_future: self._job_done(job, done_future))
+        self._futures.append(future)
+
+        return True
+
+    @staticmethod
+    def _remove_output(previous: JobStatus) -> None:
+        """Remove the HTML file and the pages of a previous job, so that the next job with its name replaces them.
+
+        The attachments are left alone, because the next job writes the same files over them.
+        """
+        html_file = previous.html_file or os.path.join(previous.output_dir, previous.html_file_name + '.html')
+        html_pages = previous.result['html_pages'] if previous.result else []
+
+        for path in [html_file] + html_pages:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _queue_held(self) -> None:
+        """Queue the held zip files whose previous jobs are done."""
+        with self._lock:
+            released = [input_file for html_file_name, input_file in self._held.items()
+                        if self._jobs[html_file_name].state not in ('queued', 'running')]
+
+            for input_file in released:
+                del self._held[os.path.splitext(os.path.basename(input_file))[0]]
+
+        for input_file in released:
+            self.queue(input_file)
+
+    def _job_progress(self, event: ProgressEvent) -> None:
+        """Update the status file of a running job, at most once every status_interval seconds."""
+        if self._progress_callback is not None:
+            self._progress_callback(event)
+
+        with self._lock:
+            job = self._jobs.get(event.html_file_name)
+
+            # The final state is written by _job_done(), which might have already happened
+            if job is None or job.state not in ('queued', 'running') or event.stage in ('finished', 'failed', 'cancelled'):
+                return
+
+            job.messages = event.messages
+            job.attachments = event.attachments
+
+            if event.stage == 'started':
+                job.state = 'running'
+                job.started_at = datetime.now().isoformat(timespec='seconds')
+            elif time.monotonic() - self._status_written.get(job.html_file_name, 0.0) < WatchDaemon.status_interval:
+                return
+
+            self._write_status(job)
+
+    def _job_done(self, job: JobStatus, future: concurrent.futures.Future) -> None:
+        """Write the final status of a job when its Future is done."""
+        with self._lock:
+            job.finished_at = datetime.now().isoformat(timespec='seconds')
+
+            try:
+                result = future.result()
+            except (FormatCancelled, concurrent.futures.CancelledError) as e:
+                job.state = 'cancelled'
+                job.error = repr(e)
+            except Exception as e:  # Any failure in one chat shouldn't stop the daemon
+                job.state = 'failed'
+                job.error = repr(e)
+            else:
+                job.state = 'finished'
+                job.result = result.to_dict()
+                job.html_file = result.html_file
+                job.messages = result.messages
+                job.attachments = result.attachments
+
+            self._write_status(job)
+
+        print(f'{job.state.upper()}: {job.input_file}' + (f': {job.error}' if job.state == 'failed' else ''), file=sys.stderr)
+
+    def run(self, stop_event=None) -> None:
+        """Watch the inbox and format every new zip file in it until stop_event is set.
+
+        Zip files which are already in the inbox are queued first. When stop_event is set, the chats which are being
+        formatted stop at their next message or attachment, the ones which haven't started are cancelled, and all of
+        them are queued again the next time the daemon is run.
+
+        Keyword arguments:
+            stop_event:
+                An object with an is_set() method, like a threading.Event. If not specified, this runs forever.
+
+        """
+        stop_event = stop_event or threading.Event()
+
+        # The chats in other processes need an Event and a queue for progress events that can be shared between processes
+        manager = progress_thread = None
+        if self._use_processes:
+            manager = multiprocessing.Manager()
+            self._cancel_event = manager.Event()
+            progress_queue = manager.Queue()
+            self._progress = progress_queue.put
+
+            progress_thread = threading.Thread(target=forward_progress_events, args=(progress_queue, self._job_progress),
+                                               daemon=True)
+            progress_thread.start()
+
+            # A pickled AudioTranscoder has no pool, so chats in separate processes convert their own audio
+            self._transcoder = AudioTranscoder(self._audio_cache_dir, max_workers=0)
+            self._executor = concurrent.futures.ProcessPoolExecutor(self._max_workers, initializer=ignore_interrupts)
+        else:
+            self._cancel_event = threading.Event()
+            self._progress = self._job_progress
+            self._transcoder = AudioTranscoder(self._audio_cache_dir, max_workers=self._audio_workers)
+            self._executor = concurrent.futures.ThreadPoolExecutor(self._max_workers)
+
+        watcher = FolderWatcher(self._inbox, poll_interval=self._poll_interval, use_inotify=self._use_inotify)
+        print(f'Watching {self._inbox} {"with inotify" if watcher.uses_inotify else "by polling it"}', file=sys.stderr)
+
+        try:
+            for input_file in watcher.scan():
+                self.queue(input_file)
+
+            while not stop_event.is_set():
+                for input_file in watcher.wait(self._poll_interval):
+                    self.queue(input_file)
+
+                self._queue_held()
+
+                # Forget the Futures that are done, so that they don't pile up in a daemon that runs for a long time
+                self._futures = [future for future in self._futures if not future.done()]
+        finally:
+            watcher.close()
+
+            self._cancel_event.set()
+            for future in self._futures:
+                future.cancel()
+
+            self._executor.shutdown()
+            self._transcoder.shutdown()
+
+            if progress_thread is not None:
+                progress_queue.put(None)
+                progress_thread.join()
+                manager.shutdown()
@@ -26,23 +26,26 @@ Classes:
 
         You have to create an instance (no arguments taken) and then call show() on it to show the window.
 
+    ProcessingWorker:
+        A QRunnable that processes a list of chats in a QThreadPool and sends its progress back with Qt signals.
+
 Functions:
     show_window():
         Create an instance of the GUI window and show it. Takes no arguments.
 
 """
 
-import os
 import sys
 import threading
 
-from shutil import rmtree
+from typing import Dict, List, Tuple
 
 from PyQt5 import QtCore, QtWidgets
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, pyqtSignal, pyqtSlot
 from PyQt5.QtGui import QKeySequence
 from PyQt5.QtWidgets import QMainWindow, QApplication, QVBoxLayout, QHBoxLayout, QWidget, QShortcut
 
-from library import process_list_of_chats
+from library import ProgressEvent, process_list_of_chats
 
 
 # This is a function I copied from [StackOverflow](https://stackoverflow.com/questions/64336575/select-a-file-or-a-folder-in-qfiledialog-pyqt5)
@@ -94,6 +97,55 @@ def get_open_files_and_dirs(parent=None, caption='', directory='', filter='', in
     return dialog.selectedFiles()
 
 
+class _WorkerSignals(QObject):
+    """The signals of a ProcessingWorker. QRunnable isn't a QObject, so it can't have signals itself."""
+
+    progress = pyqtSignal(object)  # A ProgressEvent from one of the chats
+    finished = pyqtSignal(list)  # The list of rejected chats
+    failed = pyqtSignal(str)  # The repr() of an exception that stopped the whole batch
+
+
+class ProcessingWorker(QRunnable):
+    """A QRunnable that processes a list of chats in a QThreadPool and sends its progress back with Qt signals.
+
+    The signals are in the signals attribute. Connecting them to slots in the GUI means that the slots are run in the
+    GUI's thread, so they can update widgets safely.
+
+    Methods:
+        run():
+            Process all the chats. This is called by the QThreadPool.
+
+        cancel():
+            Stop the chats that haven't finished. They're rejected, and finished is emitted as usual.
+
+    """
+
+    def __init__(self, all_chats: List[Tuple[str, bool, str, str, str, str]]):
+        """Create a ProcessingWorker for a list of argument tuples for process_chat()."""
+        super(ProcessingWorker, self).__init__()
+        # The GUI keeps a reference to the worker to cancel it, so Qt mustn't delete it when it's finished
+        self.setAutoDelete(False)
+
+        self.signals = _WorkerSignals()
+        self._all_chats = all_chats
+        self._cancel_event = threading.Event()
+
+    @pyqtSlot()
+    def run(self) -> None:
+        """Process all the chats, emitting progress as they go along and then finished or failed at the end."""
+        try:
+            rejected_chats = process_list_of_chats(self._all_chats, progress=self.signals.progress.emit,
+                                                   cancel_event=self._cancel_event)
+        except Exception as e:  # The GUI has to hear about it, or it would wait forever
+            self.signals.failed.emit(repr(e))
+        else:
+            self.signals.finished.emit(rejected_chats)
+
+    def cancel(self) -> None:
+        """Stop the chats that haven't finished. They're rejected, and finished is emitted as usual."""
+        self._cancel_event.set()
+
+
 class FormatterGUI(QMainWindow):
     """The class for the GUI for the WhatsApp Formatter.
 
@@ -108,9 +160,6 @@ class FormatterGUI(QMainWindow):
         """
         super(FormatterGUI, self).__init__()
 
-        # A boolean to see if the window exists. Used to close properly
-        self._exists = True
-
         self.setWindowTitle('WhatsApp Formatter')
         with open('style_gui.css', 'r') as f:
             self.setStyleSheet(f.read())
@@ -126,8 +175,9 @@ the top of the page and in the tab title)\n
 7. Click the 'Add to list' button\n
 8. Repeat steps 1-7 until you have selected all your chats\n
 9. Click the 'Process all' button\n
-10. Wait until the 'Processing...' text disappears
-(This may take quite a while if you've selected several large chats)\n
+10. Wait until the 'Processing...' text says that it's finished
+(This may take quite a while if you've selected several large chats,
+and you can click the 'Cancel' button to stop early)\n
 11. Once the 'Exit' button is active, you can safely exit the program'''
         self._all_chats_list = []
         self._group_chat = False
@@ -140,6 +190,11 @@ the top of the page and in the tab title)\n
         self._chat_title = ''
         self._filename = ''
 
+        # The worker processing the chats, if there is one, and the latest ProgressEvent of each of its chats
+        self._thread_pool = QThreadPool(self)
+        self._worker = None
+        self._progress_events: Dict[str, ProgressEvent] = {}
+
         # ===== Create widgets
 
         self._instructions_label = QtWidgets.QLabel(self)
@@ -164,18 +219,21 @@ the top of the page and in the tab title)\n
         self._sender_name_label.setAlignment(QtCore.Qt.AlignCenter)
 
         self._sender_name_textbox = QtWidgets.QLineEdit(self)
+        self._sender_name_textbox.textChanged.connect(self._textbox_changed)
 
         self._chat_title_label = QtWidgets.QLabel(self)
         self._chat_title_label.setText('Enter the desired title of the chat:')
         self._chat_title_label.setAlignment(QtCore.Qt.AlignCenter)
 
         self._chat_title_textbox = QtWidgets.QLineEdit(self)
+        self._chat_title_textbox.textChanged.connect(self._textbox_changed)
 
         self._filename_label = QtWidgets.QLabel(self)
         self._filename_label.setText('Enter the desired name of the HTML file:')
         self._filename_label.setAlignment(QtCore.Qt.AlignCenter)
 
         self._filename_textbox = QtWidgets.QLineEdit(self)
+        self._filename_textbox.textChanged.connect(self._textbox_changed)
 
         self._select_output_button = QtWidgets.QPushButton(self)
         self._select_output_button.setText('Select an output directory')
@@ -202,6 +260,11 @@ the top of the page and in the tab title)\n
         self._processing_label.setText('')
         self._processing_label.setAlignment(QtCore.Qt.AlignCenter)
 
+        self._cancel_button = QtWidgets.QPushButton(self)
+        self._cancel_button.setText('Cancel')
+        self._cancel_button.setEnabled(False)
+        self._cancel_button.clicked.connect(self._cancel_processing)
+
         self._exit_button = QtWidgets.QPushButton(self)
         self._exit_button.setText('Exit')
         self._exit_button.clicked.connect(self._close_properly)
@@ -221,13 +284,6 @@ the top of the page and in the tab title)\n
         self._central_widget.setLayout(self._hbox)
         self.setCentralWidget(self._central_widget)
 
-        # ===== Create threads
-
-        self._check_everything_thread = threading.Thread(target=self._loop_check_everything)
-        self._check_everything_thread.start()
-
-        self._process_all_thread: threading.Thread
-
     def _arrange_widgets(self) -> None:
         """Arrange the attributes created by __init__() nicely."""
         self._hbox.addWidget(self._instructions_label)
@@ -256,6 +312,7 @@ the top of the page and in the tab title)\n
         self._vbox.addWidget(self._add_to_list_button)
         self._vbox.addWidget(self._process_all_button)
         self._vbox.addWidget(self._processing_label)
+        self._vbox.addWidget(self._cancel_button)
         self._vbox.addWidget(self._exit_button)
         self._hbox.setSpacing(20)
 
@@ -275,6 +332,7 @@ the top of the page and in the tab title)\n
             self._selected_chat_display = ''
 
         self._selected_chat_label.setText(f'Selected:\n{self._selected_chat_display}')
+        self._enable_add_to_list_button()
 
     def _select_output_dialog(self) -> None:
         """Open a dialog and allow the user to select a directory, which then becomes self._selected_output."""
@@ -287,6 +345,7 @@ the top of the page and in the tab title)\n
             self._selected_output = ''
 
         self._selected_output_label.setText(f'Selected:\n{self._selected_output}')
+        self._enable_add_to_list_button()
 
     def _group_chat_checkbox_changed_state(self) -> None:
         """Check the state of self._group_chat_checkbox adn use it to determine the boolean value of self._group_chat."""
@@ -309,28 +368,76 @@ the top of the page and in the tab title)\n
         self._filename_textbox.setText('')
         # But don't clear the output directory, because the user will probably want to keep that the same
 
-    def _process_all_chats(self) -> None:
-        """Process all the lists of chat data in self._all_chats_list with functions.process_list()."""
-        # Disable the exit button until the process_all function returns
+        self._enable_process_all_button()
+
+    def _process_all(self) -> None:
+        """Process all the lists of chat data in self._all_chats_list with a ProcessingWorker in self._thread_pool."""
+        # Disable the exit button until the worker has finished
         self._exit_button.setEnabled(False)
+        self._cancel_button.setEnabled(True)
         self._processing_label.setText('Processing...')
 
         # Assign all chats to temporary variable to allow the process_all button to be disabled
         all_chats = self._all_chats_list.copy()
         self._all_chats_list.clear()
-        process_list_of_chats(all_chats)
+        self._enable_process_all_button()
+
+        self._progress_events.clear()
+        self._worker = ProcessingWorker(all_chats)
+        self._worker.signals.progress.connect(self._show_progress)
+        self._worker.signals.finished.connect(self._processing_finished)
+        self._worker.signals.failed.connect(self._processing_failed)
+        self._thread_pool.start(self._worker)
+
+    def _show_progress(self, event: ProgressEvent) -> None:
+        """Show the progress of every chat in self._processing_label."""
+        self._progress_events[event.html_file_name] = event
+
+        lines = ['Processing...']
+        for name, chat_event in self._progress_events.items():
+            if chat_event.stage in ('finished', 'failed', 'cancelled'):
+                lines.append(f'{name}: {chat_event.stage}')
+                continue
+
+            percent = f'{100 * chat_event.bytes_read / chat_event.total_bytes:.0f}%' if chat_event.total_bytes else ''
+            eta = chat_event.eta()
+            eta_text = f', about {eta:.0f}s left' if eta is not None else ''
+            lines.append(f'{name}: {chat_event.messages} messages {percent}{eta_text}')
+
+        self._processing_label.setText('\n'.join(lines))
+
+    def _processing_finished(self, rejected_chats: list) -> None:
+        """Show that the worker has finished, and how many chats were rejected, and allow the user to exit."""
+        if rejected_chats:
+            self._processing_label.setText(f'Finished, but {len(rejected_chats)} chats could not be processed')
+        else:
+            self._processing_label.setText('Finished')
 
-        self._processing_label.setText('')
+        self._worker_done()
+
+    def _processing_failed(self, error: str) -> None:
+        """Show the error that stopped the worker, and allow the user to exit."""
+        self._processing_label.setText(f'Processing failed: {error}')
+        self._worker_done()
+
+    def _worker_done(self) -> None:
+        """Forget the worker and enable the exit button again, and the process all button if more chats were added."""
+        self._worker = None
+        self._cancel_button.setEnabled(False)
         self._exit_button.setEnabled(True)
+        self._enable_process_all_button()
 
-        # Remove temporary directory
-        if os.path.isdir('temp'):
-            rmtree('temp')
+    def _cancel_processing(self) -> None:
+        """Ask the worker to stop the chats that haven't finished."""
+        if self._worker is not None:
+            self._worker.cancel()
+            self._cancel_button.setEnabled(False)
+            self._processing_label.setText('Cancelling...')
 
-    def _process_all(self) -> None:
-        """Run self._process_all_chats() in a thread."""
-        self._process_all_thread = threading.Thread(target=self._process_all_chats)
-        self._process_all_thread.start()
+    def _textbox_changed(self) -> None:
+        """Get the new values of the text boxes and enable or disable the add to list button."""
+        self._get_textbox_values()
+        self._enable_add_to_list_button()
 
     def _get_textbox_values(self) -> None:
         """Get the values from all the text boxes and assign them to their associated instance attributes."""
@@ -351,24 +458,27 @@ the top of the page and in the tab title)\n
             self._add_to_list_button.setEnabled(False)
 
     def _enable_process_all_button(self) -> None:
-        """Set self._process_all_button to enabled if there is data in self._all_chats_list."""
-        if len(self._all_chats_list) > 0:
+        """Set self._process_all_button to enabled if there is data in self._all_chats_list and no worker is running.
+
+        Chats can be added to the list while a worker is running, but they're only processed once it has finished.
+        """
+        if len(self._all_chats_list) > 0 and self._worker is None:
             self._process_all_button.setEnabled(True)
         else:
             self._process_all_button.setEnabled(False)
 
-    def _loop_check_everything(self) -> None:
-        """Run the methods to check things and enable widgets while self._exists is True."""
-        while self._exists:
-            self._get_textbox_values()
-            self._enable_add_to_list_button()
-            self._enable_process_all_button()
-
     def _close_properly(self) -> None:
-        """Set the self._exists boolean to false to end the threads and then close the window."""
-        self._exists = False
+        """Close the window. closeEvent() makes sure that no chats are left half processed."""
         self.close()
 
+    def closeEvent(self, event) -> None:
+        """Cancel the worker if it's still processing chats and wait for it to clean up before the window closes."""
+        if self._worker is not None:
+            self._worker.cancel()
+
+        self._thread_pool.waitForDone()
+        super(FormatterGUI, self).closeEvent(event)
+
 
 def show_window() -> None:
     """Create an instance of FormatterGUI and show it. Terminate the program when the user exits the window."""
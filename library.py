@@ -22,56 +22,391 @@ Classes:
     BadFormatError:
         A simple exception to be thrown if the format is incorrect.
 
+    FormatCancelled:
+        An exception to be thrown when formatting a chat stops early because it was cancelled.
+
+    ProgressEvent:
+        A dataclass describing how far formatting one chat has got, which is passed to progress callbacks.
+
+    FormatResult:
+        A dataclass holding the result of formatting one chat, with counts and timings.
+
     Message:
         The class for each message in a chat. Every instance is a separate message.
 
+    AudioTranscoder:
+        The class that converts audio attachments to mp3 in a pool of processes, with an optional cache on disk.
+
+    AttachmentStore:
+        The class for a content-addressed store of attachment files, which deduplicates them across chats.
+
+    ParsedMessageCache:
+        The class for a cache of the parsed messages of a chat, so that a chat which is formatted again isn't parsed again.
+
+    SearchIndex:
+        The class that writes the search index of one chat, which is used by Library/search.html.
+
+    BlockWriter:
+        A class to collect strings in memory and write them to a text file in large blocks.
+
+    OutputBackend:
+        The base class for everything that Chat writes the formatted messages of a chat to.
+
+    HTMLBackend:
+        The OutputBackend that writes rendered messages to one HTML file, or to several pages with an index.
+
+    SQLiteBackend:
+        The OutputBackend that writes messages to tables in an SQLite database, for analysing chats with SQL.
+
     Chat:
         The class for each chat to be formatted. Every instance is a separate chat.
 
 Functions:
-    process_chat(input_file: str, group_chat: bool, sender_name: str, chat_title: str, html_file_name: str, output_dir: str) -> None:
+    split_chat_messages(chat_lines: Iterable[str]) -> Iterator[str]:
+        Lazily split the lines of a _chat.txt file into raw messages, one message at a time.
+
+    find_message_ranges(buffer, start: int = 0, end: Optional[int] = None) -> Iterator[Tuple[int, int]]:
+        Lazily find where every message starts and ends in the bytes of a _chat.txt file, without decoding it.
+
+    split_chat_buffer(buffer, start: int = 0, end: Optional[int] = None) -> Iterator[str]:
+        Lazily split the bytes of a _chat.txt file, like a memory-mapped file, into raw messages.
+
+    process_chat(input_file: str, group_chat: bool, sender_name: str, chat_title: str, html_file_name: str, output_dir: str, extract_to_temp: bool = False, transcoder: AudioTranscoder = None, render_workers: int = 0, page_size: int = 0, page_by_month: bool = False, incremental: bool = False, dedupe_attachments: bool = False, thumbnails: bool = False, profile_dir: Optional[str] = None, progress: Callable[[ProgressEvent], None] = None, cancel_event=None, template_dir: Optional[str] = None, library_dir: Optional[str] = None, temp_dir: Optional[str] = None, search_index: bool = False, parse_cache_dir: Optional[str] = None, sqlite_file: Optional[str] = None) -> FormatResult:
         Process one chat completely.
 
-    process_list_of_chats(list_of_chats: list) -> list:
+    process_chat_async(input_file: str, group_chat: bool, sender_name: str, chat_title: str, html_file_name: str, output_dir: str, executor: Optional[concurrent.futures.Executor] = None, **kwargs) -> FormatResult:
+        Process one chat completely in an executor, without blocking the event loop.
+
+    process_list_of_chats(list_of_chats: list, use_processes: bool = False, max_workers: Optional[int] = None, audio_workers: Optional[int] = None, audio_cache_dir: Optional[str] = None, outcomes: Optional[dict] = None, progress: Callable[[ProgressEvent], None] = None, cancel_event=None, **kwargs) -> list:
         Fully format a list of lists, where each sub-list is a set of arguments to be passed to process_chat().
 
         Returns a list of all the sub-lists that couldn't be processed properly.
 
+    ignore_interrupts():
+        Ignore Ctrl+C in a worker process, so that only the main process decides what to do about it.
+
+    forward_progress_events(progress_queue, progress: Callable[[ProgressEvent], None]):
+        Pass every ProgressEvent from a queue on to the progress callback, until None is put in the queue.
+
 """
 
+import abc
+import asyncio
+import collections
 import concurrent.futures
+import contextlib
+import cProfile
+import hashlib
+import io
+import functools
+import itertools
+import json
+import mmap
+import multiprocessing
 import os
 import re
-import threading
 import shutil
+import signal
+import sqlite3
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
 import zipfile
 
-from datetime import datetime
-from typing import Tuple, List
+from dataclasses import asdict, dataclass, field
+from datetime import date, datetime, timedelta
+from typing import BinaryIO, Callable, Dict, Iterable, Iterator, Tuple, List, Optional, Set, TextIO
 from pydub import AudioSegment
 
+try:
+    from PIL import Image
+except ImportError:  # Pillow is only needed to make thumbnails of images
+    Image = None
+
+
+# This matches the prefix at the start of a line that begins a new message
+message_start_pattern = re.compile(r'\[\d{2}/\d{2}/\d{4}, (\d{1,2}:\d{2}:\d{2} [ap]m|\d{2}:\d{2}:\d{2})]')
+
+# This matches the same prefix in the bytes of _chat.txt, with the line ending before it and any LRM, LRE, and PDF
+# characters in between, so that messages can be found without decoding the chat
+message_boundary_pattern = re.compile(rb'[\n\r](?:\xe2\x80[\x8e\xaa\xac])*\[\d{2}/\d{2}/\d{4}, '
+                                      rb'(?:\d{1,2}:\d{2}:\d{2} [ap]m|\d{2}:\d{2}:\d{2})]')
+
+# From Python 3.12, only one cProfile profiler can be active at a time, so profiled chats take turns with this
+_profile_lock = threading.Lock()
 
 
 class BadFormatError(Exception):
     """A simple exception to be thrown if the format is incorrect."""
 
 
+class FormatCancelled(Exception):
+    """An exception to be thrown when formatting a chat stops early because it was cancelled."""
+
+
+@dataclass
+class ProgressEvent:
+    """A dataclass describing how far formatting one chat has got, which is passed to progress callbacks.
+
+    Attributes:
+        stage:
+            What happened. It's 'started', 'messages' after every Chat.progress_interval messages, 'attachments' after
+            every attachment, 'audio' after every converted audio file, or 'finished', 'failed' or 'cancelled' at the end.
+
+        input_file:
+            The zip file of the chat.
+
+        html_file_name:
+            The name of the HTML file of the chat, which tells chats apart if they're from the same zip file.
+
+        messages:
+            The number of messages written so far.
+
+        attachments:
+            The number of attachments moved so far.
+
+        converted_audio_files:
+            The number of audio files converted to mp3 so far.
+
+        bytes_read:
+            The number of uncompressed bytes read from the zip file so far. This is approximate while messages are read.
+
+        total_bytes:
+            The number of uncompressed bytes in the whole zip file, or 0 if it isn't known yet.
+
+        bytes_written:
+            The number of bytes copied to the Attachments folder so far. The HTML is only counted at the end.
+
+        elapsed:
+            The time since the chat started, in seconds.
+
+        error:
+            The repr() of the exception that stopped the chat if the stage is 'failed', else None.
+
+    Methods:
+        eta() -> Optional[float]:
+            Return an estimate of the number of seconds until the chat is finished, or None if it can't be estimated yet.
+
+    """
+
+    stage: str
+    input_file: str
+    html_file_name: str
+    messages: int = 0
+    attachments: int = 0
+    converted_audio_files: int = 0
+    bytes_read: int = 0
+    total_bytes: int = 0
+    bytes_written: int = 0
+    elapsed: float = 0.0
+    error: Optional[str] = None
+
+    def eta(self) -> Optional[float]:
+        """Return an estimate of the number of seconds until the chat is finished, or None if it can't be estimated yet.
+
+        The estimate assumes that the rest of the zip file is read at the same speed as the part that's been read.
+        """
+        if self.stage in ('finished', 'failed', 'cancelled'):
+            return 0.0
+
+        if self.bytes_read == 0 or self.total_bytes == 0:
+            return None
+
+        return self.elapsed * max(self.total_bytes - self.bytes_read, 0) / self.bytes_read
+
+
+@dataclass
+class FormatResult:
+    """A dataclass holding the result of formatting one chat, with counts and timings.
+
+    Attributes:
+        html_file:
+            The path of the HTML file that was written.
+
+        messages:
+            The number of messages written to the HTML file.
+
+        attachments:
+            The number of attachment files put in the Attachments folder.
+
+        converted_audio_files:
+            The number of those attachments that were audio files converted to mp3.
+
+        cached_audio_files:
+            The number of audio files that were copied from the AudioTranscoder's cache instead of being converted again.
+
+        skipped_messages:
+            The number of messages that were skipped because they were already formatted by a previous incremental run.
+
+        skipped_attachments:
+            The number of attachments that were skipped because they were already moved by a previous incremental run.
+
+        deduplicated_attachments:
+            The number of attachments that were already in the AttachmentStore, so they were linked instead of stored again.
+
+        thumbnails:
+            The number of thumbnails of photos and posters of videos that were made.
+
+        cached_messages:
+            The number of messages that were read from the ParsedMessageCache instead of being parsed from _chat.txt.
+
+        html_pages:
+            The paths of the pages of the chat if it was split into pages. Then html_file is the index of the pages.
+
+        bytes_read:
+            The number of uncompressed bytes of _chat.txt and the attachments that were read. If the messages were read
+            from the ParsedMessageCache, the size of the cache is counted instead of _chat.txt.
+
+        bytes_written:
+            The number of bytes written to the HTML files and the Attachments folder. Attachments that were moved from
+            the temporary directory or linked from the AttachmentStore aren't counted, because they weren't copied.
+
+        timings:
+            A dictionary of the time taken for each part of the formatting, in seconds. The 'total' key is the whole chat.
+            The text and the attachments are done at the same time, so the timings of their parts overlap.
+
+            The parts of the text are 'split_messages', 'render_messages' and 'write_html', and 'write_sqlite' if the
+            messages are written to an SQLite database too, which add up to most of 'write_text'. If the messages were read from the ParsedMessageCache, 'split_messages' is 0 and reading the
+            cache is part of 'render_messages'. The parts of the attachments are 'copy_attachments', 'wait_for_audio' and 'wait_for_thumbnails',
+            which add up to 'move_attachment_files'. 'extract_zip' is only there if the zip was extracted first.
+
+    Methods:
+        to_dict() -> dict:
+            Return the result as a dictionary that can be saved as JSON.
+
+    """
+
+    html_file: str = ''
+    html_pages: List[str] = field(default_factory=list)
+    messages: int = 0
+    attachments: int = 0
+    converted_audio_files: int = 0
+    cached_audio_files: int = 0
+    skipped_messages: int = 0
+    skipped_attachments: int = 0
+    deduplicated_attachments: int = 0
+    thumbnails: int = 0
+    cached_messages: int = 0
+    bytes_read: int = 0
+    bytes_written: int = 0
+    timings: Dict[str, float] = field(default_factory=dict)
+
+    def to_dict(self) -> dict:
+        """Return the result as a dictionary that can be saved as JSON."""
+        return asdict(self)
+
+
+@functools.lru_cache(maxsize=1024)
+def _parse_date(date_raw: str) -> Tuple[date, str, str]:
+    """Parse a date in the form dd/mm/yyyy and return the date, the day of the month with its extension, and the formatted date.
+
+    This is cached because every message on the same day has the same date.
+    """
+    date_obj = date(int(date_raw[6:10]), int(date_raw[3:5]), int(date_raw[0:2]))
+    day = str(date_obj.day)
+
+    # Get day of the month extension
+    if day.endswith('1') and day != '11':
+        extension = 'st'
+    elif day.endswith('2') and day != '12':
+        extension = 'nd'
+    elif day.endswith('3') and day != '13':
+        extension = 'rd'
+    else:
+        extension = 'th'
+
+    day += extension
+
+    return date_obj, day, date_obj.strftime(f'%a {day} %B %Y')
+
+
+def _parse_time(time_raw: str) -> Tuple[int, int, int, str]:
+    """Parse a time in the form HH:MM:SS or H:MM:SS am/pm and return the hour (out of 24), minute, second, and the formatted time.
+
+    The formatted time is always in 12 hour format without a leading zero, like '9:47:19 PM'.
+    """
+    hour_raw, minute_raw, second_raw = time_raw.split(':')
+    hour = int(hour_raw)
+    minute = int(minute_raw)
+    second = int(second_raw[:2])
+
+    if second_raw.endswith(' am'):
+        hour %= 12
+    elif second_raw.endswith(' pm'):
+        hour = hour % 12 + 12
+
+    if not (0 <= hour < 24 and 0 <= minute < 60 and 0 <= second < 60):
+        raise BadFormatError(f'Invalid time "{time_raw}".')
+
+    return hour, minute, second, _format_time(hour, minute, second)
+
+
+def _format_time(hour: int, minute: int, second: int) -> str:
+    """Return a time in 12 hour format without a leading zero, like '9:47:19 PM'."""
+    return f'{hour % 12 or 12}:{minute:02d}:{second:02d} {"AM" if hour < 12 else "PM"}'
+
+
+def _replace_content_token(token: re.Match) -> str:
+    """Return the HTML for a single match of Message.content_token_pattern."""
+    kind = token.lastgroup
+    text = token.group(kind)
+
+    if kind == 'character':
+        return Message.character_replacements[text]
+
+    if kind == 'link':
+        # Get rid of punctuation at the end of the link, but keep it in the message
+        link = text.rstrip('.,!?')
+        return f'<a href="{link}" target="_blank">{link}</a>{text[len(link):]}'
+
+    if kind == 'code':
+        # Code isn't formatted any further, but it still needs its characters replaced
+        inner_html = re.sub(r'[<>\n]', lambda character: Message.character_replacements[character.group()], text)
+    else:
+        # Other formatting can be nested, like bold italics
+        inner_html = _format_message_content(text)
+
+    return f'<{Message.format_tags[kind]}>{inner_html}</{Message.format_tags[kind]}>'
+
+
+def _format_message_content(content: str) -> str:
+    """Return the HTML of normal message content, with tags for formatting and links, and without rogue HTML tags.
+
+    This is done in one scan of the content with Message.content_token_pattern.
+    """
+    return re.sub(Message.content_token_pattern, _replace_content_token, content)
+
+
 class Message:
     """The class for each message in a chat. Every instance is a separate message.
 
+    There can be millions of Message objects for a big chat, so they use __slots__ and only keep what's needed
+    to render them. Sender names are interned, so every message from the same sender shares one string,
+    and every message on the same day shares the same date string.
+
     Methods:
-        create_html(sender_name: str) -> str:
+        from_parsed(parsed: tuple, group_chat: bool, html_file_name: str, thumbnails: bool = False) -> Message:
+            Create a Message from the tuple given by the parsed property of another Message, without parsing it again.
+
+        create_html(sender_name: str, anchor: Optional[str] = None) -> str:
             Return HTML representation of the Message object.
 
     """
 
+    __slots__ = ('_group_chat', '_name', '_message_content', '_attachment', '_datetime_obj', 'date', '_time',
+                 '_group_chat_meta')
+
     html_audio_formats = {'.mp3': 'mpeg', '.ogg': 'ogg', '.wav': 'wav'}  # Dict of HTML accepted audio formats
 
-    # This is a dictionary of patterns and replacement patterns for converting WhatsApp formatting to HTML tags
-    format_dict = {re.compile(r'\b_([^_]+)_\b'): r'<em>\1</em>',
-                   re.compile(r'\*\b([^*]+)\b\*'): r'<strong>\1</strong>',
-                   re.compile(r'~\b([^~]+)\b~'): r'<del>\1</del>',
-                   re.compile(r'```\b([^`]+)\b```'): r'<code>\1</code>'}
+    # This is a dictionary of the HTML tags for each kind of WhatsApp formatting in content_token_pattern
+    format_tags = {'em': 'em', 'strong': 'strong', 'del': 'del', 'code': 'code'}
+
+    # This is a dictionary of single characters in message content and what they're replaced with in the HTML
+    character_replacements = {'<': '&lt;', '>': '&gt;', '\n': '<br>\n\t\t'}
 
     # Tuple of extensions that can be moved without being converted
     non_conversion_extensions = ('jpg', 'png', 'webp', 'gif', 'mp4', 'mp3', 'ogg', 'wav')
@@ -85,17 +420,29 @@ class Message:
     group_meta_prefix_pattern = re.compile(r'\[(\d{2}/\d{2}/\d{4}, (\d{1,2}:\d{2}:\d{2} [ap]m|\d{2}:\d{2}:\d{2}))] ([^:]+)')
     # Groups: full prefix is 1, time is 2, content is 3
 
+    html_tag_pattern = re.compile(r'<[^>]*>')
+
+    timestamp_epoch = datetime(1970, 1, 1)  # Parsed messages keep their time as the number of seconds since this
+
     attachment_message_pattern = re.compile(r'<attached: (\d{8}-(\w+)-\d{4}-\d{2}-\d{2}-\d{2}-\d{2}-\d{2})(\.\w+)>$')
     # Groups: filename without extension is 1, file type is 2, extension is 3
 
-    # Link pattern taken from urlregex.com
-    link_pattern = re.compile(r'http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*(),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+')
+    # This combines links, WhatsApp formatting, and characters that need replacing, so content can be formatted in one scan
+    # The link characters are the same as the pattern from urlregex.com, except for < and >
+    # If more than one could start at the same character, the first one in the pattern wins
+    content_token_pattern = re.compile(r'(?P<link>http[s]?://[!$-;=?-_a-z]+)'
+                                       r'|```(?P<code>\b[^`]+\b)```'
+                                       r'|\*(?P<strong>\b[^*]+\b)\*'
+                                       r'|\b_(?P<em>[^_]+)_\b'
+                                       r'|~(?P<del>\b[^~]+\b)~'
+                                       r'|(?P<character>[<>\n])')
+    # Groups: the name of the last group that matched is the kind of token
 
     encrypted_messages_notice_pattern = re.compile(
         r'\[(\d{2}/\d{2}/\d{4}, (\d{1,2}:\d{2}:\d{2} [ap]m|\d{2}:\d{2}:\d{2}))] ([^:]+): '
         r'Messages and calls are end-to-end encrypted\. No one outside of this chat, not even WhatsApp, can read or listen to them\.$')
 
-    def __init__(self, original_string: str, group_chat: bool, html_file_name: str):
+    def __init__(self, original_string: str, group_chat: bool, html_file_name: str, thumbnails: bool = False):
         """Create a Message object.
 
         Arguments:
@@ -108,27 +455,28 @@ class Message:
             html_file_name: str:
                 The name of the final HTML file.
 
+        Keyword arguments:
+            thumbnails:
+                A boolean which is false if not specified. If true, photo and video attachments show their thumbnail
+                and the full file is only loaded when the photo is clicked or the video is played.
+
         """
         self._group_chat = group_chat
-        self._html_file_name = html_file_name
 
         # Remove LRM, LRE, and PDF Unicode characters from original_string
         original = original_string.replace('\u200e', '').replace('\u202a', '').replace('\u202c', '')
 
         prefix_match = re.match(Message.full_prefix_pattern, original)
+        self._attachment = None
 
         if prefix_match:  # If it's a normal message
-            self._name = prefix_match.group(3)
+            self._name = sys.intern(prefix_match.group(3))
             self._message_content = prefix_match.group(4)
 
             if re.match(Message.attachment_message_pattern, self._message_content):
-                self._format_attachment_message()
+                self._format_attachment_message(html_file_name, thumbnails)
             else:
-                self._clean_message_content()
-                self._format_with_html_tags()
-                self._format_links()
-
-                self._message_content = self._message_content.replace('\n', '<br>\n\t\t')
+                self._message_content = _format_message_content(self._message_content)
 
             self._group_chat_meta = False
         else:  # If it's a group chat meta message
@@ -144,31 +492,100 @@ class Message:
             self._group_chat_meta = True
 
         date_raw = prefix_match.group(1)
-        time = prefix_match.group(2)
+        time_raw = prefix_match.group(2)
+
+        # Messages on the same day share the same date, so this is cached, but the time is quick to parse by hand
+        date_obj, _, self.date = _parse_date(date_raw[:10])
+        hour, minute, second, self._time = _parse_time(time_raw)
+
+        self._datetime_obj = datetime(date_obj.year, date_obj.month, date_obj.day, hour, minute, second)
+
+    @property
+    def datetime_obj(self) -> datetime:
+        """The date and time that the message was sent."""
+        return self._datetime_obj
+
+    @property
+    def name(self) -> str:
+        """The name of the person who sent the message, or an empty string if it's a group chat meta message."""
+        return self._name
+
+    @property
+    def attachment(self) -> Optional[str]:
+        """The name of the attached file, as it is in the zip file, or None if there isn't one."""
+        return self._attachment
+
+    @property
+    def attachment_type(self) -> Optional[str]:
+        """The type of the attached file from its name, like 'PHOTO', 'VIDEO', or 'AUDIO', or None if there isn't one."""
+        # Attachment names always look like 00000001-PHOTO-2021-01-01-10-00-00.jpg
+        return self._attachment.split('-', 2)[1] if self._attachment else None
+
+    @property
+    def time(self) -> str:
+        """The time that the message was sent, formatted like '9:47:19 PM'."""
+        return self._time
+
+    @property
+    def parsed(self) -> Tuple[int, str, Optional[str], str]:
+        """The message as it was parsed, before anything that depends on how the chat is formatted, for ParsedMessageCache.
+
+        It's a tuple of the number of seconds between Message.timestamp_epoch and the time the message was sent, the
+        name of the sender (which is empty for a group chat meta message), the name of the attachment file (or None
+        if there isn't one), and the HTML of the content (which is empty for an attachment).
+        """
+        timestamp = (self._datetime_obj - Message.timestamp_epoch) // timedelta(seconds=1)
+        return timestamp, self._name, self._attachment, '' if self._attachment else self._message_content
+
+    @classmethod
+    def from_parsed(cls, parsed: Tuple[int, str, Optional[str], str], group_chat: bool, html_file_name: str,
+                    thumbnails: bool = False) -> 'Message':
+        """Create a Message from the tuple given by the parsed property of another Message, without parsing it again.
+
+        Arguments:
+            parsed: tuple:
+                The tuple from Message.parsed, which may have been read from a ParsedMessageCache.
+
+            group_chat: bool:
+                A boolean representing whether the message came from a group chat.
+
+            html_file_name: str:
+                The name of the final HTML file.
+
+        Keyword arguments:
+            thumbnails:
+                A boolean which is false if not specified. It's the same as the argument to Message().
 
-        # Use a ternary operator to get datetime object whether the message is in 12 hour or 24 hour format
-        self._datetime_obj = datetime.strptime(date_raw, '%d/%m/%Y, %I:%M:%S %p') if ' am' in time or ' pm' in time \
-            else datetime.strptime(date_raw, '%d/%m/%Y, %H:%M:%S')
+        Returns:
+            Message:
+                A Message which is the same as the one that parsed was taken from, if the other arguments are the same.
+
+        """
+        timestamp, name, attachment, content = parsed
 
-        day = str(self._datetime_obj.day)
+        msg = cls.__new__(cls)
+        msg._group_chat = group_chat
+        msg._name = sys.intern(name)
+        msg._group_chat_meta = not name
+        msg._attachment = None
 
-        # Get day of the month extension
-        if day.endswith('1') and day != '11':
-            extension = 'st'
-        elif day.endswith('2') and day != '12':
-            extension = 'nd'
-        elif day.endswith('3') and day != '13':
-            extension = 'rd'
+        if attachment:
+            msg._message_content = f'<attached: {attachment}>'
+            msg._format_attachment_message(html_file_name, thumbnails)
         else:
-            extension = 'th'
+            msg._message_content = content
 
-        self._day = day + extension
+        msg._datetime_obj = datetime_obj = Message.timestamp_epoch + timedelta(seconds=timestamp)
+        msg.date = _parse_date(f'{datetime_obj:%d/%m/%Y}')[2]
+        msg._time = _format_time(datetime_obj.hour, datetime_obj.minute, datetime_obj.second)
 
-        self.date = datetime.strftime(self._datetime_obj, f'%a {self._day} %B %Y')
-        self._time = datetime.strftime(self._datetime_obj, '%I:%M:%S %p')
+        return msg
 
-        if self._time.startswith('0'):
-            self._time = self._time.replace('0', '', 1)
+    @property
+    def plain_text(self) -> str:
+        """The content of the message without any HTML, like it was written. Attachments have no text."""
+        text = ' '.join(re.sub(Message.html_tag_pattern, '', self._message_content.replace('<br>', ' ')).split())
+        return text.replace('&lt;', '<').replace('&gt;', '>')
 
     def __repr__(self) -> str:
         """Return a __repr__ of the Message instance including the name, date, name, and whether it's from a group chat. Also includes the memory location in hex."""
@@ -186,25 +603,17 @@ class Message:
         """Replace < and > in self._message_content to avoid rogue HTML tags."""
         self._message_content = self._message_content.replace('<', '&lt;').replace('>', '&gt;')
 
-    def _format_with_html_tags(self) -> None:
-        """Replace WhatsApp format characters with their HTML tag equivalents in self._message_content."""
-        for pattern, replacement in Message.format_dict.items():
-            self._message_content = re.sub(pattern, replacement, self._message_content)
-
-    def _format_links(self) -> None:
-        """Find all the links in self._message_content and wrap them in <a> tags."""
-        links = re.findall(Message.link_pattern, self._message_content)
+    def _format_attachment_message(self, html_file_name: str, thumbnails: bool) -> None:
+        """Format an attachment message to properly link to the attachment with HTML tags.
 
-        for link in links:
-            # Get rid of punctuation or spaces at the end of the link
-            while re.search(r'[\s.,!?]$', link):
-                link = link[:-1]
+        Arguments:
+            html_file_name: str:
+                The name of the final HTML file, which is also the name of the folder in Attachments.
 
-            formatted_link = f'<a href="{link}" target="_blank">{link}</a>'
-            self._message_content = self._message_content.replace(link, formatted_link)
+            thumbnails: bool:
+                Whether to show thumbnails of photos and videos from Attachments/html_file_name/thumbnails.
 
-    def _format_attachment_message(self) -> None:
-        """Format an attachment message to properly link to the attachment with HTML tags."""
+        """
         match = re.match(Message.attachment_message_pattern, self._message_content)
         if match is None:
             raise BadFormatError('Failed to match attachment message.')
@@ -214,6 +623,7 @@ class Message:
         extension = match.group(3)
 
         filename = filename_no_ext + extension
+        self._attachment = filename
 
         if file_type == 'AUDIO':
             for ext, given_format in Message.html_audio_formats.items():
@@ -227,32 +637,51 @@ class Message:
                 filename = filename_no_ext + '.mp3'
 
             self._message_content = f'<audio controls>\n\t\t\t<source ' \
-                                    f'src="Attachments/{self._html_file_name}/{filename}" ' \
+                                    f'src="Attachments/{html_file_name}/{filename}" ' \
                                     f'type="audio/{html_format}">\n\t\t</audio>'
 
+        elif file_type == 'VIDEO' and thumbnails:
+            # The video isn't loaded until it's played
+            self._message_content = f'<video controls preload="none" ' \
+                                    f'poster="Attachments/{html_file_name}/thumbnails/{filename_no_ext}.jpg">\n\t\t\t<source ' \
+                                    f'src="Attachments/{html_file_name}/{filename}">\n\t\t</video>'
+
         elif file_type == 'VIDEO':
             self._message_content = f'<video controls>\n\t\t\t<source ' \
-                                    f'src="Attachments/{self._html_file_name}/{filename}">\n\t\t</video>'
+                                    f'src="Attachments/{html_file_name}/{filename}">\n\t\t</video>'
+
+        elif file_type == 'PHOTO' and thumbnails:
+            # The full photo is loaded by enlarge_images.js when it's clicked, or straight away if there's no thumbnail
+            self._message_content = f'<img class="small" src="Attachments/{html_file_name}/thumbnails/{filename_no_ext}.jpg" ' \
+                                    f'data-full-src="Attachments/{html_file_name}/{filename}" loading="lazy" ' \
+                                    f'onerror="this.onerror = null; this.src = this.dataset.fullSrc;" ' \
+                                    f'alt="IMAGE ATTACHMENT" style="max-height: 400px; max-width: 800px; display: inline-block;">'
 
         elif (file_type == 'PHOTO') or (file_type == 'GIF' and extension == '.gif') or (file_type == 'STICKER'):
-            self._message_content = f'<img class="small" src="Attachments/{self._html_file_name}/{filename}" ' \
+            self._message_content = f'<img class="small" src="Attachments/{html_file_name}/{filename}" ' \
                                     f'alt="IMAGE ATTACHMENT" style="max-height: 400px; max-width: 800px; display: inline-block;">'
 
         elif file_type == 'GIF' and extension != '.gif':  # Add gif as video that autoplays and loops like a proper gif
             self._message_content = f'<video autoplay loop muted playsinline>\n\t\t\t<source ' \
-                                    f'src="Attachments/{self._html_file_name}/{filename}">\n\t\t</video>'
+                                    f'src="Attachments/{html_file_name}/{filename}">\n\t\t</video>'
 
         else:
             self._message_content = f'UNKNOWN ATTACHMENT "{filename}"'
 
-    def create_html(self, sender_name: str) -> str:
+    def create_html(self, sender_name: str, anchor: Optional[str] = None) -> str:
         """Return HTML representation of the Message object.
 
         Arguments:
             sender_name: str:
                 The sender in the chat that this message is from.
 
+        Keyword arguments:
+            anchor:
+                The id of the message's element, which the search page links to. It has no id if not specified.
+
         """
+        id_attribute = f' id="{anchor}"' if anchor is not None else ''
+
         if not self._group_chat_meta:
             if self._name == sender_name:
                 sender_type = 'sender'
@@ -266,266 +695,2558 @@ class Message:
             else:
                 recipient_name = ''
 
-            return f'<div class="message {sender_type}">\n\t{recipient_name}\n\t<span class="message-info date">' \
+            return f'<div{id_attribute} class="message {sender_type}">\n\t{recipient_name}\n\t<span class="message-info date">' \
                    f'{self.date}</span>\n\t\t<p>{self._message_content}</p>\n\t<span class="message-info time">' \
                    f'{self._time}</span>\n</div>\n\n'
 
         # Else
         # If it's a meta message in a group chat
-        return f'<div class="group-chat-meta">\n\t<span class="message-info date">{self.date}</span>\n\t\t' \
+        return f'<div{id_attribute} class="group-chat-meta">\n\t<span class="message-info date">{self.date}</span>\n\t\t' \
                f'<p>{self._message_content}</p>\n\t<span class="message-info time">{self._time}</span>\n</div>\n\n'
 
 
-class Chat:
-    """The class for each chat to be formatted. Every instance is a separate chat.
-
-    Methods:
-        format():
-            Fully extract the zip file and format the chat.
+def _convert_audio_to_mp3(data: bytes, destination: str, cache_path: Optional[str]) -> bool:
+    """Convert audio data to an mp3 file at destination and then add a copy to the cache if cache_path is given.
 
+    This is a module level function so that it can be run in another process. It always returns True.
     """
+    AudioSegment.from_file(io.BytesIO(data)).export(destination, format='mp3')
 
-    attachment_file_pattern = re.compile(r'(\d{8}-(\w+)-\d{4}-\d{2}-\d{2}-\d{2}-\d{2}-\d{2})(\.\w+)$')
-    # Groups: filename without extension is 1, file type is 2, extension is 3
+    if cache_path is not None:
+        # Copy to a temporary file first and then rename it, so that other processes never see a half-written file
+        file_descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path), suffix='.tmp')
+        os.close(file_descriptor)
+        shutil.copyfile(destination, temp_path)
+        os.replace(temp_path, cache_path)
 
-    def __init__(self, input_file: str, group_chat: bool, sender_name: str, chat_title: str, html_file_name: str, output_dir: str):
-        """Create a Chat object with instance attributes equal to the arguments passed.
+    return True
 
-        Arguments:
-            input_file:
-                The original zip file of the exported chat. It must have the '.zip' extension.
 
-            group_chat:
-                A boolean to determine whether the chat is a group chat.
+class AudioTranscoder:
+    """The class that converts audio attachments to mp3 in a pool of processes, with an optional cache on disk.
 
-            sender_name:
-                The name of the sender in the chat. Typically the user's WhatsApp alias.
+    One instance can be shared by many chats, so that all their voice notes are converted in the same bounded pool.
+    The cache is keyed by the SHA-256 hash of the original audio data, so an identical voice note is only ever
+    converted once, even across separate runs and separate exports.
 
-            chat_title:
-                The title of the chat. This appears in the top bar and in the browser tab. It is not the file name.
+    If an instance is pickled to be sent to another process, the copy doesn't have a pool and converts audio in the
+    process that uses it, but it still uses the same cache.
 
-            html_file_name:
-                The intended name of the final HTML file.
+    Methods:
+        convert(source: BinaryIO, destination: str) -> concurrent.futures.Future:
+            Convert the audio in source to an mp3 file at destination, using the cache if possible.
 
-            output_dir:
-                The intended directory for the output. The HTML file, Attachments folder, and Library folder will go here.
+        shutdown():
+            Wait for all conversions to finish and shut down the pool of processes.
+
+    """
+
+    def __init__(self, cache_dir: Optional[str] = None, max_workers: Optional[int] = None):
+        """Create an AudioTranscoder with its own pool of processes.
+
+        Keyword arguments:
+            cache_dir:
+                The directory to keep converted mp3 files in. It will be created if it doesn't exist. If not specified,
+                nothing is cached.
+
+            max_workers:
+                The maximum number of processes to convert audio with. The number of CPUs is used if not specified.
+                If it's 0, there's no pool and every file is converted in the thread that calls convert().
 
         """
-        self._input_file = input_file
-        self._group_chat = group_chat
-        self._sender_name = sender_name
-        self._chat_title = chat_title
-        self._html_file_name = html_file_name
-        self._output_dir = output_dir
+        self._cache_dir = cache_dir
 
-        # Threads to be used later
-        self._write_text_thread = threading.Thread(target=self._write_text)
-        self._move_attachment_files_thread = threading.Thread(target=self._move_attachment_files)
+        if self._cache_dir is not None:
+            os.makedirs(self._cache_dir, exist_ok=True)
 
-        # This is a unique temporary directory for this chat, to allow for multithreading multiple chats
-        # os.path.splitext()[0] is used to remove extensions
-        # os.path.split()[1] is used to just get the name of the zip file, not the absolute path
-        self._temp_directory = f'temp_{os.path.splitext(os.path.split(self._input_file)[1])[0]}_{self._chat_title}_' \
-                               f'{os.path.splitext(self._html_file_name)[0]}'
+        # Ctrl+C is handled by the main process, which cancels the chats, so it mustn't kill the conversions
+        self._executor = concurrent.futures.ProcessPoolExecutor(max_workers, initializer=ignore_interrupts) \
+            if max_workers != 0 else None
 
-        # Make directories if they don't exist
-        if not os.path.isdir(library_path := os.path.join(self._output_dir, 'Library')):
-            shutil.copytree('Library', library_path)
+    def __getstate__(self) -> dict:
+        """Return the state of the instance to pickle, without the pool of processes."""
+        return {'_cache_dir': self._cache_dir, '_executor': None}
 
-        if not os.path.isdir(attachments_path := os.path.join(self._output_dir, 'Attachments', self._html_file_name)):
-            os.makedirs(attachments_path)
+    def convert(self, source: BinaryIO, destination: str) -> 'concurrent.futures.Future[bool]':
+        """Convert the audio in source to an mp3 file at destination, using the cache if possible.
 
-    def _extract_zip(self) -> bool:
-        """Extract the zip file into a temporary directory.
+        Arguments:
+            source: BinaryIO:
+                The open audio file to read from. It's read completely before this method returns.
 
-        Extract the object's input_file into a unique temporary directory. If the extraction fails, the method returns False and skips the file.
+            destination: str:
+                The path of the mp3 file to write.
 
         Returns:
-            True if the zip file was successfully extracted, False if not.
+            A Future which is done when the mp3 file has been written. Its result is True if the audio was converted
+            and False if it was copied from the cache.
 
         """
+        data = source.read()
+        cache_path = None
+
+        if self._cache_dir is not None:
+            cache_path = os.path.join(self._cache_dir, hashlib.sha256(data).hexdigest() + '.mp3')
+
+        if self._executor is not None and not (cache_path and os.path.isfile(cache_path)):
+            return self._executor.submit(_convert_audio_to_mp3, data, destination, cache_path)
+
+        # Else
+        # If it's already in the cache or there's no pool, do it now and return a Future that's already done
+        future: 'concurrent.futures.Future[bool]' = concurrent.futures.Future()
+
         try:
-            with zipfile.ZipFile(self._input_file) as zip_file:
-                zip_file.extractall(self._temp_directory)
+            if cache_path and os.path.isfile(cache_path):
+                shutil.copyfile(cache_path, destination)
+                future.set_result(False)
+            else:
+                future.set_result(_convert_audio_to_mp3(data, destination, cache_path))
+        except Exception as e:
+            future.set_exception(e)
 
-            return True
+        return future
 
-        except OSError:  # If the zip file failed to extract
-            print(f'ERROR: Failed to extract {self._input_file}. It likely does not exist. This chat will be skipped.')
-            return False
+    def shutdown(self) -> None:
+        """Wait for all conversions to finish and shut down the pool of processes."""
+        if self._executor is not None:
+            self._executor.shutdown()
 
-    def _write_text(self) -> None:
-        """Write the contents of temp/_chat.txt to the output directory."""
-        with open(os.path.join(self._temp_directory, '_chat.txt'), 'r', encoding='utf-8') as f:
-            # Read file and remove LRM, LRE, and PDF Unicode characters
-            chat_txt = f.read().replace('\u200e', '').replace('\u202a', '').replace('\u202c', '')
 
-        # Add number to the end of the filename if the file already exists
-        html_filename_with_directory_no_ext = os.path.join(self._output_dir, self._html_file_name)
-        if not os.path.isfile(html_filename_with_directory_no_ext + '.html'):
-            html_file = open(html_filename_with_directory_no_ext + '.html', 'w+', encoding='utf-8')
-        else:
-            same_name_number = 1
+class AttachmentStore:
+    """The class for a content-addressed store of attachment files, which deduplicates them across chats.
 
-            while os.path.isfile(html_filename_with_directory_no_ext + f' ({same_name_number}).html'):
-                same_name_number += 1
+    Every file in the store is named after the SHA-256 hash of its contents, so the same forwarded video or sticker
+    is only stored once, however many chats it's in. Each chat's Attachments folder has a hard link to the stored file
+    under the attachment's original name, or a copy if hard links aren't supported.
 
-            html_file = open(html_filename_with_directory_no_ext + f' ({same_name_number}).html', 'w+', encoding='utf-8')
+    It's safe for many threads and processes to use stores in the same directory at the same time.
 
-        start_template = open('start_template.txt', 'r', encoding='utf-8').readlines()  # .readlines() preserves \n characters
+    Methods:
+        add(source: BinaryIO, destination: str) -> bool:
+            Store the contents of source and link destination to it.
 
-        # Replace chat title in start template
-        for line in start_template:
-            if '%chat_title%' in line:
-                line = line.replace('%chat_title%', self._chat_title)
+        add_file(path: str) -> bool:
+            Store the file at path and replace it with a link to the stored file.
 
-            html_file.write(line)
+    """
 
-        # Use a re.sub to place LRMs between each message and then create a list by splitting by LRM
-        chat_txt = re.sub(r'\n\[(?=\d{2}/\d{2}/\d{4}, (\d{1,2}:\d{2}:\d{2} [ap]m|\d{2}:\d{2}:\d{2})])', '\u200e[', chat_txt)
-        chat_txt_list = chat_txt.split('\u200e')
+    def __init__(self, store_dir: str):
+        """Create an AttachmentStore in store_dir, which will be created if it doesn't exist."""
+        self._store_dir = store_dir
+        os.makedirs(self._store_dir, exist_ok=True)
 
-        date_separator = ''
+    def _link(self, stored_path: str, destination: str) -> None:
+        """Make destination a hard link to stored_path, or a copy of it if hard links aren't supported."""
+        if os.path.lexists(destination):
+            os.remove(destination)
 
-        # === Write every message
+        try:
+            os.link(stored_path, destination)
+        except OSError:
+            shutil.copyfile(stored_path, destination)
 
-        for raw_message in chat_txt_list:
-            # If it's the notice that messages are encrypted, skip it
-            if re.match(Message.encrypted_messages_notice_pattern, raw_message):
-                continue
+    def _store_temp_file(self, temp_path: str, sha256_hash: str, extension: str) -> Tuple[str, bool]:
+        """Move a temporary file in the store to its hashed name, or delete it if that's already stored.
 
-            msg = Message(raw_message, self._group_chat, self._html_file_name)
+        Returns:
+            A tuple of the path of the stored file and True if it was newly stored, False if it was already there.
 
-            if msg.date != date_separator:
-                date_separator = msg.date
-                html_file.write(f'<div class="date-separator">{date_separator}</div>\n\n')
+        """
+        stored_path = os.path.join(self._store_dir, sha256_hash + extension)
 
-            html_file.write(msg.create_html(self._sender_name))
+        if os.path.isfile(stored_path):
+            os.remove(temp_path)
+            return stored_path, False
 
-        end_template = open('end_template.txt', 'r', encoding='utf-8')
+        # Linking fails instead of replacing the file if another thread has stored the same file in the meantime,
+        # so a stored file keeps its inode and the chats already linked to it stay linked
+        try:
+            os.link(temp_path, stored_path)
+        except FileExistsError:
+            os.remove(temp_path)
+            return stored_path, False
+        except OSError:
+            # Hard links aren't supported, so the file can only be moved into place
+            os.replace(temp_path, stored_path)
+            return stored_path, True
 
-        for line in end_template:
-            html_file.write(line)
+        os.remove(temp_path)
+        return stored_path, True
 
-        html_file.close()
+    def add(self, source: BinaryIO, destination: str) -> bool:
+        """Store the contents of source and link destination to it.
 
-        os.remove(os.path.join(self._temp_directory, '_chat.txt'))
+        The contents are hashed while they're copied into the store, so source is only read once.
 
-    def _move_attachment_files(self) -> None:
-        """Move the attachment files in temp to the output directory."""
-        files = os.listdir(self._temp_directory)
-        for f in files:
-            if f != '_chat.txt':
-                try:
-                    # Get the file type and the name without an extension
-                    file_match = re.match(Chat.attachment_file_pattern, f)
-                    if file_match is None:
-                        raise BadFormatError('Failed to match format of attachment file.')
-
-                    file_type = file_match.group(2)
-
-                    f_no_ext = os.path.splitext(f)[0]
-
-                    if file_type == 'AUDIO':
-                        # Convert audio files that can't be played in browsers with simple HTML audio tags
-                        # This is necessary because all voice messages are .opus, which must be converted
-                        if file_type not in Message.html_audio_formats.keys():
-                            # Convert old audio file into .mp3 in same directory
-                            AudioSegment.from_file(os.path.join(self._temp_directory, f)).export(
-                                os.path.join(self._temp_directory, f_no_ext) + '.mp3', format='mp3')
-
-                            # Remove old audio file
-                            os.remove(os.path.join(self._temp_directory, f))
-                            # Set f to new file to make moving the new file easier
-                            f = f_no_ext + '.mp3'
-                except AttributeError:  # File is named weird and doesn't match the RegEx
-                    pass
-
-                os.rename(os.path.join(self._temp_directory, f), os.path.join(self._output_dir, 'Attachments', self._html_file_name, f))
-
-    def _start_formatting_threads(self) -> None:
-        """Start two threads to fully format the chat after it's been extracted."""
-        self._write_text_thread.start()
-        self._move_attachment_files_thread.start()
-
-    def format(self) -> None:
-        """Fully extract the zip file and format the chat."""
-        self._extract_zip()
-        self._start_formatting_threads()
-
-        # Wait until directory is empty, then rmdir it
-        while len(os.listdir(self._temp_directory)) > 0:
-            pass
+        Arguments:
+            source: BinaryIO:
+                The open file to store. It can be a member of a zip file.
 
-        os.rmdir(self._temp_directory)
+            destination: str:
+                The path in a chat's Attachments folder to link to the stored file.
 
+        Returns:
+            True if the contents were newly stored, False if they were already in the store.
 
-def process_chat(input_file: str, group_chat: bool, sender_name: str, chat_title: str, html_file_name: str, output_dir: str) -> None:
-    """Process one chat completely.
+        """
+        sha256 = hashlib.sha256()
+        file_descriptor, temp_path = tempfile.mkstemp(dir=self._store_dir, suffix='.tmp')
 
-    This function also checks that all arguments are of the right type before using them. If they're not, raise TypeError.
+        with os.fdopen(file_descriptor, 'wb') as temp_file:
+            while chunk := source.read(1024 * 1024):
+                sha256.update(chunk)
+                temp_file.write(chunk)
 
-    Arguments:
-        input_file: str:
-            The original zip file of the exported chat. It must have '.zip' on the end.
+        # Temporary files are only readable by their owner, but attachments need to be readable like any other file
+        os.chmod(temp_path, 0o644)
 
-        group_chat: bool:
-            A boolean to determine whether the chat is a group chat.
+        stored_path, newly_stored = self._store_temp_file(temp_path, sha256.hexdigest(), os.path.splitext(destination)[1])
+        self._link(stored_path, destination)
 
-        sender_name: str:
-            The name of the sender in the chat. Typically the user's WhatsApp alias.
+        return newly_stored
 
-        chat_title: str:
-            The title of the chat. This appears in the top bar and in the browser tab. It is not the file name.
+    def add_file(self, path: str) -> bool:
+        """Store the file at path and replace it with a link to the stored file.
 
-        html_file_name: str:
-            The intended name of the final HTML file.
+        Returns:
+            True if the file was newly stored, False if it was already in the store.
 
-        output_dir: str:
-            The intended directory for the output. The HTML file, Attachments folder, and Library folder will go here.
+        """
+        sha256 = hashlib.sha256()
 
-    Raises:
-        TypeError:
-            If the arguments aren't all of the correct type.
+        with open(path, 'rb') as f:
+            while chunk := f.read(1024 * 1024):
+                sha256.update(chunk)
 
-    """
-    args = [input_file, group_chat, sender_name, chat_title, html_file_name, output_dir]
+        # Move the file into the store directory first, so that it's renamed on the same filesystem
+        file_descriptor, temp_path = tempfile.mkstemp(dir=self._store_dir, suffix='.tmp')
+        os.close(file_descriptor)
+        os.replace(path, temp_path)
 
-    arg_types = [type(x) for x in args]
-    printable_arg_types = '[' + ', '.join([str(x)[8:-2] for x in arg_types]) + ']'
+        stored_path, newly_stored = self._store_temp_file(temp_path, sha256.hexdigest(), os.path.splitext(path)[1])
+        self._link(stored_path, path)
 
-    required_types = [str, bool, str, str, str, str]
-    printable_required_types = '[' + ', '.join([str(x)[8:-2] for x in required_types]) + ']'
+        return newly_stored
 
-    # If all the arguments are of the correct type, format the chat
-    if arg_types == required_types:
-        chat = Chat(input_file, group_chat, sender_name, chat_title, html_file_name, output_dir)
-        chat.format()
-    else:
-        raise TypeError(f'Expected arg types of {printable_required_types}. Got {printable_arg_types} instead.')
 
+class ParsedMessageCache:
+    """The class for a cache of the parsed messages of a chat, so that a chat which is formatted again isn't parsed again.
 
-def process_list_of_chats(list_of_chats: List[Tuple[str, bool, str, str, str, str]]) -> List[Tuple[str, bool, str, str, str, str]]:
-    """Fully format a list of tuples, where each tuple is a list of arguments to be passed to process_chat().
+    Each chat is kept in its own SQLite database, named after the CRC-32 and the size of its _chat.txt, which are
+    read from the zip file without reading the chat. Messages are kept as the tuples from Message.parsed, with their
+    senders in a table of their own. Nothing that depends on the sender name, the chat title or the HTML file name is
+    cached, so formatting the same export again with any of those changed reads the cache instead of parsing it all.
 
-    Returns:
-        rejected_chats:
-            A list of all the argument tuples that couldn't be processed properly. It is an empty list if no tuples failed.
+    The database is written to a temporary file which is renamed when it's complete, so it's safe for many threads
+    and processes to use caches in the same directory at the same time.
+
+    Methods:
+        exists() -> bool:
+            Return True if the chat is in the cache.
+
+        read() -> Iterator[tuple]:
+            Yield the parsed messages of the chat from the cache, in order.
+
+        add(msg: Message):
+            Add the next message of the chat to the cache that's being written.
+
+        commit():
+            Finish writing the cache, so that later runs can read it.
+
+        discard():
+            Delete the cache that's being written, if it hasn't been committed.
 
     """
-    rejected_chats = []
 
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        # Create a dictionary with the Future object of the method call as the key and the list of args as the value
-        # This allows us to return the args of the rejected chats
-        futures = {executor.submit(process_chat, *chat_data): chat_data for chat_data in list_of_chats}
+    format_version = 1  # This is part of the name of every database, so it must change whenever Message.parsed changes
 
-        for future in concurrent.futures.as_completed(futures):
-            try:
-                future.result()
-            except TypeError:
-                # Get the value from the dictionary using the Future object as the key
-                # This is the arguments passed
-                rejected_chats.append(futures[future])
+    write_batch_size = 10000  # The number of messages inserted into the database at once
 
-    return rejected_chats
+    def __init__(self, cache_dir: str, input_file: str):
+        """Create a ParsedMessageCache for the chat in input_file, keeping it in cache_dir.
+
+        Arguments:
+            cache_dir: str:
+                The directory to keep the databases in. It will be created if it doesn't exist.
+
+            input_file: str:
+                The zip file of the exported chat.
+
+        """
+        self._cache_dir = cache_dir
+        os.makedirs(self._cache_dir, exist_ok=True)
+
+        with zipfile.ZipFile(input_file) as zip_file:
+            info = zip_file.getinfo('_chat.txt')
+
+        self.path = os.path.join(self._cache_dir, f'{info.CRC:08x}-{info.file_size}-v{ParsedMessageCache.format_version}.sqlite')
+
+        # These are only used while the cache is being written
+        self._connection: Optional[sqlite3.Connection] = None
+        self._temp_path = ''
+        self._sender_ids: Dict[str, int] = {}
+        self._rows: List[tuple] = []
+
+    def exists(self) -> bool:
+        """Return True if the chat is in the cache."""
+        return os.path.isfile(self.path)
+
+    def read(self) -> Iterator[Tuple[int, str, Optional[str], str]]:
+        """Yield the parsed messages of the chat from the cache, in order, to be passed to Message.from_parsed().
+
+        The messages are read from the database as they're needed, so memory use doesn't grow with the size of the chat.
+        """
+        connection = sqlite3.connect(self.path)
+
+        try:
+            senders = {sender_id: sys.intern(name) for sender_id, name in connection.execute('SELECT id, name FROM senders')}
+            senders[None] = ''
+
+            for timestamp, sender_id, attachment, content in connection.execute(
+                    'SELECT timestamp, sender, attachment, content FROM messages ORDER BY id'):
+                yield timestamp, senders[sender_id], attachment, content
+        finally:
+            connection.close()
+
+    def _start_writing(self) -> None:
+        """Create the temporary database that the messages are written to."""
+        file_descriptor, self._temp_path = tempfile.mkstemp(dir=self._cache_dir, suffix='.tmp')
+        os.close(file_descriptor)
+
+        # The database is only used once it's been renamed, so it doesn't need a journal or to wait for the disk
+        self._connection = sqlite3.connect(self._temp_path)
+        self._connection.execute('PRAGMA journal_mode = OFF')
+        self._connection.execute('PRAGMA synchronous = OFF')
+        self._connection.execute('CREATE TABLE senders (id INTEGER PRIMARY KEY, name TEXT NOT NULL)')
+        self._connection.execute('CREATE TABLE messages (id INTEGER PRIMARY KEY, timestamp INTEGER NOT NULL, '
+                                 'sender INTEGER REFERENCES senders (id), attachment TEXT, content TEXT NOT NULL)')
+
+    def _write_rows(self) -> None:
+        """Insert the messages that have been added since the last time into the database."""
+        self._connection.executemany('INSERT INTO messages (timestamp, sender, attachment, content) VALUES (?, ?, ?, ?)',
+                                     self._rows)
+        self._rows = []
+
+    def add(self, msg: Message) -> None:
+        """Add the next message of the chat to the cache that's being written. Messages must be added in order."""
+        if self._connection is None:
+            self._start_writing()
+
+        timestamp, name, attachment, content = msg.parsed
+        sender_id = None
+
+        if name:
+            sender_id = self._sender_ids.get(name)
+
+            if sender_id is None:
+                sender_id = self._sender_ids[name] = len(self._sender_ids)
+                self._connection.execute('INSERT INTO senders (id, name) VALUES (?, ?)', (sender_id, name))
+
+        self._rows.append((timestamp, sender_id, attachment, content))
+
+        if len(self._rows) >= ParsedMessageCache.write_batch_size:
+            self._write_rows()
+
+    def commit(self) -> None:
+        """Finish writing the cache and rename it, so that later runs can read it."""
+        if self._connection is None:
+            self._start_writing()
+
+        self._write_rows()
+        self._connection.commit()
+        self._connection.close()
+        self._connection = None
+
+        # If another thread cached the same chat in the meantime, this just replaces it with an identical database
+        os.replace(self._temp_path, self.path)
+        self._temp_path = ''
+
+    def discard(self) -> None:
+        """Delete the cache that's being written, if it hasn't been committed. This does nothing if it has been."""
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+        if self._temp_path:
+            os.remove(self._temp_path)
+            self._temp_path = ''
+
+
+class SearchIndex:
+    """The class that writes the search index of one chat, which is used by Library/search.html.
+
+    The index is an inverted index of the words in the messages and the names of their senders. It's split into shards
+    of one calendar month, so the search page only has to load the months that have every word it's looking for.
+    Everything is written as JavaScript files, because browsers don't let pages read JSON files from the filesystem.
+
+    The files of a chat are in Search/<chat>/ in the output directory:
+        terms.js has every word in the chat and the shards it's in.
+        <yyyy-mm>.js has the messages in that month and the words in each of them.
+        info.json has the details of the chat and is used to write Search/chats.js, the list of every indexed chat.
+
+    Everything is written to a temporary directory in Search/, which only replaces the chat's directory when the index
+    is closed, so the index of a chat that fails or is cancelled is left as it was.
+
+    Methods:
+        next_anchor(msg: Message) -> str:
+            Return the id of the HTML element for the next message, which the search page links to.
+
+        add(msg: Message, anchor: str, page_file: str):
+            Add a message to the index.
+
+        close():
+            Write the rest of the index, replace the chat's directory with it, and update the list of every indexed chat.
+
+        discard():
+            Delete the new index if it wasn't closed, leaving the chat's directory as it was.
+
+        has_chat(output_dir: str, html_file: str) -> bool:
+            Return True if the chat with this HTML file has a search index in output_dir.
+
+    """
+
+    token_pattern = re.compile(r'\w+')
+
+    snippet_length = 200  # The number of characters of each message that are shown in the search results
+
+    def __init__(self, output_dir: str, html_file: str, chat_title: str, append: bool = False):
+        """Create a SearchIndex for a chat.
+
+        Arguments:
+            output_dir: str:
+                The output directory of the chat, which the Search directory goes in.
+
+            html_file: str:
+                The HTML file of the chat, or the index of its pages. The chat's directory in Search is named after it.
+
+            chat_title: str:
+                The title of the chat.
+
+        Keyword arguments:
+            append:
+                A boolean which is false if not specified. If true, the messages are added to a copy of the existing
+                index of the chat, because they're being appended to its HTML file. If false, any existing index is
+                replaced.
+
+        """
+        self._search_dir = os.path.join(output_dir, 'Search')
+        self._chat_key = os.path.splitext(os.path.basename(html_file))[0]
+        self._chat_dir = os.path.join(self._search_dir, self._chat_key)
+
+        self._info = {'title': chat_title, 'file': os.path.basename(html_file), 'first': '', 'last': '',
+                      'shards': [], 'anchor_time': '', 'anchor_count': 0}
+
+        # Every word and the names of the shards that it's in
+        self._terms: Dict[str, List[str]] = {}
+
+        # The shard that messages are being added to
+        self._shard_name = ''
+        self._shard_messages: List[list] = []
+        self._shard_terms: Dict[str, List[int]] = {}
+
+        # The name starts with a dot so that update_chat_list() doesn't list it as a chat
+        os.makedirs(self._search_dir, exist_ok=True)
+        self._temp_dir = tempfile.mkdtemp(prefix=f'.{self._chat_key}-', dir=self._search_dir)
+        os.chmod(self._temp_dir, 0o755)  # mkdtemp makes directories that only their owner can read
+
+        if append and os.path.isfile(os.path.join(self._chat_dir, 'info.json')):
+            shutil.copytree(self._chat_dir, self._temp_dir, dirs_exist_ok=True)
+
+            with open(os.path.join(self._temp_dir, 'info.json'), 'r', encoding='utf-8') as f:
+                self._info = json.load(f)
+
+            self._terms = self._read_js(os.path.join(self._temp_dir, 'terms.js'))
+
+    @staticmethod
+    def has_chat(output_dir: str, html_file: str) -> bool:
+        """Return True if the chat with this HTML file has a search index in output_dir."""
+        chat_key = os.path.splitext(os.path.basename(html_file))[0]
+        return os.path.isfile(os.path.join(output_dir, 'Search', chat_key, 'info.json'))
+
+    @staticmethod
+    def _write_js(path: str, function: str, *args) -> None:
+        """Write a JavaScript file that calls a function of the search page with args, with the last one on its own line."""
+        first_args = ''.join(json.dumps(arg, ensure_ascii=False) + ', ' for arg in args[:-1])
+        data = json.dumps(args[-1], ensure_ascii=False, separators=(',', ':'))
+
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(f'WhatsAppSearch.{function}({first_args}\n{data}\n);\n')
+
+    @staticmethod
+    def _read_js(path: str):
+        """Return the data in a JavaScript file written by _write_js()."""
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.loads(f.read().split('\n')[1])
+
+    def next_anchor(self, msg: Message) -> str:
+        """Return the id of the HTML element for the next message, which the search page links to.
+
+        The id is the time of the message and how many messages were sent before it in the same second, so it stays
+        the same when more messages are appended to the chat.
+        """
+        message_time = f'{msg.datetime_obj:%Y%m%d%H%M%S}'
+
+        if message_time == self._info['anchor_time']:
+            self._info['anchor_count'] += 1
+        else:
+            self._info['anchor_time'] = message_time
+            self._info['anchor_count'] = 0
+
+        return f'm{message_time}-{self._info["anchor_count"]}'
+
+    def _start_shard(self, shard_name: str) -> None:
+        """Write the current shard and start the shard with the given name, loading it if it already exists."""
+        self._write_shard()
+
+        self._shard_name = shard_name
+        self._shard_messages = []
+        self._shard_terms = {}
+
+        if shard_name in self._info['shards']:
+            shard = self._read_js(os.path.join(self._temp_dir, shard_name + '.js'))
+            self._shard_messages = shard['messages']
+            self._shard_terms = shard['terms']
+        else:
+            self._info['shards'].append(shard_name)
+
+    def _write_shard(self) -> None:
+        """Write the current shard, if there is one."""
+        if self._shard_name:
+            self._write_js(os.path.join(self._temp_dir, self._shard_name + '.js'), 'shardLoaded', self._chat_key,
+                           self._shard_name, {'messages': self._shard_messages, 'terms': self._shard_terms})
+
+    def add(self, msg: Message, anchor: str, page_file: str) -> None:
+        """Add a message to the index.
+
+        Arguments:
+            msg: Message:
+                The message to add. Messages must be added in the order they were sent.
+
+            anchor: str:
+                The id of the message's HTML element, from next_anchor().
+
+            page_file: str:
+                The name of the HTML file that the message is in.
+
+        """
+        shard_name = f'{msg.datetime_obj:%Y-%m}'
+        if shard_name != self._shard_name:
+            self._start_shard(shard_name)
+
+        text = msg.plain_text
+        message_number = len(self._shard_messages)
+        self._shard_messages.append([anchor, page_file, msg.name, msg.date, msg.time, text[:SearchIndex.snippet_length]])
+
+        # Each word is only added once, in the order it's first used, so the index is the same every time it's written
+        for token in dict.fromkeys(re.findall(SearchIndex.token_pattern, f'{msg.name} {text}'.lower())):
+            self._shard_terms.setdefault(token, []).append(message_number)
+
+            shards = self._terms.setdefault(token, [])
+            if not shards or shards[-1] != shard_name:
+                shards.append(shard_name)
+
+        self._info['first'] = self._info['first'] or msg.date
+        self._info['last'] = msg.date
+
+    def close(self) -> None:
+        """Write the rest of the index, replace the chat's directory with it, and update the list of every indexed chat."""
+        self._write_shard()
+        self._write_js(os.path.join(self._temp_dir, 'terms.js'), 'termsLoaded', self._chat_key, self._terms)
+
+        with open(os.path.join(self._temp_dir, 'info.json'), 'w', encoding='utf-8') as f:
+            json.dump(self._info, f)
+
+        # A directory can't be renamed over one that isn't empty, so the old one is moved out of the way first
+        old_dir = self._temp_dir + '-old'
+        if os.path.isdir(self._chat_dir):
+            os.rename(self._chat_dir, old_dir)
+
+        os.rename(self._temp_dir, self._chat_dir)
+        self._temp_dir = None
+
+        if os.path.isdir(old_dir):
+            shutil.rmtree(old_dir)
+
+        SearchIndex.update_chat_list(os.path.dirname(self._search_dir))
+
+    def discard(self) -> None:
+        """Delete the new index if it wasn't closed, leaving the chat's directory as it was."""
+        if self._temp_dir is not None and os.path.isdir(self._temp_dir):
+            shutil.rmtree(self._temp_dir)
+
+        self._temp_dir = None
+
+    @staticmethod
+    def update_chat_list(output_dir: str) -> None:
+        """Write Search/chats.js in output_dir, which lists every chat that has a search index there.
+
+        Chats in other threads and processes may be doing this at the same time, so it's written to a temporary file
+        and renamed, and then it's written again if the list of chats changed in the meantime.
+        """
+        search_dir = os.path.join(output_dir, 'Search')
+
+        written_chats = None
+        while True:
+            chats = []
+            for chat_key in sorted(os.listdir(search_dir)):
+                # The directories of indexes that are still being written start with a dot
+                if chat_key.startswith('.'):
+                    continue
+
+                info_path = os.path.join(search_dir, chat_key, 'info.json')
+
+                if os.path.isfile(info_path):
+                    with open(info_path, 'r', encoding='utf-8') as f:
+                        info = json.load(f)
+
+                    chats.append({'key': chat_key, 'title': info['title'], 'file': info['file'],
+                                  'first': info['first'], 'last': info['last'], 'shards': info['shards']})
+
+            if chats == written_chats:
+                return
+
+            file_descriptor, temp_path = tempfile.mkstemp(dir=search_dir, suffix='.tmp')
+            os.close(file_descriptor)
+            os.chmod(temp_path, 0o644)  # mkstemp makes files that only their owner can read
+
+            SearchIndex._write_js(temp_path, 'chatsLoaded', chats)
+            os.replace(temp_path, os.path.join(search_dir, 'chats.js'))
+
+            written_chats = chats
+
+
+class BlockWriter:
+    """A class to collect strings in memory and write them to a text file in large blocks.
+
+    Writing every message separately means a system call for every few hundred bytes, which is slow on network
+    filesystems. This joins the strings together and only writes when there's at least buffer_size characters.
+
+    Methods:
+        write(text: str):
+            Add text to the buffer, and write the buffer to the file if it's full.
+
+        flush():
+            Write everything in the buffer to the file. This must be called after the last write().
+
+    """
+
+    def __init__(self, file: TextIO, buffer_size: int = 1024 * 1024):
+        """Create a BlockWriter for an open text file.
+
+        Arguments:
+            file: TextIO:
+                The open text file to write to.
+
+        Keyword arguments:
+            buffer_size:
+                The number of characters to collect before writing them to the file. 1 MiB if not specified.
+
+        """
+        self._file = file
+        self._buffer_size = buffer_size
+
+        self._buffer: List[str] = []
+        self._buffered_length = 0
+
+    def write(self, text: str) -> None:
+        """Add text to the buffer, and write the buffer to the file if it's full."""
+        self._buffer.append(text)
+        self._buffered_length += len(text)
+
+        if self._buffered_length >= self._buffer_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write everything in the buffer to the file. This must be called after the last write()."""
+        if self._buffer:
+            self._file.write(''.join(self._buffer))
+            self._buffer.clear()
+            self._buffered_length = 0
+
+
+class OutputBackend(abc.ABC):
+    """The base class for everything that Chat writes the formatted messages of a chat to.
+
+    Chat gives every message to each of its backends in order, commits them all if every message was written, and
+    then closes them all, even if formatting stopped early. A new kind of output only needs a subclass with
+    write_message() and close(), and a subclass without either of them can't be created.
+
+    Methods:
+        write_message(msg: Message, html: str):
+            Write one message. html is its rendered HTML, which backends that don't write HTML can ignore.
+
+        commit():
+            Keep everything that was written, because every message of the chat was written.
+
+        close():
+            Finish writing everything. No more messages are written after this.
+
+    """
+
+    @abc.abstractmethod
+    def write_message(self, msg: Message, html: str) -> None:
+        """Write one message. html is its rendered HTML, which backends that don't write HTML can ignore."""
+
+    def commit(self) -> None:
+        """Keep everything that was written, because every message of the chat was written. This does nothing here."""
+
+    @abc.abstractmethod
+    def close(self) -> None:
+        """Finish writing everything. No more messages are written after this."""
+
+
+class HTMLBackend(OutputBackend):
+    """The OutputBackend that writes rendered messages to one HTML file, or to several pages with an index.
+
+    Every page is written as its messages arrive, and only one page is open at a time.
+
+    Methods:
+        write_message(msg: Message, html: str):
+            Write a message and its HTML, adding a date separator and starting a new page if needed.
+
+        close():
+            Finish the current page and write the index of pages.
+
+        state() -> dict:
+            Return a dictionary that can be saved as JSON and passed back as resume_state to append to this output later.
+
+    """
+
+    def __init__(self, path_no_ext: str, chat_title: str, page_size: int = 0, page_by_month: bool = False,
+                 resume_state: Optional[dict] = None, template_dir: Optional[str] = None):
+        """Create an HTMLBackend and open the first file.
+
+        Arguments:
+            path_no_ext: str:
+                The path of the HTML file without '.html'. Pages are named after this too.
+
+            chat_title: str:
+                The title of the chat.
+
+        Keyword arguments:
+            page_size:
+                The maximum number of messages on each page. It's 0 if not specified, which means no maximum.
+
+            page_by_month:
+                A boolean which is false if not specified. If true, each calendar month starts a new page.
+
+            If page_size and page_by_month are both left out, everything is written to one file.
+
+            resume_state:
+                A dictionary from state() after a previous close(). If given, the last file is reopened and new messages
+                are appended to it, just before its navigation links and end template.
+
+            template_dir:
+                The directory with start_template.txt and end_template.txt. The working directory if not specified.
+
+        """
+        self._path_no_ext = path_no_ext
+        self._template_dir = template_dir or ''
+        self._chat_title = chat_title
+        self._page_size = page_size
+        self._page_by_month = page_by_month
+        self._paged = page_size > 0 or page_by_month
+
+        self.index_file = path_no_ext + '.html'
+        self.page_files: List[str] = []
+
+        # The number of bytes written to all the files, not counting anything that was there before
+        self.bytes_written = 0
+        self._start_offset = 0
+
+        # Tuples of the first date, last date, and number of messages of every page
+        self._page_summaries: List[Tuple[str, str, int]] = []
+
+        self._file: Optional[TextIO] = None
+        self._writer: Optional[BlockWriter] = None
+        self._date_separator = ''
+        self._month: Tuple[int, int] = (0, 0)
+
+        # The byte offset in the last file where its navigation links and end template start
+        self._tail_offset = 0
+
+        if resume_state is not None:
+            self._resume(resume_state)
+        elif not self._paged:
+            self._open_file(self.index_file, self._chat_title)
+
+    def _resume(self, state: dict) -> None:
+        """Reopen the last file from a previous run and remove its tail so that new messages can be appended."""
+        directory = os.path.dirname(self._path_no_ext)
+
+        self.page_files = [os.path.join(directory, page_file) for page_file in state['page_files']]
+        self._page_summaries = [tuple(summary) for summary in state['page_summaries']]
+        self._month = tuple(state['month'])
+        self._date_separator = state['date_separator']
+
+        if self._paged and not self.page_files:
+            return
+
+        path = self.page_files[-1] if self._paged else self.index_file
+
+        with open(path, 'r+b') as f:
+            f.truncate(state['tail_offset'])
+
+        self._file = open(path, 'a', encoding='utf-8')
+        self._writer = BlockWriter(self._file)
+        self._start_offset = state['tail_offset']
+
+    def _mark_tail(self) -> None:
+        """Remember where the tail of the open file starts, so that it can be removed to append to the file later."""
+        self._writer.flush()
+        self._file.flush()
+        self._tail_offset = self._file.buffer.tell()
+
+    def _page_path(self, page_number: int) -> str:
+        """Return the path of the page with the given number, starting at 1."""
+        return f'{self._path_no_ext}_page_{page_number}.html'
+
+    def _link(self, path: str, text: str) -> str:
+        """Return an <a> tag linking to path from another file in the same directory."""
+        return f'<a href="{urllib.parse.quote(os.path.basename(path))}">{text}</a>'
+
+    def _navigation(self, page_number: int, has_next_page: bool) -> str:
+        """Return the links to the previous and next pages and the index, for the page with the given number."""
+        links = []
+
+        if page_number > 1:
+            links.append(self._link(self._page_path(page_number - 1), 'Previous page'))
+
+        links.append(self._link(self.index_file, 'All pages'))
+
+        if has_next_page:
+            links.append(self._link(self._page_path(page_number + 1), 'Next page'))
+
+        return '<div class="page-navigation">\n\t' + '\n\t'.join(links) + '\n</div>\n\n'
+
+    def _open_file(self, path: str, title: str) -> None:
+        """Open a new HTML file and write the start template to it."""
+        self._file = open(path, 'w', encoding='utf-8')
+        self._writer = BlockWriter(self._file)
+        self._start_offset = 0
+
+        # Replace chat title in start template
+        self._writer.write(_read_template(os.path.join(self._template_dir, 'start_template.txt')).replace('%chat_title%', title))
+
+    def _close_file(self) -> None:
+        """Write the end template to the open HTML file and close it."""
+        if not self._paged:
+            self._mark_tail()
+
+        self._writer.write(_read_template(os.path.join(self._template_dir, 'end_template.txt')))
+        self._writer.flush()
+        self._file.flush()
+        self.bytes_written += self._file.buffer.tell() - self._start_offset
+        self._file.close()
+
+        self._file = None
+        self._writer = None
+
+    def _close_page(self, has_next_page: bool) -> None:
+        """Write the navigation links at the bottom of the current page and close it."""
+        self._mark_tail()
+        self._writer.write(self._navigation(len(self.page_files), has_next_page))
+        self._close_file()
+
+    def _start_page(self) -> None:
+        """Close the current page if there is one, and then open the next one."""
+        if self._writer is not None:
+            self._close_page(has_next_page=True)
+
+        self.page_files.append(self._page_path(len(self.page_files) + 1))
+        self._page_summaries.append(('', '', 0))
+
+        self._open_file(self.page_files[-1], f'{self._chat_title} - page {len(self.page_files)}')
+        self._date_separator = ''
+
+        # The next page doesn't exist yet, so the link to it is only at the bottom of the page
+        self._writer.write(self._navigation(len(self.page_files), has_next_page=False))
+
+    @property
+    def current_file(self) -> str:
+        """The name of the file that the last message was written to, without any directories."""
+        return os.path.basename(self.page_files[-1] if self._paged else self.index_file)
+
+    def write_message(self, msg: Message, html: str) -> None:
+        """Write a message and its HTML, adding a date separator and starting a new page if needed."""
+        if self._paged:
+            month = (msg.datetime_obj.year, msg.datetime_obj.month)
+
+            if self._writer is None or \
+                    (self._page_size > 0 and self._page_summaries[-1][2] >= self._page_size) or \
+                    (self._page_by_month and month != self._month):
+                self._start_page()
+
+            self._month = month
+
+            first_date, _, count = self._page_summaries[-1]
+            self._page_summaries[-1] = (first_date or msg.date, msg.date, count + 1)
+
+        if msg.date != self._date_separator:
+            self._date_separator = msg.date
+            self._writer.write(f'<div class="date-separator">{self._date_separator}</div>\n\n')
+
+        self._writer.write(html)
+
+    def close(self) -> None:
+        """Finish the current page and write the index of pages."""
+        if not self._paged:
+            self._close_file()
+            return
+
+        if self._writer is not None:
+            self._close_page(has_next_page=False)
+
+        self._open_file(self.index_file, self._chat_title)
+        self._writer.write('<div class="page-index">\n')
+
+        for page_number, (page_file, (first_date, last_date, count)) in enumerate(zip(self.page_files, self._page_summaries), 1):
+            dates = first_date if first_date == last_date else f'{first_date} - {last_date}'
+            self._writer.write(f'\t<p>{self._link(page_file, f"Page {page_number}")}: {dates} ({count} messages)</p>\n')
+
+        self._writer.write('</div>\n\n')
+        self._close_file()
+
+    def state(self) -> dict:
+        """Return a dictionary that can be saved as JSON and passed back as resume_state to append to this output later.
+
+        This must only be called after close().
+        """
+        last_file = self.page_files[-1] if self._paged and self.page_files else self.index_file
+
+        return {'page_size': self._page_size,
+                'page_by_month': self._page_by_month,
+                'page_files': [os.path.basename(page_file) for page_file in self.page_files],
+                'page_summaries': self._page_summaries,
+                'month': self._month,
+                'date_separator': self._date_separator,
+                'tail_offset': self._tail_offset,
+                'last_file_size': os.path.getsize(last_file)}
+
+    @staticmethod
+    def can_resume(path_no_ext: str, page_size: int, page_by_month: bool, state: dict) -> bool:
+        """Return True if the files described by state from a previous run are still there unchanged and use the same pages."""
+        if state['page_size'] != page_size or state['page_by_month'] != page_by_month or not os.path.isfile(path_no_ext + '.html'):
+            return False
+
+        if state['page_files']:
+            last_file = os.path.join(os.path.dirname(path_no_ext), state['page_files'][-1])
+        else:
+            last_file = path_no_ext + '.html'
+
+        return os.path.isfile(last_file) and os.path.getsize(last_file) == state['last_file_size']
+
+
+class SQLiteBackend(OutputBackend):
+    """The OutputBackend that writes messages to tables in an SQLite database, for analysing chats with SQL.
+
+    Many chats can be written to the same database, even at the same time from different threads or processes.
+    The chats table has a row for every chat, keyed by the path of its HTML file, and the messages table has a row
+    for every message, with its chat, its time in ISO format, its sender, its text without any HTML, and the name
+    and type of its attachment. Messages are indexed by chat and time, by sender, and by time.
+
+    Messages are collected in memory and inserted into the pending_messages table in one transaction for every
+    batch_size messages, so the database is only locked briefly and other chats can be written in between. They're
+    only moved to the messages table by commit(), in one transaction with replacing the chat's old messages, so a chat
+    which fails or is cancelled leaves its old messages as they were.
+
+    Methods:
+        write_message(msg: Message, html: str):
+            Add a message to the current batch, and insert the batch if it's full.
+
+        commit():
+            Replace the chat's messages with the pending ones, or add them if appending, and update the chat's row.
+
+        close():
+            Delete the pending messages if they weren't committed, and close the database.
+
+        has_chat(path: str, html_file: str) -> bool:
+            Return True if a database exists at path and has a row for the chat with this HTML file.
+
+    """
+
+    batch_size = 10000  # The number of messages inserted in each transaction
+
+    timeout = 60  # The number of seconds to wait for another connection to finish writing to the database
+
+    schema = (
+        'CREATE TABLE IF NOT EXISTS chats (id INTEGER PRIMARY KEY, html_file TEXT NOT NULL UNIQUE, title TEXT NOT NULL, '
+        'input_file TEXT NOT NULL, group_chat INTEGER NOT NULL, sender_name TEXT NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY, chat_id INTEGER NOT NULL REFERENCES chats (id), '
+        'timestamp TEXT NOT NULL, sender TEXT, text TEXT NOT NULL, attachment TEXT, attachment_type TEXT)',
+        'CREATE INDEX IF NOT EXISTS messages_chat_timestamp ON messages (chat_id, timestamp)',
+        'CREATE INDEX IF NOT EXISTS messages_sender ON messages (sender)',
+        'CREATE INDEX IF NOT EXISTS messages_timestamp ON messages (timestamp)',
+        'CREATE TABLE IF NOT EXISTS pending_messages (id INTEGER PRIMARY KEY, html_file TEXT NOT NULL, '
+        'timestamp TEXT NOT NULL, sender TEXT, text TEXT NOT NULL, attachment TEXT, attachment_type TEXT)',
+        'CREATE INDEX IF NOT EXISTS pending_messages_html_file ON pending_messages (html_file)'
+    )
+
+    def __init__(self, path: str, html_file: str, chat_title: str, input_file: str, group_chat: bool, sender_name: str,
+                 append: bool = False):
+        """Create an SQLiteBackend for one chat, creating the database and its tables if they don't exist.
+
+        Nothing in the chats or messages tables is changed until commit() is called.
+
+        Arguments:
+            path: str:
+                The path of the database file.
+
+            html_file: str:
+                The path of the HTML file of the chat, which identifies the chat in the database.
+
+            chat_title: str:
+                The title of the chat.
+
+            input_file: str:
+                The zip file of the exported chat.
+
+            group_chat: bool:
+                A boolean representing whether the chat is a group chat.
+
+            sender_name: str:
+                The name of the sender in the chat.
+
+        Keyword arguments:
+            append:
+                A boolean which is false if not specified. If true and the chat is already in the database, new messages
+                are added to the ones that are there, like an incremental run adds to its HTML. If false, the messages
+                that are there are replaced.
+
+        """
+        self._path = path
+        self._html_file = os.path.abspath(html_file)
+        self._chat_row = (chat_title, os.path.abspath(input_file), group_chat, sender_name)
+        self._append = append
+        self._rows: List[tuple] = []
+        self._committed = False
+
+        self._connection = sqlite3.connect(self._path, timeout=SQLiteBackend.timeout)
+
+        try:
+            # WAL lets the database be read while chats are being written to it
+            self._connection.execute('PRAGMA journal_mode = WAL')
+            self._connection.execute('PRAGMA synchronous = NORMAL')
+
+            with self._connection:
+                for statement in SQLiteBackend.schema:
+                    self._connection.execute(statement)
+
+                # These are left behind if a previous run of this chat was killed before it could delete them
+                self._connection.execute('DELETE FROM pending_messages WHERE html_file = ?', (self._html_file,))
+        except BaseException:
+            self._connection.close()
+            raise
+
+    @staticmethod
+    def has_chat(path: str, html_file: str) -> bool:
+        """Return True if a database exists at path and has a row for the chat with this HTML file."""
+        if not os.path.isfile(path):
+            return False
+
+        connection = sqlite3.connect(path, timeout=SQLiteBackend.timeout)
+
+        try:
+            return connection.execute('SELECT id FROM chats WHERE html_file = ?',
+                                      (os.path.abspath(html_file),)).fetchone() is not None
+        except sqlite3.DatabaseError:
+            return False
+        finally:
+            connection.close()
+
+    def _insert_rows(self) -> None:
+        """Insert the current batch of messages into pending_messages in one transaction."""
+        if self._rows:
+            with self._connection:
+                self._connection.executemany('INSERT INTO pending_messages (html_file, timestamp, sender, text, attachment, '
+                                             'attachment_type) VALUES (?, ?, ?, ?, ?, ?)', self._rows)
+
+            self._rows = []
+
+    def write_message(self, msg: Message, html: str) -> None:
+        """Add a message to the current batch, and insert the batch if it's full."""
+        self._rows.append((self._html_file, msg.datetime_obj.isoformat(' '), msg.name or None, msg.plain_text,
+                           msg.attachment, msg.attachment_type))
+
+        if len(self._rows) >= SQLiteBackend.batch_size:
+            self._insert_rows()
+
+    def commit(self) -> None:
+        """Replace the chat's messages with the pending ones, or add them if appending, and update the chat's row."""
+        self._insert_rows()
+
+        with self._connection:
+            row = self._connection.execute('SELECT id FROM chats WHERE html_file = ?', (self._html_file,)).fetchone()
+
+            if row is None:
+                chat_id = self._connection.execute(
+                    'INSERT INTO chats (title, input_file, group_chat, sender_name, html_file) VALUES (?, ?, ?, ?, ?)',
+                    self._chat_row + (self._html_file,)).lastrowid
+            else:
+                chat_id = row[0]
+                self._connection.execute('UPDATE chats SET title = ?, input_file = ?, group_chat = ?, sender_name = ? '
+                                         'WHERE id = ?', self._chat_row + (chat_id,))
+
+                if not self._append:
+                    self._connection.execute('DELETE FROM messages WHERE chat_id = ?', (chat_id,))
+
+            self._connection.execute('INSERT INTO messages (chat_id, timestamp, sender, text, attachment, attachment_type) '
+                                     'SELECT ?, timestamp, sender, text, attachment, attachment_type FROM pending_messages '
+                                     'WHERE html_file = ? ORDER BY id', (chat_id, self._html_file))
+            self._connection.execute('DELETE FROM pending_messages WHERE html_file = ?', (self._html_file,))
+
+        self._committed = True
+
+    def close(self) -> None:
+        """Delete the pending messages if they weren't committed, and close the database."""
+        try:
+            if not self._committed:
+                with self._connection:
+                    self._connection.execute('DELETE FROM pending_messages WHERE html_file = ?', (self._html_file,))
+        finally:
+            self._connection.close()
+
+
+class Chat:
+    """The class for each chat to be formatted. Every instance is a separate chat.
+
+    Methods:
+        format():
+            Fully format the chat, reading it straight from the zip file or extracting it first.
+
+    """
+
+    attachment_file_pattern = re.compile(r'(\d{8}-(\w+)-\d{4}-\d{2}-\d{2}-\d{2}-\d{2}-\d{2})(\.\w+)$')
+    # Groups: filename without extension is 1, file type is 2, extension is 3
+
+    render_chunk_size = 5000  # The number of messages sent to each render worker at once
+
+    state_directory = '.formatter_state'  # The directory in output_dir where incremental runs keep their state
+
+    thumbnail_size = (800, 400)  # The maximum width and height of thumbnails, which is the size that images are shown at
+
+    progress_interval = 1000  # The number of messages between each progress event and check for cancellation
+
+    def __init__(self, input_file: str, group_chat: bool, sender_name: str, chat_title: str, html_file_name: str, output_dir: str,
+                 extract_to_temp: bool = False, transcoder: Optional[AudioTranscoder] = None, render_workers: int = 0,
+                 page_size: int = 0, page_by_month: bool = False, incremental: bool = False, dedupe_attachments: bool = False,
+                 thumbnails: bool = False, profile_file: Optional[str] = None,
+                 progress: Optional[Callable[[ProgressEvent], None]] = None, cancel_event=None,
+                 template_dir: Optional[str] = None, library_dir: Optional[str] = None, temp_dir: Optional[str] = None,
+                 search_index: bool = False, parse_cache_dir: Optional[str] = None, sqlite_file: Optional[str] = None):
+        """Create a Chat object with instance attributes equal to the arguments passed.
+
+        Arguments:
+            input_file:
+                The original zip file of the exported chat. It must have the '.zip' extension.
+
+            group_chat:
+                A boolean to determine whether the chat is a group chat.
+
+            sender_name:
+                The name of the sender in the chat. Typically the user's WhatsApp alias.
+
+            chat_title:
+                The title of the chat. This appears in the top bar and in the browser tab. It is not the file name.
+
+            html_file_name:
+                The intended name of the final HTML file.
+
+            output_dir:
+                The intended directory for the output. The HTML file, Attachments folder, and Library folder will go here.
+
+        Keyword arguments:
+            extract_to_temp:
+                A boolean which is false if not specified. If true, the whole zip file is extracted into a temporary
+                directory before formatting. If false, the chat text is streamed straight out of the zip file and every
+                attachment is copied directly into the Attachments folder, so nothing is written to disk twice.
+
+            transcoder:
+                The AudioTranscoder to convert audio attachments with. It can be shared with other chats. If not
+                specified, the chat creates its own without a cache and shuts it down when it's finished.
+
+            render_workers:
+                The number of processes to parse and render messages in. It's 0 if not specified, which means that every
+                message is rendered in the same thread that writes the HTML file. This is worth using for very large chats.
+
+            page_size:
+                The maximum number of messages on each page. It's 0 if not specified, which means no maximum.
+
+            page_by_month:
+                A boolean which is false if not specified. If true, each calendar month starts a new page.
+
+            If page_size or page_by_month is given, the chat is split into pages named like '<html_file_name>_page_1.html'
+            with links between them, and the HTML file is an index of all the pages.
+
+            incremental:
+                A boolean which is false if not specified. If true, the chat's state is saved in output_dir after it's
+                formatted. If there's already a state from a previous incremental run of a chat with the same
+                html_file_name, only the messages newer than that run are appended to its HTML, and only the new
+                attachments are moved.
+
+            dedupe_attachments:
+                A boolean which is false if not specified. If true, attachments are kept in an AttachmentStore in
+                Attachments/.store, shared by every chat in output_dir, and each chat's Attachments folder links to them.
+
+            thumbnails:
+                A boolean which is false if not specified. If true, thumbnails of photos and posters of videos are made in
+                a pool of threads, and the HTML shows those and only loads the full files when they're needed.
+                Thumbnails of photos need Pillow and posters of videos need ffmpeg.
+
+            profile_file:
+                A file to save a cProfile dump of formatting the chat in. A profiled chat does the text and then the
+                attachments in one thread, and waits for any other profiled chat to finish first, so that only one
+                profiler is ever active. The chat isn't profiled if not specified.
+
+            progress:
+                A function to call with a ProgressEvent when the chat starts, every progress_interval messages, after
+                every attachment, and when the chat finishes. It's called from the threads doing the work, so it must be
+                thread safe and quick.
+
+            cancel_event:
+                An object with an is_set() method, like a threading.Event. It's checked before every attachment and
+                every progress_interval messages, and once it's set, format() stops and raises FormatCancelled.
+                The temporary directory is still removed, but the output written so far is left as it is.
+
+            template_dir:
+                The directory with start_template.txt and end_template.txt. The working directory if not specified.
+
+            library_dir:
+                The Library directory to copy to output_dir. 'Library' in the working directory if not specified.
+
+            temp_dir:
+                The directory to make the temporary directory in if extract_to_temp is true. The system's temporary
+                directory if not specified.
+
+            search_index:
+                A boolean which is false if not specified. If true, write a SearchIndex of the chat for
+                Library/search.html, and give every message an id so that the search results can link to it.
+
+            parse_cache_dir:
+                The directory of a ParsedMessageCache. If the chat is in the cache, its messages are read from there
+                instead of being parsed, and if it isn't, it's added. Nothing is cached if not specified.
+
+            sqlite_file:
+                An SQLite database to write every message to with an SQLiteBackend, as well as to the HTML file.
+                Many chats can be written to the same database. Nothing is written to a database if not specified.
+
+        """
+        self._input_file = input_file
+        self._group_chat = group_chat
+        self._sender_name = sender_name
+        self._chat_title = chat_title
+        self._html_file_name = html_file_name
+        self._output_dir = output_dir
+        self._extract_to_temp = extract_to_temp
+        self._transcoder = transcoder
+        self._render_workers = render_workers
+        self._page_size = page_size
+        self._page_by_month = page_by_month
+        self._incremental = incremental
+        self._store = AttachmentStore(os.path.join(self._output_dir, 'Attachments', '.store')) if dedupe_attachments else None
+        self._thumbnails = thumbnails
+        self._profile_file = profile_file
+        self._progress = progress
+        self._cancel_event = cancel_event
+        self._template_dir = template_dir
+        self._temp_dir = temp_dir
+        self._search_index = search_index
+        self._parse_cache_dir = parse_cache_dir
+        self._sqlite_file = sqlite_file
+        self._start_time = 0.0
+        self._total_bytes = 0
+
+        # This is the state saved by a previous incremental run, if there is one
+        self._state_file = os.path.join(self._output_dir, Chat.state_directory, self._html_file_name + '.json')
+        self._previous_state: Optional[dict] = None
+        self._previous_attachment_names: Set[str] = set()
+
+        # These are recorded to save the state of an incremental run
+        self._html_state: dict = {}
+        self._last_message_time: Optional[datetime] = None
+        self._messages_at_last_time = 0
+        self._attachment_names: List[str] = []
+
+        # These are the Futures of audio files being converted by the transcoder, and the files they're converted to
+        self._audio_conversions: List[concurrent.futures.Future] = []
+        self._converted_audio_destinations: List[str] = []
+
+        # This is the pool of threads that makes thumbnails, if they're wanted, and the Futures of the thumbnails
+        self._thumbnail_executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+        self._thumbnail_futures: List[concurrent.futures.Future] = []
+
+        # This gets filled in by the formatting methods
+        self._result = FormatResult()
+
+        # The text and the attachments are done in separate threads, so they count their bytes separately
+        self._text_bytes_read = 0
+        self._text_size = 0
+        self._text_bytes_written = 0
+        self._attachment_bytes_read = 0
+        self._attachment_bytes_written = 0
+
+        # This is a unique temporary directory for this chat, to allow for multithreading multiple chats
+        # It's only made by format() if extract_to_temp is true
+        self._temp_directory = ''
+
+        # Make directories if they don't exist
+        # Other threads or processes may be making them at the same time for other chats, so existing directories are fine
+        if not os.path.isdir(library_path := os.path.join(self._output_dir, 'Library')):
+            shutil.copytree(library_dir or 'Library', library_path, dirs_exist_ok=True)
+
+        os.makedirs(os.path.join(self._output_dir, 'Attachments', self._html_file_name), exist_ok=True)
+
+    def _extract_zip(self) -> bool:
+        """Extract the zip file into a temporary directory.
+
+        Extract the object's input_file into a unique temporary directory. If the extraction fails, the method returns False and skips the file.
+
+        Returns:
+            True if the zip file was successfully extracted, False if not.
+
+        """
+        try:
+            with zipfile.ZipFile(self._input_file) as zip_file:
+                for member in zip_file.infolist():
+                    self._check_cancelled()
+                    zip_file.extract(member, self._temp_directory)
+
+            return True
+
+        except (OSError, zipfile.BadZipFile):  # If the zip file failed to extract
+            print(f'ERROR: Failed to extract {self._input_file}. It likely does not exist. This chat will be skipped.')
+            return False
+
+    def _write_text(self) -> None:
+        """Write the contents of _chat.txt to the output directory.
+
+        The chat is read and written one message at a time, so memory use doesn't grow with the size of the chat.
+        """
+        start_time = time.perf_counter()
+
+        # If this is an incremental run and the output of the previous run is still there, append to that
+        resume_state = None
+        if self._previous_state is not None:
+            previous_path_no_ext = os.path.join(self._output_dir, os.path.splitext(self._previous_state['html_file'])[0])
+
+            if HTMLBackend.can_resume(previous_path_no_ext, self._page_size, self._page_by_month, self._previous_state['html']):
+                self._result.html_file = previous_path_no_ext + '.html'
+
+                # The other outputs can only be appended to if the previous run wrote them too, so if it didn't, every
+                # output is written again with the whole chat, over the previous run's HTML file
+                if self._can_resume_outputs():
+                    resume_state = self._previous_state['html']
+
+        # Add number to the end of the filename if the file already exists
+        html_filename_with_directory_no_ext = os.path.join(self._output_dir, self._html_file_name)
+        if self._result.html_file:
+            pass
+        elif not os.path.isfile(html_filename_with_directory_no_ext + '.html'):
+            self._result.html_file = html_filename_with_directory_no_ext + '.html'
+        else:
+            same_name_number = 1
+
+            while os.path.isfile(html_filename_with_directory_no_ext + f' ({same_name_number}).html'):
+                same_name_number += 1
+
+            self._result.html_file = html_filename_with_directory_no_ext + f' ({same_name_number}).html'
+
+        # Every message is written to each of these, and the time taken by each one is recorded under its timing key
+        backends: List[Tuple[str, OutputBackend]] = []
+
+        search_index = None
+        parse_cache = None
+        cache_messages = False
+
+        # === Write every message
+
+        # The time spent in each generator includes the time spent in the generators it reads from
+        stage_times: Dict[str, float] = {}
+        write_times: Dict[str, float] = {}
+
+        try:
+            if self._search_index:
+                search_index = SearchIndex(self._output_dir, self._result.html_file, self._chat_title,
+                                           append=resume_state is not None)
+
+            # If the chat has been parsed before, read it from the cache, and if it hasn't, add it to the cache as it's
+            # parsed. The cache needs every message, so it isn't written if an incremental run is skipping the old ones
+            if self._parse_cache_dir:
+                parse_cache = ParsedMessageCache(self._parse_cache_dir, self._input_file)
+                cache_messages = not parse_cache.exists() and resume_state is None
+
+            if self._sqlite_file:
+                backends.append(('write_sqlite', SQLiteBackend(self._sqlite_file, self._result.html_file, self._chat_title,
+                                                               self._input_file, self._group_chat, self._sender_name,
+                                                               append=resume_state is not None)))
+
+            # The HTML file is opened last, so that it isn't created if any of the other outputs can't be
+            html_output = HTMLBackend(os.path.splitext(self._result.html_file)[0], self._chat_title,
+                                      page_size=self._page_size, page_by_month=self._page_by_month,
+                                      resume_state=resume_state, template_dir=self._template_dir)
+            backends.insert(0, ('write_html', html_output))
+
+            with contextlib.ExitStack() as stack:
+                if parse_cache is not None and parse_cache.exists():
+                    chat_file = None
+                    self._text_size = os.path.getsize(parse_cache.path)
+                    messages = self._render_cached_messages(parse_cache.read(), skip=resume_state is not None)
+                elif (mapped_chat := stack.enter_context(self._map_chat_file())) is not None:
+                    # Only the boundaries of the messages are found here, and each one is decoded when it's rendered
+                    chat_file = None
+                    message_ranges = _timed(self._find_message_ranges(*mapped_chat[1:]), stage_times, 'split')
+
+                    if self._incremental:
+                        message_ranges = self._skip_old_messages(
+                            message_ranges, skip=resume_state is not None,
+                            message_datetime=functools.partial(_message_range_datetime, mapped_chat[1]))
+
+                    messages = self._render_messages(message_ranges, mapped_chat=mapped_chat)
+                else:
+                    chat_file = stack.enter_context(self._open_chat_file())
+                    raw_messages = _timed(split_chat_messages(chat_file), stage_times, 'split')
+
+                    if self._incremental:
+                        raw_messages = self._skip_old_messages(raw_messages, skip=resume_state is not None)
+
+                    messages = self._render_messages(raw_messages)
+
+                # Close the messages in this thread if the chat stops early, because closing them shuts down any render
+                # workers, and that fails if the garbage collector does it later from one of the pool's own threads
+                stack.callback(messages.close)
+
+                for msg, html in _timed(messages, stage_times, 'render'):
+                    if search_index is not None:
+                        # Give the message an id so that the search page can link to it. The content of the message
+                        # was formatted when it was parsed, so this only puts the HTML together again
+                        anchor = search_index.next_anchor(msg)
+                        html = msg.create_html(self._sender_name, anchor=anchor)
+
+                    for timing_key, backend in backends:
+                        write_start_time = time.perf_counter()
+                        backend.write_message(msg, html)
+                        write_times[timing_key] = write_times.get(timing_key, 0.0) + time.perf_counter() - write_start_time
+
+                    if search_index is not None:
+                        # This is after the HTML is written, because that might start a new page
+                        search_index.add(msg, anchor, html_output.current_file)
+
+                    self._result.messages += 1
+
+                    if cache_messages:
+                        parse_cache.add(msg)
+
+                    if self._result.messages % Chat.progress_interval == 0:
+                        self._check_cancelled()
+
+                        # The text file reads ahead, so this is only roughly how far through the chat it is
+                        # A mapped chat records how far through it is as it goes, and a cached chat doesn't record it
+                        if chat_file is not None:
+                            self._text_bytes_read = chat_file.buffer.tell()
+
+                        self._report('messages')
+
+            self._text_bytes_read = self._text_size
+
+            # Every message has been written, so the backends can keep them
+            for timing_key, backend in backends:
+                write_start_time = time.perf_counter()
+                backend.commit()
+                write_times[timing_key] = write_times.get(timing_key, 0.0) + time.perf_counter() - write_start_time
+
+            if search_index is not None:
+                search_index.close()
+
+            if cache_messages:
+                parse_cache.commit()
+        finally:
+            # Every backend is closed, even if closing another one fails
+            with contextlib.ExitStack() as stack:
+                for _, backend in backends:
+                    stack.callback(backend.close)
+
+            if cache_messages:
+                parse_cache.discard()
+
+            if search_index is not None:
+                search_index.discard()
+
+        self._result.timings['split_messages'] = stage_times.get('split', 0.0)
+        self._result.timings['render_messages'] = stage_times.get('render', 0.0) - stage_times.get('split', 0.0)
+
+        for timing_key, _ in backends:
+            self._result.timings[timing_key] = write_times.get(timing_key, 0.0)
+
+        self._text_bytes_written = html_output.bytes_written
+        self._result.html_pages = html_output.page_files
+        self._html_state = html_output.state()
+
+        if self._extract_to_temp:
+            os.remove(os.path.join(self._temp_directory, '_chat.txt'))
+
+        self._result.timings['write_text'] = time.perf_counter() - start_time
+
+    def _skip_old_messages(self, raw_messages: Iterable, skip: bool,
+                           message_datetime: Callable[..., datetime] = None) -> Iterator:
+        """Yield the raw messages that are newer than the previous incremental run, and record the time of the last one.
+
+        Several messages can be sent in the same second, so the state records how many messages were sent at the time
+        of the last message, and that many messages at that time are skipped.
+
+        Arguments:
+            raw_messages: Iterable:
+                The raw messages from split_chat_messages(), or the parsed messages from ParsedMessageCache.read().
+
+            skip: bool:
+                If false, every message is yielded and only the time of the last one is recorded.
+
+        Keyword arguments:
+            message_datetime:
+                A function that returns the date and time of one of the messages. If not specified, the messages must
+                be raw messages.
+
+        """
+        message_datetime = message_datetime or _raw_message_datetime
+
+        last_time = None
+        messages_to_skip_at_last_time = 0
+
+        if skip and self._previous_state['last_message_time'] is not None:
+            last_time = datetime.fromisoformat(self._previous_state['last_message_time'])
+            messages_to_skip_at_last_time = self._previous_state['messages_at_last_time']
+
+        for raw_message in raw_messages:
+            message_time = message_datetime(raw_message)
+
+            if message_time == self._last_message_time:
+                self._messages_at_last_time += 1
+            else:
+                self._last_message_time = message_time
+                self._messages_at_last_time = 1
+
+            if last_time is not None and (message_time < last_time or (message_time == last_time and
+                                                                       self._messages_at_last_time <= messages_to_skip_at_last_time)):
+                self._result.skipped_messages += 1
+                continue
+
+            yield raw_message
+
+    def _load_state(self) -> None:
+        """Load the state of the previous incremental run of this chat, if there is one."""
+        try:
+            with open(self._state_file, 'r', encoding='utf-8') as f:
+                self._previous_state = json.load(f)
+        except FileNotFoundError:
+            return
+
+        self._previous_attachment_names = set(self._previous_state['attachments'])
+
+    def _can_resume_outputs(self) -> bool:
+        """Return True if the previous incremental run wrote every output that this run writes besides HTML."""
+        if self._search_index:
+            if not self._previous_state.get('search_index') or \
+                    not SearchIndex.has_chat(self._output_dir, self._result.html_file):
+                return False
+
+        if self._sqlite_file:
+            if self._previous_state.get('sqlite_file') != os.path.abspath(self._sqlite_file):
+                return False
+
+            if not SQLiteBackend.has_chat(self._sqlite_file, self._result.html_file):
+                return False
+
+        return True
+
+    def _save_state(self) -> None:
+        """Save the state of this incremental run so that the next one can skip everything that was done in this one."""
+        state = {'html_file': os.path.basename(self._result.html_file),
+                 'html': self._html_state,
+                 'last_message_time': self._last_message_time.isoformat() if self._last_message_time else None,
+                 'messages_at_last_time': self._messages_at_last_time,
+                 'attachments': sorted(self._attachment_names),
+                 'search_index': self._search_index,
+                 'sqlite_file': os.path.abspath(self._sqlite_file) if self._sqlite_file else None}
+
+        os.makedirs(os.path.dirname(self._state_file), exist_ok=True)
+
+        # Write to a temporary file and then rename it, so that the state is never half-written
+        with open(self._state_file + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(state, f, indent=1)
+
+        os.replace(self._state_file + '.tmp', self._state_file)
+
+    def _render_messages(self, raw_messages: Iterable, mapped_chat: Optional[Tuple[str, mmap.mmap, int, int]] = None) \
+            -> Iterator[Tuple[Message, str]]:
+        """Create a Message from every raw message and render it to HTML, yielding them in their original order.
+
+        If self._render_workers isn't 0, the raw messages are split into chunks of Chat.render_chunk_size messages
+        which are rendered in a pool of processes. Only a few chunks are in flight at once, so memory use stays bounded.
+
+        Arguments:
+            raw_messages: Iterable:
+                The raw messages from split_chat_messages(), or the ranges of the messages from find_message_ranges()
+                if mapped_chat is given.
+
+        Keyword arguments:
+            mapped_chat:
+                The tuple from _map_chat_file(), if the chat is memory-mapped. Then each message is only decoded when
+                it's rendered, and render workers map the file themselves, so only the ranges are sent to them.
+
+        Yields:
+            A tuple of each Message and its HTML.
+
+        """
+        if self._render_workers == 0:
+            if mapped_chat is not None:
+                buffer = mapped_chat[1]
+                raw_messages = (_decode_raw_message(buffer[start:end]) for start, end in raw_messages)
+
+            yield from _render_raw_messages(raw_messages, self._group_chat, self._html_file_name, self._sender_name,
+                                            self._thumbnails)
+            return
+
+        raw_messages = iter(raw_messages)
+        max_chunks_in_flight = 2 * self._render_workers
+
+        with concurrent.futures.ProcessPoolExecutor(self._render_workers, initializer=ignore_interrupts) as executor:
+            futures = collections.deque()
+
+            while True:
+                # Keep the pool busy by submitting chunks until there are enough in flight
+                while len(futures) < max_chunks_in_flight:
+                    chunk = list(itertools.islice(raw_messages, Chat.render_chunk_size))
+                    if not chunk:
+                        break
+
+                    if mapped_chat is None:
+                        futures.append(executor.submit(_render_raw_message_chunk, chunk, self._group_chat,
+                                                       self._html_file_name, self._sender_name, self._thumbnails))
+                    else:
+                        futures.append(executor.submit(_render_message_range_chunk, mapped_chat[0], chunk, self._group_chat,
+                                                       self._html_file_name, self._sender_name, self._thumbnails))
+
+                if not futures:
+                    break
+
+                # The oldest chunk is always yielded first, so the messages stay in order
+                yield from futures.popleft().result()
+
+    def _render_cached_messages(self, parsed_messages: Iterable[Tuple[int, str, Optional[str], str]],
+                                skip: bool) -> Iterator[Tuple[Message, str]]:
+        """Create a Message from every parsed message from the ParsedMessageCache and yield it with its HTML.
+
+        This is quick enough that it's never worth sending the messages to render workers.
+
+        Arguments:
+            parsed_messages: Iterable[tuple]:
+                The parsed messages from ParsedMessageCache.read().
+
+            skip: bool:
+                Whether to skip the messages that were formatted by the previous incremental run.
+
+        """
+        if self._incremental:
+            parsed_messages = self._skip_old_messages(
+                parsed_messages, skip,
+                message_datetime=lambda parsed: Message.timestamp_epoch + timedelta(seconds=parsed[0]))
+
+        for parsed in parsed_messages:
+            msg = Message.from_parsed(parsed, self._group_chat, self._html_file_name, thumbnails=self._thumbnails)
+            self._result.cached_messages += 1
+
+            yield msg, msg.create_html(self._sender_name)
+
+    @contextlib.contextmanager
+    def _map_chat_file(self) -> Iterator[Optional[Tuple[str, mmap.mmap, int, int]]]:
+        """Memory-map _chat.txt, if it can be read straight from a file, so its messages can be found without decoding it.
+
+        That's the extracted file if extract_to_temp is true, or the zip file if _chat.txt is stored in it without
+        compression. If _chat.txt is compressed or encrypted, or it's empty, it can't be mapped and None is yielded,
+        so it must be read with _open_chat_file() instead.
+
+        Yields:
+            A tuple of the path of the mapped file, its mmap.mmap, and the offsets of the start and end of _chat.txt in it.
+
+        """
+        if self._extract_to_temp:
+            path = os.path.join(self._temp_directory, '_chat.txt')
+            info = None
+            size = os.path.getsize(path)
+        else:
+            path = self._input_file
+
+            with zipfile.ZipFile(path) as zip_file:
+                info = zip_file.getinfo('_chat.txt')
+
+            size = info.file_size
+
+            if info.compress_type != zipfile.ZIP_STORED or info.flag_bits & 0x1:
+                yield None
+                return
+
+        # An empty file can't be mapped
+        if size == 0:
+            yield None
+            return
+
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            start = 0
+
+            if info is not None:
+                # The data of a zip member is after its local header, which has the name and extra field lengths at 26
+                name_length, extra_length = struct.unpack('<HH', buffer[info.header_offset + 26:info.header_offset + 30])
+                start = info.header_offset + 30 + name_length + extra_length
+
+            self._text_size = size
+            yield path, buffer, start, start + size
+
+    def _find_message_ranges(self, buffer: mmap.mmap, start: int, end: int) -> Iterator[Tuple[int, int]]:
+        """Yield the ranges of the messages from find_message_ranges(), recording how far through the chat they are."""
+        for message_range in find_message_ranges(buffer, start, end):
+            self._text_bytes_read = message_range[1] - start
+            yield message_range
+
+    @contextlib.contextmanager
+    def _open_chat_file(self) -> Iterator[TextIO]:
+        """Open _chat.txt as a text file, either from the temporary directory or straight from the zip file."""
+        if self._extract_to_temp:
+            chat_path = os.path.join(self._temp_directory, '_chat.txt')
+            self._text_size = os.path.getsize(chat_path)
+
+            with open(chat_path, 'r', encoding='utf-8') as chat_file:
+                yield chat_file
+        else:
+            with zipfile.ZipFile(self._input_file) as zip_file, \
+                    io.TextIOWrapper(zip_file.open('_chat.txt'), encoding='utf-8') as chat_file:
+                self._text_size = zip_file.getinfo('_chat.txt').file_size
+                yield chat_file
+
+    @staticmethod
+    def _converted_audio_filename(filename: str) -> Optional[str]:
+        """Return the name of the mp3 file that an audio attachment will be converted to, or None if it doesn't need converting.
+
+        Audio files that can't be played in browsers with simple HTML audio tags have to be converted.
+        This is necessary because all voice messages are .opus files.
+        """
+        file_match = re.match(Chat.attachment_file_pattern, filename)
+
+        if file_match and file_match.group(2) == 'AUDIO' and file_match.group(3) not in Message.html_audio_formats.keys():
+            return file_match.group(1) + '.mp3'
+
+        return None
+
+    def _copy_attachment(self, filename: str, source: BinaryIO) -> None:
+        """Copy a single attachment from an open binary file into the Attachments folder, converting audio if needed.
+
+        Audio is converted by self._transcoder in the background, so the conversion may not be finished when this returns.
+
+        Arguments:
+            filename: str:
+                The name of the attachment file, without any directories.
+
+            source: BinaryIO:
+                The open attachment file to read from. It can be a member of the zip file.
+
+        """
+        attachments_path = os.path.join(self._output_dir, 'Attachments', self._html_file_name)
+
+        if (mp3_filename := self._converted_audio_filename(filename)) is not None:
+            self._audio_conversions.append(self._transcoder.convert(source, os.path.join(attachments_path, mp3_filename)))
+            self._converted_audio_destinations.append(os.path.join(attachments_path, mp3_filename))
+        elif self._store is not None:
+            if self._store.add(source, os.path.join(attachments_path, filename)):
+                self._attachment_bytes_written += os.path.getsize(os.path.join(attachments_path, filename))
+            else:
+                self._result.deduplicated_attachments += 1
+        else:
+            with open(os.path.join(attachments_path, filename), 'wb') as destination:
+                shutil.copyfileobj(source, destination, 1024 * 1024)
+                self._attachment_bytes_written += destination.tell()
+
+        self._result.attachments += 1
+        self._start_thumbnail(filename)
+
+    def _start_thumbnail(self, filename: str) -> None:
+        """Start making a thumbnail of an attachment in the Attachments folder in the background, if it needs one."""
+        file_match = re.match(Chat.attachment_file_pattern, filename)
+
+        if self._thumbnail_executor is None or file_match is None or file_match.group(2) not in ('PHOTO', 'VIDEO'):
+            return
+
+        attachments_path = os.path.join(self._output_dir, 'Attachments', self._html_file_name)
+        thumbnail_path = os.path.join(attachments_path, 'thumbnails', file_match.group(1) + '.jpg')
+
+        self._thumbnail_futures.append(self._thumbnail_executor.submit(
+            _make_thumbnail, file_match.group(2), os.path.join(attachments_path, filename), thumbnail_path, Chat.thumbnail_size))
+
+    def _skip_old_attachment(self, filename: str) -> bool:
+        """Record the name of an attachment for the state and return True if a previous incremental run already moved it."""
+        self._attachment_names.append(filename)
+
+        if filename not in self._previous_attachment_names:
+            return False
+
+        output_filename = self._converted_audio_filename(filename) or filename
+
+        if os.path.isfile(os.path.join(self._output_dir, 'Attachments', self._html_file_name, output_filename)):
+            self._result.skipped_attachments += 1
+            return True
+
+        return False
+
+    def _move_attachment_files(self) -> None:
+        """Move the attachment files to the output directory, either from temp or straight from the zip file."""
+        start_time = time.perf_counter()
+
+        if not self._extract_to_temp:
+            with zipfile.ZipFile(self._input_file) as zip_file:
+                for member in zip_file.infolist():
+                    filename = os.path.basename(member.filename)
+
+                    if not member.is_dir() and filename != '_chat.txt' and not self._skip_old_attachment(filename):
+                        self._check_cancelled()
+
+                        with zip_file.open(member) as source:
+                            self._copy_attachment(filename, source)
+
+                        self._attachment_bytes_read += member.file_size
+                        self._report('attachments')
+
+        else:
+            for f in os.listdir(self._temp_directory):
+                if f != '_chat.txt' and not self._skip_old_attachment(f):
+                    self._check_cancelled()
+                    temp_path = os.path.join(self._temp_directory, f)
+
+                    if self._converted_audio_filename(f) is not None:
+                        self._attachment_bytes_read += os.path.getsize(temp_path)
+
+                        with open(temp_path, 'rb') as source:
+                            self._copy_attachment(f, source)
+
+                        os.remove(temp_path)
+                    else:
+                        # Files that don't need converting can just be moved
+                        # The temporary directory may be on a different filesystem, so this can't just rename them
+                        destination = os.path.join(self._output_dir, 'Attachments', self._html_file_name, f)
+                        shutil.move(temp_path, destination)
+                        self._result.attachments += 1
+
+                        if self._store is not None and not self._store.add_file(destination):
+                            self._result.deduplicated_attachments += 1
+
+                        self._start_thumbnail(f)
+
+                    self._report('attachments')
+
+        self._result.timings['copy_attachments'] = time.perf_counter() - start_time
+        wait_start_time = time.perf_counter()
+
+        # Wait for all the audio files to be converted
+        for future in self._audio_conversions:
+            self._check_cancelled()
+
+            if future.result():
+                self._result.converted_audio_files += 1
+            else:
+                self._result.cached_audio_files += 1
+
+            self._report('audio')
+
+        for destination in self._converted_audio_destinations:
+            self._attachment_bytes_written += os.path.getsize(destination)
+
+        # Converted audio files are only complete now, so they can be stored
+        if self._store is not None:
+            for destination in self._converted_audio_destinations:
+                if not self._store.add_file(destination):
+                    self._result.deduplicated_attachments += 1
+
+        self._result.timings['wait_for_audio'] = time.perf_counter() - wait_start_time
+        wait_start_time = time.perf_counter()
+
+        # Wait for all the thumbnails to be made
+        missing_thumbnails = 0
+        for future in self._thumbnail_futures:
+            try:
+                if future.result():
+                    self._result.thumbnails += 1
+                else:
+                    missing_thumbnails += 1
+            except Exception as e:  # A broken photo or video shouldn't stop the chat, because the HTML shows the full file
+                print(f'WARNING: Failed to make a thumbnail in {self._input_file}: {e!r}')
+
+        if missing_thumbnails:
+            # The HTML falls back to the full files, so the chat still works
+            print(f'WARNING: {missing_thumbnails} thumbnails in {self._input_file} were not made because '
+                  f'Pillow or ffmpeg is not installed')
+
+        self._result.timings['wait_for_thumbnails'] = time.perf_counter() - wait_start_time
+        self._result.timings['move_attachment_files'] = time.perf_counter() - start_time
+
+    def _check_cancelled(self) -> None:
+        """Raise FormatCancelled if the cancel_event has been set."""
+        if self._cancel_event is not None and self._cancel_event.is_set():
+            raise FormatCancelled(f'Formatting {self._input_file} was cancelled')
+
+    def _report(self, stage: str, error: Optional[Exception] = None) -> None:
+        """Call the progress callback, if there is one, with a ProgressEvent of the given stage."""
+        if self._progress is None:
+            return
+
+        self._progress(ProgressEvent(
+            stage, self._input_file, self._html_file_name, messages=self._result.messages,
+            attachments=self._result.attachments, converted_audio_files=self._result.converted_audio_files,
+            bytes_read=self._text_bytes_read + self._attachment_bytes_read, total_bytes=self._total_bytes,
+            bytes_written=self._text_bytes_written + self._attachment_bytes_written,
+            elapsed=time.perf_counter() - self._start_time, error=None if error is None else repr(error)))
+
+    def _format_profiled(self) -> None:
+        """Write the text and then move the attachments in this thread, profiling both with one cProfile profiler.
+
+        Only one profiler can be active at a time from Python 3.12, so profiled chats wait for each other. The profile
+        is saved to the profile_file even if formatting fails.
+        """
+        profile = cProfile.Profile()
+
+        with _profile_lock:
+            try:
+                profile.runcall(self._write_text)
+                profile.runcall(self._move_attachment_files)
+            finally:
+                profile.dump_stats(self._profile_file)
+
+    def format(self) -> FormatResult:
+        """Fully format the chat, reading it straight from the zip file or extracting it first.
+
+        The text and the attachments are done in two threads at the same time, unless the chat is being profiled.
+        This method waits for both of them to finish and then re-raises the first exception that either of them raised,
+        if there was one.
+
+        Returns:
+            A FormatResult with the counts and timings for this chat.
+
+        Raises:
+            FormatCancelled:
+                If the cancel_event was set before the chat was finished.
+
+        """
+        start_time = self._start_time = time.perf_counter()
+        self._check_cancelled()
+
+        own_transcoder = self._transcoder is None
+        if own_transcoder:
+            self._transcoder = AudioTranscoder()
+
+        if self._thumbnails:
+            os.makedirs(os.path.join(self._output_dir, 'Attachments', self._html_file_name, 'thumbnails'), exist_ok=True)
+            self._thumbnail_executor = concurrent.futures.ThreadPoolExecutor()
+
+        if self._incremental:
+            self._load_state()
+
+        try:
+            if self._progress is not None and zipfile.is_zipfile(self._input_file):
+                with zipfile.ZipFile(self._input_file) as zip_file:
+                    self._total_bytes = sum(member.file_size for member in zip_file.infolist())
+
+            self._report('started')
+
+            if self._extract_to_temp:
+                self._temp_directory = tempfile.mkdtemp(prefix='whatsapp_formatter_', dir=self._temp_dir)
+
+                if not self._extract_zip():
+                    raise OSError(f'Failed to extract {self._input_file}')
+
+                self._result.timings['extract_zip'] = time.perf_counter() - start_time
+
+            # Check the zip file before either thread starts writing any output for this chat
+            elif not zipfile.is_zipfile(self._input_file):
+                raise zipfile.BadZipFile(f'{self._input_file} does not exist or is not a zip file')
+
+            if self._profile_file is not None:
+                self._format_profiled()
+
+            else:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+                    futures = [executor.submit(self._write_text), executor.submit(self._move_attachment_files)]
+
+                # Leaving the with block waits for both threads, so this just raises any exceptions
+                for future in futures:
+                    future.result()
+
+            if self._incremental:
+                self._save_state()
+
+            self._result.bytes_read = self._text_bytes_read + self._attachment_bytes_read
+            self._result.bytes_written = self._text_bytes_written + self._attachment_bytes_written
+
+        except FormatCancelled:
+            # Don't start any more conversions or thumbnails that nothing is waiting for
+            for future in self._audio_conversions + self._thumbnail_futures:
+                future.cancel()
+
+            self._report('cancelled')
+            raise
+
+        except Exception as e:
+            self._report('failed', e)
+            raise
+
+        finally:
+            if self._temp_directory and os.path.isdir(self._temp_directory):
+                shutil.rmtree(self._temp_directory)
+
+            if own_transcoder:
+                self._transcoder.shutdown()
+
+            if self._thumbnail_executor is not None:
+                self._thumbnail_executor.shutdown()
+
+        self._result.timings['total'] = time.perf_counter() - start_time
+        self._report('finished')
+
+        return self._result
+
+
+@functools.lru_cache(maxsize=None)
+def _read_template(filename: str) -> str:
+    """Return the contents of a template file. This is cached, so each template is only read once per process."""
+    with open(filename, 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+def _timed(iterable: Iterable, times: Dict[str, float], key: str) -> Iterator:
+    """Yield everything from iterable, and add the total time spent getting the items to times[key] when it's finished."""
+    iterator = iter(iterable)
+    total_time = 0.0
+
+    try:
+        while True:
+            start_time = time.perf_counter()
+
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                total_time += time.perf_counter() - start_time
+
+            yield item
+    finally:
+        times[key] = times.get(key, 0.0) + total_time
+
+
+def _raw_message_datetime(raw_message: str) -> datetime:
+    """Return the date and time in the prefix of a raw message, without parsing the rest of it."""
+    prefix_match = re.match(message_start_pattern, raw_message)
+    if prefix_match is None:
+        raise BadFormatError('Failed to match the date and time of a message.')
+
+    date_obj = _parse_date(raw_message[1:11])[0]
+    hour, minute, second, _ = _parse_time(prefix_match.group(1))
+
+    return datetime(date_obj.year, date_obj.month, date_obj.day, hour, minute, second)
+
+
+def _message_range_datetime(buffer: mmap.mmap, message_range: Tuple[int, int]) -> datetime:
+    """Return the date and time of a message from find_message_ranges(), only decoding the start of it."""
+    start, end = message_range
+
+    # The prefix is 26 characters at most, so this is enough even with a few LRM, LRE, and PDF characters before it
+    prefix = buffer[start:min(end, start + 64)].decode('utf-8', errors='ignore')
+    return _raw_message_datetime(prefix.replace('\u200e', '').replace('\u202a', '').replace('\u202c', ''))
+
+
+def _render_raw_messages(raw_messages: Iterable[str], group_chat: bool, html_file_name: str, sender_name: str,
+                         thumbnails: bool = False) -> Iterator[Tuple[Message, str]]:
+    """Create a Message from every raw message and yield it with its HTML, skipping the notice that messages are encrypted."""
+    for raw_message in raw_messages:
+        # If it's the notice that messages are encrypted, skip it
+        if re.match(Message.encrypted_messages_notice_pattern, raw_message):
+            continue
+
+        msg = Message(raw_message, group_chat, html_file_name, thumbnails=thumbnails)
+        yield msg, msg.create_html(sender_name)
+
+
+def _render_raw_message_chunk(raw_messages: List[str], group_chat: bool, html_file_name: str, sender_name: str,
+                              thumbnails: bool) -> List[Tuple[Message, str]]:
+    """Return a list of every Message in a chunk of raw messages with its HTML.
+
+    This is a module level function so that it can be run in another process.
+    """
+    return list(_render_raw_messages(raw_messages, group_chat, html_file_name, sender_name, thumbnails))
+
+
+def _render_message_range_chunk(path: str, message_ranges: List[Tuple[int, int]], group_chat: bool, html_file_name: str,
+                                sender_name: str, thumbnails: bool) -> List[Tuple[Message, str]]:
+    """Return a list of every Message in a chunk of message ranges in a file with its HTML.
+
+    This is a module level function so that it can be run in another process. The file is mapped again in this process,
+    so only the ranges of the messages are sent to it, and each message is only decoded here.
+    """
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        raw_messages = [_decode_raw_message(buffer[start:end]) for start, end in message_ranges]
+
+    return list(_render_raw_messages(raw_messages, group_chat, html_file_name, sender_name, thumbnails))
+
+
+def _make_thumbnail(file_type: str, path: str, thumbnail_path: str, max_size: Tuple[int, int]) -> bool:
+    """Make a JPEG thumbnail of a photo, or a poster from the first frame of a video, no bigger than max_size.
+
+    Returns:
+        True if the thumbnail was made, False if it couldn't be made because Pillow or ffmpeg isn't installed.
+
+    """
+    if file_type == 'PHOTO':
+        if Image is None:
+            return False
+
+        with Image.open(path) as image:
+            image.thumbnail(max_size)
+            image.convert('RGB').save(thumbnail_path, 'JPEG', quality=80)
+
+        return True
+
+    # Else
+    # If it's a video
+    if shutil.which('ffmpeg') is None:
+        return False
+
+    subprocess.run(['ffmpeg', '-y', '-loglevel', 'error', '-i', path, '-frames:v', '1',
+                    '-vf', f'scale=w={max_size[0]}:h={max_size[1]}:force_original_aspect_ratio=decrease', thumbnail_path],
+                   check=True, stdin=subprocess.DEVNULL)
+
+    return True
+
+
+def split_chat_messages(chat_lines: Iterable[str]) -> Iterator[str]:
+    """Lazily split the lines of a _chat.txt file into raw messages, one message at a time.
+
+    A new message starts on every line that begins with a date and time prefix in square brackets.
+    Every other line is a continuation of the previous message, so it's joined onto that message.
+    LRM, LRE, and PDF Unicode characters are removed from every line.
+
+    Arguments:
+        chat_lines: Iterable[str]:
+            The lines of the chat, with their line endings. An open text file works.
+
+    Yields:
+        The raw string of each message, including the prefix data in square brackets.
+
+    """
+    message_lines: List[str] = []
+
+    for line in chat_lines:
+        line = line.replace('\u200e', '').replace('\u202a', '').replace('\u202c', '')
+
+        if line.startswith('[') and message_lines and re.match(message_start_pattern, line):
+            # Yield the previous message without the newline that separates it from this one
+            yield ''.join(message_lines)[:-1]
+            message_lines = []
+
+        message_lines.append(line)
+
+    if message_lines:
+        raw_message = ''.join(message_lines)
+        yield raw_message[:-1] if raw_message.endswith('\n') else raw_message
+
+
+def find_message_ranges(buffer, start: int = 0, end: Optional[int] = None) -> Iterator[Tuple[int, int]]:
+    """Lazily find where every message starts and ends in the bytes of a _chat.txt file, without decoding it.
+
+    The messages are the same ones that split_chat_messages() finds, so each range can be decoded on its own with
+    _decode_raw_message(), by this process or by another one that has mapped the same file.
+
+    Arguments:
+        buffer:
+            The bytes of the chat. It can be anything that supports the buffer protocol, like an mmap.mmap, so a big
+            chat doesn't need to be read into memory.
+
+    Keyword arguments:
+        start:
+            The offset in buffer where the chat starts. 0 if not specified.
+
+        end:
+            The offset in buffer where the chat ends. The end of buffer if not specified.
+
+    Yields:
+        A tuple of the offset of the first byte of each message and the offset after its last byte. The line ending
+        before the next message is part of the message, just like with the lines of a text file.
+
+    """
+    end = len(buffer) if end is None else end
+    message_start = start
+
+    # The pattern is searched for one match at a time instead of with finditer(), which would keep the buffer locked
+    # (so an mmap.mmap can't be closed) until the iterator is thrown away
+    while (boundary := message_boundary_pattern.search(buffer, message_start, end)) is not None:
+        # The match starts with the line ending at the end of the previous message
+        next_message_start = boundary.start() + 1
+        yield message_start, next_message_start
+        message_start = next_message_start
+
+    if message_start < end:
+        yield message_start, end
+
+
+def _decode_raw_message(data: bytes) -> str:
+    """Decode the bytes of one message from find_message_ranges() into the same raw message as split_chat_messages().
+
+    The line endings are translated like they are when a text file is read, and LRM, LRE, and PDF Unicode characters
+    are removed.
+    """
+    raw_message = data.decode('utf-8')
+
+    if '\r' in raw_message:
+        raw_message = raw_message.replace('\r\n', '\n').replace('\r', '\n')
+
+    raw_message = raw_message.replace('\u200e', '').replace('\u202a', '').replace('\u202c', '')
+
+    # Remove the newline that separates the message from the next one
+    return raw_message[:-1] if raw_message.endswith('\n') else raw_message
+
+
+def split_chat_buffer(buffer, start: int = 0, end: Optional[int] = None) -> Iterator[str]:
+    """Lazily split the bytes of a _chat.txt file, like a memory-mapped file, into raw messages.
+
+    This gives the same raw messages as split_chat_messages(), but it finds them in the bytes of the chat with
+    find_message_ranges() and only decodes each message when it's yielded.
+
+    Arguments:
+        buffer:
+            The bytes of the chat. It can be anything that supports the buffer protocol and slicing, like an mmap.mmap.
+
+    Keyword arguments:
+        start:
+            The offset in buffer where the chat starts. 0 if not specified.
+
+        end:
+            The offset in buffer where the chat ends. The end of buffer if not specified.
+
+    Yields:
+        The raw string of each message, including the prefix data in square brackets.
+
+    """
+    for message_start, message_end in find_message_ranges(buffer, start, end):
+        yield _decode_raw_message(buffer[message_start:message_end])
+
+
+def process_chat(input_file: str, group_chat: bool, sender_name: str, chat_title: str, html_file_name: str, output_dir: str,
+                 extract_to_temp: bool = False, transcoder: Optional[AudioTranscoder] = None, render_workers: int = 0,
+                 page_size: int = 0, page_by_month: bool = False, incremental: bool = False,
+                 dedupe_attachments: bool = False, thumbnails: bool = False, profile_dir: Optional[str] = None,
+                 progress: Optional[Callable[[ProgressEvent], None]] = None, cancel_event=None,
+                 template_dir: Optional[str] = None, library_dir: Optional[str] = None,
+                 temp_dir: Optional[str] = None, search_index: bool = False,
+                 parse_cache_dir: Optional[str] = None, sqlite_file: Optional[str] = None) -> FormatResult:
+    """Process one chat completely.
+
+    This function also checks that all arguments are of the right type before using them. If they're not, raise TypeError.
+
+    Arguments:
+        input_file: str:
+            The original zip file of the exported chat. It must have '.zip' on the end.
+
+        group_chat: bool:
+            A boolean to determine whether the chat is a group chat.
+
+        sender_name: str:
+            The name of the sender in the chat. Typically the user's WhatsApp alias.
+
+        chat_title: str:
+            The title of the chat. This appears in the top bar and in the browser tab. It is not the file name.
+
+        html_file_name: str:
+            The intended name of the final HTML file.
+
+        output_dir: str:
+            The intended directory for the output. The HTML file, Attachments folder, and Library folder will go here.
+
+    Keyword arguments:
+        extract_to_temp: bool:
+            A boolean which is false if not specified. If true, extract the whole zip file into a temporary directory first.
+            If false, read everything straight from the zip file.
+
+        transcoder: AudioTranscoder:
+            The AudioTranscoder to convert audio attachments with. If not specified, the chat creates its own.
+
+        render_workers: int:
+            The number of processes to parse and render the messages of this chat in. It's 0 if not specified,
+            which means that they're rendered in the same thread that writes the HTML file.
+
+        page_size: int:
+            The maximum number of messages on each page of the output. It's 0 if not specified, which means no maximum.
+
+        page_by_month: bool:
+            A boolean which is false if not specified. If true, each calendar month starts a new page of the output.
+
+        If page_size or page_by_month is given, the HTML file is an index of the pages, which link to each other.
+
+        incremental: bool:
+            A boolean which is false if not specified. If true, save the state of the chat in output_dir, and if a previous
+            incremental run of a chat with the same html_file_name saved its state, only format what's new since then.
+
+        dedupe_attachments: bool:
+            A boolean which is false if not specified. If true, store each distinct attachment only once in output_dir,
+            in a content-addressed AttachmentStore that every chat's Attachments folder links to.
+
+        thumbnails: bool:
+            A boolean which is false if not specified. If true, make thumbnails of photos and posters of videos, and only
+            load the full files when they're needed.
+
+        profile_dir: str:
+            A directory to save a cProfile dump of formatting this chat in, named after html_file_name with '.prof' on
+            the end. The chat isn't profiled if not specified. The dump can be read with the pstats module. Profiled
+            chats are formatted one at a time, because only one profiler can be active at once.
+
+        progress: Callable[[ProgressEvent], None]:
+            A function to call with a ProgressEvent as the chat goes along. It's called from the threads doing the work.
+
+        cancel_event:
+            An object with an is_set() method, like a threading.Event. Once it's set, the chat stops early.
+
+        template_dir: str:
+            The directory with start_template.txt and end_template.txt. The working directory if not specified.
+
+        library_dir: str:
+            The Library directory to copy to output_dir. 'Library' in the working directory if not specified.
+
+        temp_dir: str:
+            The directory to make the temporary directory in if extract_to_temp is true. The system's temporary
+            directory if not specified.
+
+        search_index: bool:
+            A boolean which is false if not specified. If true, write a search index of the chat in output_dir/Search,
+            which can be searched with Library/search.html.
+
+        parse_cache_dir: str:
+            The directory of a ParsedMessageCache, so that formatting the same export again doesn't parse it again,
+            even with a different sender_name, chat_title or html_file_name. Nothing is cached if not specified.
+
+        sqlite_file: str:
+            An SQLite database to write the messages to as well, with an SQLiteBackend. Many chats can be written to
+            the same database. Nothing is written to a database if not specified.
+
+    Returns:
+        A FormatResult with the counts and timings for this chat.
+
+    Raises:
+        TypeError:
+            If the arguments aren't all of the correct type.
+
+        FormatCancelled:
+            If the cancel_event was set before the chat was finished.
+
+    """
+    args = [input_file, group_chat, sender_name, chat_title, html_file_name, output_dir]
+
+    arg_types = [type(x) for x in args]
+    printable_arg_types = '[' + ', '.join([str(x)[8:-2] for x in arg_types]) + ']'
+
+    required_types = [str, bool, str, str, str, str]
+    printable_required_types = '[' + ', '.join([str(x)[8:-2] for x in required_types]) + ']'
+
+    # If all the arguments are of the correct type, format the chat
+    if arg_types == required_types:
+        chat = Chat(input_file, group_chat, sender_name, chat_title, html_file_name, output_dir, extract_to_temp=extract_to_temp,
+                    transcoder=transcoder, render_workers=render_workers, page_size=page_size, page_by_month=page_by_month,
+                    incremental=incremental, dedupe_attachments=dedupe_attachments, thumbnails=thumbnails,
+                    profile_file=os.path.join(profile_dir, html_file_name + '.prof') if profile_dir else None,
+                    progress=progress, cancel_event=cancel_event, template_dir=template_dir, library_dir=library_dir,
+                    temp_dir=temp_dir, search_index=search_index, parse_cache_dir=parse_cache_dir,
+                    sqlite_file=sqlite_file)
+        return chat.format()
+    else:
+        raise TypeError(f'Expected arg types of {printable_required_types}. Got {printable_arg_types} instead.')
+
+
+async def process_chat_async(input_file: str, group_chat: bool, sender_name: str, chat_title: str, html_file_name: str,
+                             output_dir: str, executor: Optional[concurrent.futures.Executor] = None, **kwargs) -> FormatResult:
+    """Process one chat completely in an executor, without blocking the event loop.
+
+    Many chats can be awaited at the same time, and they run concurrently in the executor. The arguments are the same
+    as process_chat(), and any other keyword arguments are passed on to it, so template_dir, library_dir and temp_dir
+    can be given to avoid depending on the working directory. Passing one AudioTranscoder as transcoder to every chat
+    stops each chat from starting its own pool of processes.
+
+    If the task awaiting this is cancelled, the chat is cancelled too, and it stops at its next message or attachment.
+
+    Keyword arguments:
+        executor: concurrent.futures.Executor:
+            The executor to run the chat in. The event loop's default executor is used if not specified.
+            If it's a ProcessPoolExecutor, every argument must be picklable, so progress can't be given, and cancel_event
+            must be shareable between processes, like an Event from a multiprocessing.Manager.
+
+        progress: Callable[[ProgressEvent], None]:
+            A function to call with a ProgressEvent as the chat goes along. Unlike process_chat(), it's called in
+            the event loop's thread, so it can use the event loop safely.
+
+    Returns:
+        A FormatResult with the counts and timings for this chat.
+
+    Raises:
+        TypeError:
+            If the arguments aren't all of the correct type.
+
+        FormatCancelled:
+            If the cancel_event was set before the chat was finished.
+
+    """
+    loop = asyncio.get_running_loop()
+    in_processes = isinstance(executor, concurrent.futures.ProcessPoolExecutor)
+
+    # A threading.Event can't be shared with other processes, so the chat can only be cancelled with a given cancel_event
+    cancel_event = kwargs.pop('cancel_event', None)
+    if cancel_event is None and not in_processes:
+        cancel_event = threading.Event()
+
+    # The progress callback is called from the chat's threads, so the events are passed back to the event loop
+    if (progress := kwargs.pop('progress', None)) is not None:
+        if in_processes:
+            raise ValueError('progress cannot be given when the executor is a ProcessPoolExecutor')
+
+        kwargs['progress'] = functools.partial(loop.call_soon_threadsafe, progress)
+
+    future = loop.run_in_executor(executor, functools.partial(
+        process_chat, input_file, group_chat, sender_name, chat_title, html_file_name, output_dir,
+        cancel_event=cancel_event, **kwargs))
+
+    try:
+        return await future
+    except asyncio.CancelledError:
+        if cancel_event is not None:
+            cancel_event.set()
+
+        raise
+
+
+def process_list_of_chats(list_of_chats: List[Tuple[str, bool, str, str, str, str]], use_processes: bool = False,
+                          max_workers: Optional[int] = None, audio_workers: Optional[int] = None, audio_cache_dir: Optional[str] = None,
+                          outcomes: Optional[dict] = None, progress: Optional[Callable[[ProgressEvent], None]] = None,
+                          cancel_event=None, **kwargs) -> List[Tuple[str, bool, str, str, str, str]]:
+    """Fully format a list of tuples, where each tuple is a list of arguments to be passed to process_chat().
+
+    Any other keyword arguments are passed on to process_chat() for every chat.
+
+    Keyword arguments:
+        use_processes:
+            A boolean which is false if not specified. If true, the chats are formatted in a pool of processes instead of
+            a pool of threads. Parsing and formatting messages is pure Python, so only processes can use multiple cores.
+
+        max_workers:
+            The maximum number of threads or processes to format chats with. The executor's default is used if not specified.
+
+        audio_workers:
+            The maximum number of processes in the AudioTranscoder pool shared by all the chats. The number of CPUs is used
+            if not specified. If use_processes is true, each chat's process converts its own audio instead, because
+            the chats are already spread across processes.
+
+        audio_cache_dir:
+            The directory for the AudioTranscoder to cache converted audio in. If not specified, nothing is cached.
+
+        outcomes:
+            A dictionary to fill in as chats finish. Each argument tuple is mapped to its FormatResult if it was processed,
+            or to the exception that stopped it if it was rejected.
+
+        progress:
+            A function to call with a ProgressEvent as each chat goes along. If use_processes is true, the events are
+            sent back through a multiprocessing.Manager queue and it's always called from one thread of this process.
+            Otherwise it's called from the threads formatting the chats, so it must be thread safe.
+
+        cancel_event:
+            An object with an is_set() method. Once it's set, the chats being formatted stop early, the chats that haven't
+            started are cancelled, and they're all rejected with FormatCancelled. It can be a threading.Event, but if
+            use_processes is true, it must be shareable between processes, like an Event from a multiprocessing.Manager.
+            Then the processes also ignore Ctrl+C, so that it can be handled by setting the cancel_event instead.
+
+    Returns:
+        rejected_chats:
+            A list of all the argument tuples that couldn't be processed properly. It is an empty list if no tuples failed.
+
+    """
+    rejected_chats = []
+
+    executor_class = concurrent.futures.ProcessPoolExecutor if use_processes else concurrent.futures.ThreadPoolExecutor
+
+    # A pickled AudioTranscoder has no pool, so chats in separate processes convert their own audio
+    transcoder = AudioTranscoder(audio_cache_dir, max_workers=0 if use_processes else audio_workers)
+
+    # Progress events from other processes are put in a queue and passed on to the callback by a thread in this process
+    manager = progress_thread = None
+    chat_progress = progress
+    if use_processes and progress is not None:
+        manager = multiprocessing.Manager()
+        progress_queue = manager.Queue()
+        chat_progress = progress_queue.put
+
+        progress_thread = threading.Thread(target=forward_progress_events, args=(progress_queue, progress), daemon=True)
+        progress_thread.start()
+
+    executor_kwargs = {}
+    if use_processes and cancel_event is not None:
+        executor_kwargs['initializer'] = ignore_interrupts
+
+    with executor_class(max_workers=max_workers, **executor_kwargs) as executor:
+        # Create a dictionary with the Future object of the method call as the key and the list of args as the value
+        # This allows us to return the args of the rejected chats
+        futures = {executor.submit(process_chat, *chat_data, transcoder=transcoder, progress=chat_progress,
+                                   cancel_event=cancel_event, **kwargs): chat_data
+                   for chat_data in list_of_chats}
+
+        for future in concurrent.futures.as_completed(futures):
+            # Chats that haven't started yet can be cancelled straight away
+            if cancel_event is not None and cancel_event.is_set():
+                for other_future in futures:
+                    other_future.cancel()
+
+            try:
+                result = future.result()
+            except concurrent.futures.CancelledError:
+                e = FormatCancelled(f'Formatting {futures[future][0]} was cancelled before it started')
+                print(f'CANCELLED: {futures[future][0]}')
+
+                if outcomes is not None:
+                    outcomes[tuple(futures[future])] = e
+
+                rejected_chats.append(futures[future])
+            except FormatCancelled as e:
+                print(f'CANCELLED: {futures[future][0]}')
+
+                if outcomes is not None:
+                    outcomes[tuple(futures[future])] = e
+
+                rejected_chats.append(futures[future])
+            except Exception as e:  # Any failure in one chat shouldn't stop the others from being processed
+                print(f'ERROR: Failed to process {futures[future][0]}: {e!r}')
+
+                if outcomes is not None:
+                    outcomes[tuple(futures[future])] = e
+
+                # Get the value from the dictionary using the Future object as the key
+                # This is the arguments passed
+                rejected_chats.append(futures[future])
+            else:
+                if outcomes is not None:
+                    outcomes[tuple(futures[future])] = result
+
+    transcoder.shutdown()
+
+    if progress_thread is not None:
+        progress_queue.put(None)
+        progress_thread.join()
+        manager.shutdown()
+
+    return rejected_chats
+
+
+def ignore_interrupts() -> None:
+    """Ignore Ctrl+C in a worker process, so that only the main process decides what to do about it."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def forward_progress_events(progress_queue, progress: Callable[[ProgressEvent], None]) -> None:
+    """Pass every ProgressEvent from a queue on to the progress callback, until None is put in the queue."""
+    while (event := progress_queue.get()) is not None:
+        progress(event)